@@ -0,0 +1,200 @@
+import numpy as np
+import threading
+import time
+from collections import deque
+
+import latency
+from shots import make_shot
+
+
+"""
+Monitor-driven acquisition: instead of polling the PV with a timer, subscribe to the PV monitor and
+queue every update. The CA callback only pushes the shot into a bounded deque (append and popleft are
+atomic in CPython, no lock is needed), the analysis drains the queue from its own thread.
+"""
+
+PULSEID_MASK = 0x1FFFF # LCLS timing: the pulse ID is encoded in the 17 lower bits of the nanoseconds
+
+
+def get_pulse_id(nanoseconds):
+    """ Pulse ID from the nanoseconds field of the EPICS timestamp """
+    if nanoseconds is None:
+        return None
+    return int(nanoseconds) & PULSEID_MASK
+
+
+class ShotQueue(object):
+    """
+    Bounded FIFO of shots. When full, the oldest shot is dropped to make room for the new one.
+    """
+    def __init__(self, maxlen=120):
+        self.maxlen = maxlen
+        self._queue = deque(maxlen=maxlen)
+        self.n_received = 0
+        self.n_dropped = 0
+        return
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, shot):
+        if len(self._queue)==self.maxlen:
+            self.n_dropped+=1
+        self._queue.append(shot)
+        self.n_received+=1
+        return
+
+    def get(self):
+        """ Returns the oldest shot, or None if the queue is empty """
+        try:
+            return self._queue.popleft()
+        except IndexError:
+            return None
+
+    def get_all(self):
+        """ Returns all the queued shots (oldest first) """
+        shots = []
+        shot = self.get()
+        while shot is not None:
+            shots.append(shot)
+            shot = self.get()
+        return shots
+
+
+class MonitorAcquisition(object):
+    """
+    Subscribe to the monitor of a waveform PV and queue each update with its timestamp and pulse ID.
+    """
+    def __init__(self, pv, maxlen=120, notify=None):
+        """ Args:
+        pv: pv instance (epics.PV, or FakePV for testing)
+        maxlen: size of the shot queue
+        notify: function called (without argument) from the CA thread each time a shot is queued
+        """
+        self.pv = pv
+        self.queue = ShotQueue(maxlen=maxlen)
+        self.notify = notify
+        self._count = 0
+        self._cb_index = None
+        return
+
+    def start(self):
+        if self._cb_index is None:
+            self._cb_index = self.pv.add_callback(self._callback)
+        return
+
+    def stop(self):
+        if self._cb_index is not None:
+            self.pv.remove_callback(self._cb_index)
+            self._cb_index = None
+        return
+
+    def _callback(self, value=None, timestamp=None, nanoseconds=None, **kwargs):
+        """ Runs in the CA thread: keep it short """
+        if value is None:
+            return
+        self._count+=1
+        pulse_id = get_pulse_id(nanoseconds)
+        shot = {
+            'value': np.asarray(value),
+            'timestamp': timestamp if timestamp is not None else time.time(),
+            'pulse_id': pulse_id if pulse_id is not None else self._count,
+            't_arrival': time.perf_counter() # see latency.py
+        }
+        self.queue.put(shot)
+        if self.notify is not None:
+            self.notify()
+        return
+
+
+def drain_shots(shot_queue, bkg_fun=None):
+    """ Shots (shots.Shot, oldest first) made from all the shots of the queue, with their timestamp, 
+    pulse ID and latency stamps (stage 'acquired').
+    Args:
+        shot_queue: ShotQueue (MonitorAcquisition.queue)
+        bkg_fun: background function, see shots.make_shot
+    """
+    shot_list = []
+    for shot in shot_queue.get_all():
+        stamps = latency.monitor.new_stamps(shot['t_arrival'])
+        shot_list.append(make_shot(shot['value'], bkg_fun=bkg_fun, timestamp=shot['timestamp'], 
+                                   pulse_id=shot['pulse_id'], stamps=stamps))
+        latency.monitor.stamp(stamps, 'acquired')
+    return shot_list
+
+
+class FakePV(object):
+    """
+    Stand-in for epics.PV to test the acquisition without IOC. Waveforms are taken in turn from a
+    set of reference waveforms, and published either manually (publish) or at a fixed rate from a
+    background thread (start).
+    """
+    def __init__(self, waveforms, pvname='FAKE:WAVEFORM'):
+        self.pvname = pvname
+        self.waveforms = np.atleast_2d(waveforms)
+        self._callbacks = {}
+        self._idx = 0
+        self._value = self.waveforms[0]
+        self._metadata = {}
+        self._thread = None
+        self._running = False
+        return
+
+    def add_callback(self, callback):
+        index = len(self._callbacks)+1
+        while index in self._callbacks:
+            index+=1
+        self._callbacks[index] = callback
+        return index
+
+    def remove_callback(self, index):
+        self._callbacks.pop(index, None)
+        return
+
+    def get(self):
+        return self._value
+
+    def get_with_metadata(self):
+        data = dict(self._metadata)
+        data['value'] = self._value
+        return data
+
+    def publish(self, value=None):
+        """ Simulate a monitor update (next reference waveform if value is None) """
+        if value is None:
+            value = self.waveforms[self._idx%self.waveforms.shape[0]]
+        self._idx+=1
+        timestamp = time.time()
+        self._value = value
+        self._metadata = {
+            'pvname': self.pvname,
+            'timestamp': timestamp,
+            'posixseconds': int(timestamp),
+            'nanoseconds': (int((timestamp%1)*1e9) & ~PULSEID_MASK) | (self._idx & PULSEID_MASK)
+        }
+        for callback in list(self._callbacks.values()):
+            callback(value=value, **self._metadata)
+        return
+
+    def start(self, rate=120):
+        """ Publish waveforms at a fixed rate (Hz) from a background thread """
+        self._running = True
+        self._thread = threading.Thread(target=self._run, args=(rate,), daemon=True)
+        self._thread.start()
+        return
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return
+
+    def _run(self, rate):
+        period = 1/rate
+        t_next = time.perf_counter()
+        while self._running:
+            self.publish()
+            t_next+=period
+            time.sleep(max(0, t_next-time.perf_counter()))
+        return
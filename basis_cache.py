@@ -0,0 +1,123 @@
+import hashlib
+import json
+import numpy as np
+import os
+import threading
+from collections import OrderedDict
+
+import config
+import refstore
+import utils
+import svd_waveform_processing as proc
+
+
+"""
+Cache of built regressors, keyed on the reference set and the construction parameters.
+
+The key is a hash of the raw reference waveforms and of (ROI, background, polarity, n_components,
+n_pulse, delay, SVD method, projector method and regularization). The most recent regressors are kept in memory, all of them are saved on
+disk (WaveformRegressor.save), so that switching back to a configuration used before, even in a
+previous session, does not recompute the SVD.
+"""
+
+
+def hash_waveforms(waveforms, chunk_size=10000):
+    """ Hash of a set of raw waveforms (memory-mapped sets are read chunk by chunk) """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(str((waveforms.shape, str(waveforms.dtype))).encode())
+    for ii in range(0, waveforms.shape[0], chunk_size):
+        h.update(np.ascontiguousarray(waveforms[ii:ii+chunk_size]).data)
+    return h.hexdigest()
+
+
+def bkg_settings(bkg_fun):
+    """ Background settings affecting the reference waveforms (see refstore.WaveformView) """
+    if bkg_fun is None:
+        return None
+    if isinstance(bkg_fun, utils.Background):
+        return {'bkg_idx': bkg_fun.bkg_idx, 'method': bkg_fun.method, 'trim': bkg_fun.trim}
+    return {'function': getattr(bkg_fun, '__name__', repr(bkg_fun))}
+
+
+class BasisCache(object):
+    """
+    Memory and disk cache of regressors.
+    """
+    def __init__(self, directory=config.BASIS_CACHE_DIR, maxsize=config.BASIS_CACHE_SIZE):
+        """ Args:
+        directory: directory of the saved regressors (None: memory only)
+        maxsize: number of regressors kept in memory
+        """
+        self.directory = directory
+        self.maxsize = maxsize
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        return
+
+    @staticmethod
+    def make_key(ref_hash, roi=None, bkg=None, polarity=config.POLARITY, n_components=1, n_pulse=1, delay=None,
+                 svd_method='exact', method='pinv', alpha=0):
+        params = {'refs': ref_hash, 'roi': None if roi is None else [int(r) for r in roi], 'bkg': bkg,
+                  'polarity': polarity, 'n_components': n_components, 'n_pulse': n_pulse,
+                  'delay': None if delay is None else [int(d) for d in np.ravel(delay)], 'svd_method': svd_method,
+                  'method': method, 'alpha': float(alpha)}
+        return hashlib.blake2b(json.dumps(params, sort_keys=True).encode(), digest_size=20).hexdigest(), params
+
+    def _fname(self, key):
+        return os.path.join(self.directory, key+'.npz')
+
+    def get(self, key):
+        """ Cached regressor, or None """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if self.directory is not None and os.path.exists(self._fname(key)):
+            regr = proc.WaveformRegressor.load(self._fname(key))
+            self._remember(key, regr)
+            return regr
+        return None
+
+    def put(self, key, regr, **metadata):
+        self._remember(key, regr)
+        if self.directory is not None:
+            regr.save(self._fname(key), **metadata)
+        return
+
+    def _remember(self, key, regr):
+        with self._lock:
+            self._memory[key] = regr
+            self._memory.move_to_end(key)
+            while len(self._memory)>self.maxsize:
+                self._memory.popitem(last=False)
+        return
+
+    def get_regressor(self, ref_wfs, ref_hash=None, roi=None, bkg_fun=None, polarity=config.POLARITY,
+                      n_components=1, n_pulse=1, delay=None, svd_method=config.SVD_METHOD, method='pinv', alpha=0):
+        """ Cached regressor for these reference waveforms and parameters, built and cached if needed.
+        Same preparation of the reference waveforms as the live analysis (see refstore.WaveformView).
+        Args:
+            ref_wfs: raw reference waveforms
+            ref_hash: hash_waveforms(ref_wfs), if already known
+            others: see svd_waveform_processing.construct_waveformRegressor
+        """
+        if ref_hash is None:
+            ref_hash = hash_waveforms(ref_wfs)
+        ref_view = refstore.WaveformView(ref_wfs, polarity=polarity, bkg_fun=bkg_fun, roi=roi)
+        if len(ref_view)>config.REF_CHUNK_SIZE:
+            svd_method = 'incremental' # large (memory-mapped) set: processed by chunks
+        key, params = self.make_key(ref_hash, roi=roi, bkg=bkg_settings(bkg_fun), polarity=polarity,
+                                    n_components=n_components, n_pulse=n_pulse, delay=delay, svd_method=svd_method,
+                                    method=method, alpha=alpha)
+        regr = self.get(key)
+        if regr is not None:
+            print('Regressor loaded from cache ({}).'.format(key[:8]))
+            return regr
+        if svd_method!='incremental':
+            ref_view = np.asarray(ref_view)
+        regr = proc.construct_waveformRegressor(ref_view, n_components=n_components, n_pulse=n_pulse, delay=delay,
+                                                svd_method=svd_method, roi=roi, method=method, alpha=alpha)
+        self.put(key, regr, input_hash=key, **params)
+        return regr
@@ -0,0 +1,303 @@
+import argparse
+import itertools
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime
+
+import config
+import engine
+import refstore
+import shots
+import utils
+import svd_waveform_processing as proc
+
+
+"""
+Benchmark of the per-shot analysis path.
+
+Measures the shots/s and the latency percentiles of the regressor operations (fit, fit_reconstruct,
+score, get_pulse_intensity, analyze, quality (analyze plus all the fit quality metrics, see
+fit_quality.py) and engine.fit_shots, the path of the GUI and headless workers)
+across waveform length, n_components, n_pulse, projector method and batch size, plus the cost of
+building the projector (multiPulseProjector, in calls/s, the SVD time is in 'svd_s').
+Data: the example GEM waveforms (refs/GEM_example_waveforms.csv, ROI 150:450) and synthetic waveforms
+made from their mean pulse shape, with a fixed random seed.
+
+Usage:
+    python benchmark.py -o bench.json                  # full suite
+    python benchmark.py --quick -o bench.json          # reduced grid
+    python benchmark.py --quick --compare bench.json   # compare with a previous run
+
+The results are saved as JSON (one entry per configuration and operation) with the environment
+(git commit, numpy version, CPU) so that runs on different versions or machines can be compared.
+"""
+
+
+GEM_ROI = [150, 450]
+GEM_DELAY = 37 # delay of the second pulse for the GEM multipulse configurations
+OPERATIONS = ['fit', 'fit_reconstruct', 'score', 'get_pulse_intensity', 'analyze', 'quality', 'fit_shots']
+RATES = [120, 1000] # Hz, deployment rates for the feasibility summary
+
+FULL_GRID = {
+    'lengths': [100, 300, 1000, 4000],
+    'components': [1, 3, 5],
+    'pulses': [1, 2, 4],
+    'methods': ['pinv', 'QR', 'Ridge'],
+    'batches': [1, 8, 64]
+}
+QUICK_GRID = {
+    'lengths': [300, 2000],
+    'components': [1, 3],
+    'pulses': [1, 2],
+    'methods': ['pinv', 'Ridge'],
+    'batches': [1, 16]
+}
+
+
+""" Data """
+_gem = []
+
+def gem_waveforms():
+    """ Example GEM waveforms, background subtracted, with polarity and ROI applied """
+    if not _gem:
+        wfs = refstore.load_reference_set(config.TEST_DATA_FILE)[0]
+        _gem.append(np.asarray(refstore.WaveformView(wfs, polarity=config.POLARITY, bkg_fun=utils.Background(10), roi=GEM_ROI)))
+    return _gem[0]
+
+
+def pulse_template(length):
+    """ Mean GEM pulse, resampled to length samples and normalized to a maximum of 1 """
+    pulse = gem_waveforms().mean(axis=0)
+    x = np.linspace(0, pulse.size-1, length)
+    pulse = np.interp(x, np.arange(pulse.size), pulse)
+    return pulse/pulse.max()
+
+
+def synthetic_delays(length, n_pulse):
+    """ Pulse delays (relative to the first pulse) spreading n_pulse pulses over the waveform """
+    return [int(ii*0.8*length/n_pulse) for ii in range(1, n_pulse)]
+
+
+def synthetic_waveforms(n, length, n_pulse=1, noise=0.01, seed=0):
+    """ Waveforms made of n_pulse pulses of the GEM shape (width length/10), with amplitude jitter,
+    timing jitter of one sample and white noise.
+    """
+    rng = np.random.default_rng(seed)
+    template = np.zeros(length)
+    width = max(length//10, 4)
+    template[length//20:length//20+width] = pulse_template(width)
+    X = np.zeros((n, length))
+    for delay in [0]+synthetic_delays(length, n_pulse):
+        amplitudes = rng.uniform(0.5, 1.5, size=n)
+        for ii in range(n):
+            X[ii]+=amplitudes[ii]*np.roll(template, delay+rng.integers(-1, 2))
+    X+=rng.normal(0, noise, size=X.shape)
+    return X
+
+
+def make_case(data, length, n_pulse, n_shots=512):
+    """ Reference waveforms (single pulse), test shots and delays of a configuration """
+    if data=='gem':
+        X = gem_waveforms()
+        delays = [GEM_DELAY*ii for ii in range(1, n_pulse)]
+        shots_ = np.tile(X, (n_shots//len(X)+1, 1))[:n_shots]
+        for delay in delays:
+            shots_ = shots_+0.5*np.roll(shots_, delay, axis=1)
+        return X, shots_, delays
+    refs = synthetic_waveforms(200, length, n_pulse=1, seed=1)
+    return refs, synthetic_waveforms(n_shots, length, n_pulse=n_pulse, seed=2), synthetic_delays(length, n_pulse)
+
+
+""" Timing """
+def time_calls(fun, inputs, min_time=0.2, min_calls=20, max_calls=100000):
+    """ Call fun on the inputs (cycled) until min_time and min_calls are reached.
+    Returns the latencies (s) of the calls.
+    """
+    latencies = []
+    t_start = time.perf_counter()
+    for ii in range(max_calls):
+        x = inputs[ii%len(inputs)]
+        t0 = time.perf_counter()
+        fun(x)
+        latencies.append(time.perf_counter()-t0)
+        if ii+1>=min_calls and time.perf_counter()-t_start>=min_time:
+            break
+    return np.asarray(latencies)
+
+
+def summarize(latencies, batch):
+    latency = {p: float(np.percentile(latencies, q)*1e6) for p, q in [('p50', 50), ('p90', 90), ('p99', 99)]}
+    latency['max'] = float(latencies.max()*1e6)
+    return {
+        'n_calls': int(latencies.size),
+        'shots_per_s': float(batch*latencies.size/latencies.sum()),
+        'latency_us': latency
+    }
+
+
+def make_operation(op, regr, polarity=1):
+    """ Function of a batch of waveforms for the operation op """
+    if op=='fit':
+        return regr.fit
+    elif op=='fit_reconstruct':
+        return regr.fit_reconstruct
+    elif op=='score':
+        return lambda X: regr.fit_reconstruct(X, return_score=True)
+    elif op=='get_pulse_intensity':
+        return lambda X: regr.get_pulse_intensity(X, mode='max')
+    elif op=='analyze':
+        return lambda X: regr.analyze(X, mode='max')
+    elif op=='quality':
+        def analyze_quality(X):
+            details = regr.analyze(X, mode='max', full_output=True)[3]
+            return regr.quality(X, details['residual'])
+        return analyze_quality
+    elif op=='fit_shots':
+        return lambda shot_list: engine.fit_shots(shot_list, regressor=regr, polarity=polarity)
+    raise NameError('Operation {} not implemented'.format(op))
+
+
+def run_case(data, length, n_components, n_pulse, method, batches, ops, min_time):
+    refs, X, delays = make_case(data, length, n_pulse)
+    length = X.shape[1]
+    case = {'data': data, 'length': length, 'n_components': n_components, 'n_pulse': n_pulse, 'method': method}
+    results = []
+
+    """ build costs """
+    t0 = time.perf_counter()
+    A0, _, svd = proc.get_basis_and_projector(refs, n_components=n_components)
+    t_svd = time.perf_counter()-t0
+    lat = time_calls(lambda A: proc.multiPulseProjector(A, n_pulse=n_pulse, delay=delays or None, method=method, alpha=1.),
+                     [A0], min_time=min_time/4, min_calls=5)
+    results.append(dict(case, op='multiPulseProjector', batch=1, **summarize(lat, 1)))
+    results[-1]['svd_s'] = t_svd
+    A, projector = proc.multiPulseProjector(A0, n_pulse=n_pulse, delay=delays or None, method=method, alpha=1.)
+    regr = proc.WaveformRegressor(A=A, projector=projector, n_pulse=n_pulse)
+
+    """ per shot operations """
+    for batch, op in itertools.product(batches, ops):
+        n_inputs = max(X.shape[0]//batch, 1)
+        if op=='fit_shots':
+            inputs = [[shots.Shot(y) for y in X[ii*batch:(ii+1)*batch]] for ii in range(n_inputs)]
+        else:
+            inputs = [X[ii*batch:(ii+1)*batch] for ii in range(n_inputs)]
+        lat = time_calls(make_operation(op, regr), inputs, min_time=min_time)
+        results.append(dict(case, op=op, batch=batch, **summarize(lat, batch)))
+    return results
+
+
+""" Environment and comparison """
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'date': datetime.now().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'threads': {key: os.environ[key] for key in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+                    if key in os.environ}
+    }
+
+
+def result_key(r):
+    return (r['data'], r['length'], r['n_components'], r['n_pulse'], r['method'], r['batch'], r['op'])
+
+
+def compare(results, baseline, threshold=0.1):
+    """ Print the throughput ratio (new/baseline) of the common configurations, flagging the regressions
+    larger than threshold.
+    """
+    base = {result_key(r): r for r in baseline['results']}
+    print('\nComparison with {} ({}):'.format(baseline['environment'].get('commit', ''), baseline['environment']['date']))
+    n_regressions = 0
+    for r in results:
+        b = base.get(result_key(r))
+        if b is None:
+            continue
+        ratio = r['shots_per_s']/b['shots_per_s']
+        flag = ''
+        if ratio<1-threshold:
+            flag = '  <-- regression'
+            n_regressions+=1
+        print('  {:<70s} {:10.0f} -> {:10.0f} shots/s  x{:.2f}{}'.format(
+            format_case(r), b['shots_per_s'], r['shots_per_s'], ratio, flag))
+    print('{} regression(s) larger than {:.0%}.'.format(n_regressions, threshold))
+    return n_regressions
+
+
+def format_case(r):
+    return '{data} L={length} nc={n_components} np={n_pulse} {method:<5s} batch={batch:<3d} {op}'.format(**r)
+
+
+def feasibility(results, rates=RATES):
+    """ Print, for the analyze hot path, whether the p99 latency per shot allows each rate """
+    print('\nFeasibility (analyze, p99 latency per shot vs shot period):')
+    for r in results:
+        if r['op']!='analyze':
+            continue
+        per_shot = r['latency_us']['p99']/r['batch']*1e-6
+        ok = ['{} Hz: {}'.format(rate, 'ok' if per_shot<1/rate else 'NO') for rate in rates]
+        print('  {:<70s} {:8.1f} us/shot  {}'.format(format_case(r), per_shot*1e6, ', '.join(ok)))
+    return
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Benchmark of the per-shot analysis path')
+    parser.add_argument('-o', '--output', default=None, help='JSON output file')
+    parser.add_argument('--quick', action='store_true', help='reduced grid')
+    parser.add_argument('--data', nargs='+', default=['gem', 'synthetic'], choices=['gem', 'synthetic'])
+    parser.add_argument('--lengths', type=int, nargs='+', default=None, help='waveform lengths (synthetic data)')
+    parser.add_argument('--components', type=int, nargs='+', default=None)
+    parser.add_argument('--pulses', type=int, nargs='+', default=None)
+    parser.add_argument('--methods', nargs='+', default=None, choices=['pinv', 'QR', 'Ridge'])
+    parser.add_argument('--batches', type=int, nargs='+', default=None)
+    parser.add_argument('--ops', nargs='+', default=OPERATIONS, choices=OPERATIONS)
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum measurement time per operation (s)')
+    parser.add_argument('--compare', default=None, help='previous JSON results to compare with')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    grid = dict(QUICK_GRID if args.quick else FULL_GRID)
+    for key in grid:
+        if getattr(args, key) is not None:
+            grid[key] = getattr(args, key)
+    cases = []
+    for data in args.data:
+        lengths = [GEM_ROI[1]-GEM_ROI[0]] if data=='gem' else grid['lengths']
+        pulses = [p for p in grid['pulses'] if p<=2] if data=='gem' else grid['pulses'] # GEM ROI: 2 pulses at most
+        cases+=[(data,)+c for c in itertools.product(lengths, grid['components'], pulses, grid['methods'])]
+
+    results = []
+    t0 = time.time()
+    for ii, case in enumerate(cases):
+        print('[{}/{}] data={} length={} n_components={} n_pulse={} method={}'.format(ii+1, len(cases), *case))
+        results+=run_case(*case, batches=grid['batches'], ops=args.ops, min_time=args.min_time)
+    print('Benchmark done in {:.0f} s.'.format(time.time()-t0))
+
+    feasibility(results)
+    output = {'environment': environment(), 'grid': grid, 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1)
+        print('Results saved to {}.'.format(args.output))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return output
+
+
+if __name__=='__main__':
+    main()
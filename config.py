@@ -1,9 +1,53 @@
 RATE = 60 # Hz
-DISPLAY_RATE_RATIO = 30 # lower display rate with respect to RATE
-INTENSITY_MODE = 'max' # intensity mode for the regressor
+DISPLAY_RATE_RATIO = 30 # lower display rate with respect to RATE (only if DISPLAY_FPS is None)
+DISPLAY_FPS = 10 # target display rate, independent of the analysis rate. None: one display every DISPLAY_RATE_RATIO shots
+DISPLAY_BUDGET = 0.5 # maximum fraction of the frame period spent drawing (the frame period is increased otherwise)
+BATCH_SIZE = 1 # number of shots fitted together (1: no batching). The results of a batch are dispatched as one list (one display per batch at most)
+BATCH_WINDOW = 50 # ms, maximum time to wait for a batch to be complete
+ACQUISITION_MODE = 'timer' # 'timer': poll the PV at RATE, 'monitor': one analysis per PV update
+QUEUE_SIZE = 120 # maximum number of shots waiting for analysis in monitor mode
+SCHEDULING = { # drop policy of each analysis stage on the threadpool (see scheduling.py)
+    'acquisition': {'policy': 'drop-newest', 'maxlen': 0},
+    'fit': {'policy': 'drop-oldest', 'maxlen': 12}
+}
+COUNTERS_PERIOD = 1 # s, update period of the shot counters display
+COUNTERS_LOG = False # also print the shot counters at each update (always displayed in the GUI)
+LATENCY_MONITOR = True # per-stage latency of the shots, displayed with the counters (see latency.py)
+LATENCY_LOG = False # also print the latency summary at each counters update
+LATENCY_WINDOW = 1000 # number of shots in the latency statistics
+ANALYSIS_BACKEND = 'threads' # fits in the 'threads' of the threadpool, or in worker 'processes' (see procpool.py)
+ANALYSIS_PROCESSES = None # number of worker processes of the 'processes' backend (None: number of CPUs)
+ANALYSIS_START_METHOD = 'spawn' # multiprocessing start method of the worker processes
+CHANNELS = {} # headless multi-channel mode (not the GUI), name: headless.py arguments of the channel (see multichannel.py)
+MULTICHANNEL_THREADS = 4 # size of the thread pool shared by the channels in headless multi-channel mode
+INTENSITY_MODE = 'max' # intensity mode for the regressor, 'norm' or 'max'
 DEFAULT_CHANNEL = 'DIAG:FEE1:202:241:Data'
 POLARITY = -1 # polarity of the waveform (positive or negative signal)
+BKG_METHOD = 'median' # background estimator: 'median', 'mean', 'trimmed' or 'pedestal' (see utils.Background)
+BKG_TRIM = 0.1 # fraction trimmed on each side for the 'trimmed' background
+BKG_PEDESTAL_ALPHA = 0.01 # weight of a new shot in the running 'pedestal' background
 SAVE_NUMBER = 200 # number of waveform to save when acquiring new set of reference
+REF_FLUSH_EVERY = 50 # number of reference waveforms between flushes to disk
+REF_CHUNK_SIZE = 5000 # reference sets larger than this are processed by chunks (incremental SVD)
 COLORS = ['#ffa500', '#5d8aa8', '#800080', '#ecd540',  '#da70d6',
           '#87ceeb', '#fada5e', '#ff00ff', '#00ff00', '#d6cadd']
+BASIS_CACHE = True # reuse the regressors already built for the same reference set and parameters (see basis_cache.py)
+BASIS_CACHE_DIR = './basis_cache' # directory of the cached regressors
+BASIS_CACHE_SIZE = 8 # number of cached regressors kept in memory
+DELAY_SCAN_PER = 'shot' # delay scan regressor (delay range 'start:stop' in the GUI): best delays per 'shot' or per 'batch'
+PROJECTOR_METHOD = 'pinv' # projector of the fit: 'pinv', 'QR' or 'Ridge' (regularized, see svd_waveform_processing.regularized_projector)
+RIDGE_ALPHA = 0. # regularization strength of the 'Ridge' projector
+SVD_METHOD = 'exact' # 'exact', 'randomized' or 'incremental' (see svd_waveform_processing.get_basis_and_projector)
+ONLINE_BASIS = False # update the basis from the live waveforms (single pulse only, see OnlineBasis)
+ONLINE_FORGET = 0.99 # forgetting factor per waveform of the online basis update
+ONLINE_MIN_SCORE = 0.95 # minimum fit score for a waveform to be used in the online basis update
+ONLINE_BATCH = 20 # number of waveforms per online basis update
+PV_SERVER = False # serve the results as PVs (requires caproto, see pv_server.py)
+PV_PREFIX = 'SVD:GEM:' # prefix of the served PVs
+PV_MAX_RATE = 10 # Hz, maximum update rate of the served PVs
+PV_MAX_PULSE = 4 # number of pulse intensity PVs
+RECORD = False # record the shot results in HDF5 files (requires h5py, see recorder.py)
+RECORD_DIR = './records' # directory of the recorded files
+RECORD_MAX_SHOTS = 100000 # number of shots per recorded file
+RECORD_WAVEFORMS = False # also record the background subtracted waveforms (compressed)
 TEST_DATA_FILE = './refs/GEM_example_waveforms.csv'
@@ -0,0 +1,286 @@
+import itertools
+import numpy as np
+import threading
+
+import fit_quality
+import svd_waveform_processing as proc
+
+
+"""
+Delay scan of multipulse fits.
+
+The multipulse basis for the delays (d_1, ..., d_P) is [A0, roll(A0, d_2), ..., roll(A0, d_P)] (see
+svd_waveform_processing.multiPulseProjector). With circular shifts, all its Gram blocks are
+cross-correlations of the single pulse basis, roll(A0, a).T roll(A0, b) = A0.T roll(A0, b-a), and all
+the projections roll(A0, d).T x are cross-correlations of the waveform with the basis. Both are
+computed once by FFT for all lags: the Gram matrices of every delay combination of the grid are
+assembled from the same blocks (the pseudo-inverses are small, n_pulse*n_components square), and the
+fit score of a batch of waveforms for every delay combination costs one FFT per waveform plus small
+quadratic forms.
+"""
+
+
+def _as_range(r):
+    return r if isinstance(r, range) else range(*r)
+
+
+def delay_grid(ranges):
+    """ Delay combinations from one range per delay (pulse 2 to n_pulse, relative to the first pulse).
+    Args:
+        ranges: list of range objects, or (start, stop[, step]) tuples
+    Returns:
+        list of delay lists, in the format of multiPulseProjector (n_pulse-1 delays)
+    """
+    ranges = [_as_range(r) for r in ranges]
+    return [list(d) for d in itertools.product(*ranges)]
+
+
+def parse_delay_scan(text):
+    """ Parse a delay scan specification 'start:stop[:step], ...' (one range per delay).
+    Returns the list of ranges, or None if text is not a scan specification.
+    """
+    if ':' not in text:
+        return None
+    return [range(*map(int, r.split(':'))) for r in text.split(',')]
+
+
+def construct_delayScanRegressor(X_ref, n_components=1, delay_ranges=None, per='shot', svd_method='exact', sampling=1):
+    """ Delay scan regressor based on a set of reference (single pulse) waveforms.
+    
+    Args:
+        X_ref: reference waveforms
+        n_components: number of SVD components of the single pulse basis
+        delay_ranges: one range per delay, see delay_grid (the number of pulses is len(delay_ranges)+1)
+        per: 'shot' or 'batch', see DelayScanRegressor
+        svd_method: see svd_waveform_processing.get_basis_and_projector
+        sampling: see DelayBank
+    """
+    A0, projector, svd = proc.get_basis_and_projector(X_ref, n_components=n_components, method=svd_method)
+    bank = DelayBank(A0, delay_grid(delay_ranges), sampling=sampling)
+    regr = DelayScanRegressor(bank, per=per, params=dict(n_components=n_components, n_pulse=bank.n_pulse, 
+                              delay_ranges=[[r.start, r.stop, r.step] for r in map(_as_range, delay_ranges)]))
+    regr.svd_ = svd
+    print('Delay scan over {} delay combinations.'.format(len(bank)))
+    return regr
+
+
+class DelayBank(object):
+    """
+    Projectors of a multipulse basis for a grid of delays, and fit scores of waveforms over the grid.
+    """
+    def __init__(self, singlePulseBasis, delays, sampling=1):
+        """ Args:
+        singlePulseBasis: single pulse basis A0 (n_samples, n_components), as given to multiPulseProjector
+        delays: list of delay lists (n_pulse-1 or n_pulse delays each, see multiPulseProjector), e.g. from delay_grid
+        sampling: sampling of the waveform, if the delays are in time units
+        """
+        A0 = np.asarray(singlePulseBasis, dtype=float)
+        self.A0 = A0
+        self.n_samples, self.n_components = A0.shape
+        delays = np.atleast_2d(np.asarray(delays, dtype=float))
+        if delays.shape[1]>0 and np.all(delays[:,0]==0):
+            self.delays = delays
+        else:
+            self.delays = np.insert(delays, 0, 0, axis=1)
+        self.n_pulse = self.delays.shape[1]
+        self.shifts = (self.delays/sampling).astype(int)%self.n_samples # (n_grid, n_pulse)
+
+        self._basis_fft = np.conj(np.fft.rfft(A0, axis=0)).T # (n_components, n_freq)
+        self.gram_inv = np.linalg.pinv(self._gram()) # (n_grid, n_pulse*n_components, n_pulse*n_components)
+        self._regressors = {}
+        self._lock = threading.Lock()
+        return
+
+    def __len__(self):
+        return self.shifts.shape[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock'], state['_regressors']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._regressors = {}
+        self._lock = threading.Lock()
+        return
+
+    def _xcorr(self, X):
+        """ Cross-correlation of X (n, n_samples) with the basis for all lags (n, n_components, n_samples):
+        xcorr[:,p,lag] = roll(A0[:,p], lag).dot(x)
+        """
+        return np.fft.irfft(self._basis_fft[None,:,:]*np.fft.rfft(X, axis=1)[:,None,:], n=self.n_samples, axis=2)
+
+    def _gram(self):
+        """ Gram matrix of the multipulse basis for every delay combination of the grid """
+        corr = self._xcorr(self.A0.T) # corr[q,p,lag] = roll(A0[:,p], lag).dot(A0[:,q])
+        diff = (self.shifts[:,None,:]-self.shifts[:,:,None])%self.n_samples # (n_grid, P, P): s_j-s_i
+        G = corr[:,:,diff] # (q, p, n_grid, i, j): roll(A0_p, s_j-s_i).dot(A0_q) = roll(A0_q, s_i).dot(roll(A0_p, s_j))
+        G = G.transpose(2,3,0,4,1) # (n_grid, i, q, j, p): row q of pulse i, column p of pulse j
+        m = self.n_pulse*self.n_components
+        return G.reshape(len(self), m, m)
+
+    def projections(self, X):
+        """ Projection of X on the multipulse basis, for every delay combination (n, n_grid, n_pulse*n_components) """
+        xcorr = self._xcorr(X) # (n, n_components, n_samples)
+        b = xcorr[:,:,self.shifts] # (n, n_components, n_grid, n_pulse)
+        return b.transpose(0,2,3,1).reshape(X.shape[0], len(self), -1)
+
+    def scan(self, X):
+        """ r2 score of the fit of each waveform of X for each delay combination (n, n_grid).
+        Same convention as WaveformRegressor.analyze.
+        """
+        X = np.atleast_2d(X)
+        b = self.projections(X)
+        ss_fit = np.einsum('sgi,gij,sgj->sg', b, self.gram_inv, b)
+        ss_res = np.maximum(np.einsum('ij,ij->i', X, X)[:,None]-ss_fit, 0)
+        Xc = X-X.mean(axis=1, keepdims=True)
+        ss_tot = np.einsum('ij,ij->i', Xc, Xc)[:,None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = np.where(ss_tot!=0, 1-ss_res/ss_tot, np.where(ss_res==0, 1., 0.))
+        return score
+
+    def basis(self, idx):
+        """ Multipulse basis (n_samples, n_pulse*n_components) for the delay combination idx """
+        return np.concatenate([np.roll(self.A0, s, axis=0) for s in self.shifts[idx]], axis=1)
+
+    def regressor(self, idx):
+        """ WaveformRegressor for the delay combination idx (built once) """
+        with self._lock:
+            if idx not in self._regressors:
+                A = self.basis(idx)
+                projector = self.gram_inv[idx].dot(A.T) # pinv(A)
+                regr = proc.WaveformRegressor(A=A, projector=projector, n_pulse=self.n_pulse)
+                regr.params_ = dict(n_components=self.n_components, n_pulse=self.n_pulse, delay=self.delays[idx].tolist())
+                self._regressors[idx] = regr
+            return self._regressors[idx]
+
+
+class DelayScanRegressor(object):
+    """
+    Multipulse regressor fitting each waveform (or each batch) with the delays of the bank giving the
+    best score. Same analyze interface as WaveformRegressor, the fitted delays of the last call are in
+    the buffers (key 'delays').
+    """
+    def __init__(self, bank, per='shot', support_tol=1e-2, params=None):
+        """ Args:
+        bank: DelayBank
+        per: 'shot' (best delays for each waveform) or 'batch' (same delays for all the waveforms of an analyze call)
+        support_tol: see WaveformRegressor
+        params: construction parameters (stored in params_)
+        """
+        if per not in ['shot', 'batch']:
+            raise ValueError('per must be \'shot\' or \'batch\'')
+        self.bank = bank
+        self.per = per
+        self.n_pulse_ = bank.n_pulse
+        self.params_ = dict(params or {}, per=per)
+        self.best_idx = 0 # most frequent best delays of the last call
+
+        A0 = bank.A0.T
+        A_max = np.abs(A0).max(axis=0)
+        if support_tol is None or A_max.max()==0:
+            support = np.arange(bank.n_samples)
+        else:
+            support = np.nonzero(A_max>=support_tol*A_max.max())[0]
+        self.pulse_op = A0[:,support] # (n_components, width): the max of a pulse does not depend on its shift
+        return
+
+    @property
+    def A(self):
+        return self.bank.regressor(self.best_idx).A
+
+    @property
+    def delays(self):
+        return self.bank.delays[self.best_idx]
+
+    def analyze(self, X, mode='max', full_output=False):
+        """ See WaveformRegressor.analyze. The details (full_output) also hold the fitted delays
+        'delays' (n, n_pulse). The outputs are views on buffers preallocated for the calling thread.
+        """
+        if mode not in proc.PULSE_INTENSITY_MODES:
+            raise ValueError('Intensity mode {} not supported, must be in {}'.format(mode, proc.PULSE_INTENSITY_MODES))
+        if X.ndim==1:
+            X = X[None,:]
+        if X.shape[-1]!=self.bank.n_samples:
+            print('Data and projector shapes dont match.')
+            zeros = np.zeros((X.shape[0], self.n_pulse_))
+            out = None, np.zeros(X.shape[0]), (zeros, zeros) if mode=='both' else zeros
+            return out+({},) if full_output else out
+        buf = self._get_buffers(X)
+        n, P, k = X.shape[0], self.n_pulse_, self.bank.n_components
+
+        """ (i) best delays """
+        scores = self.bank.scan(X)
+        if self.per=='batch':
+            idx = np.full(n, np.argmax(scores.mean(axis=0)))
+        else:
+            idx = np.argmax(scores, axis=1)
+        self.best_idx = np.bincount(idx).argmax()
+        buf['delays'][:] = self.bank.delays[idx]
+
+        """ (ii) coefficients and reconstruction """
+        b = self.bank.projections(X)[np.arange(n), idx] # (n, P*k)
+        np.einsum('sij,sj->si', self.bank.gram_inv[idx], b, out=buf['coeffs'])
+        coeffs = buf['coeffs'].reshape(n, P, k)
+        pulses = np.einsum('spk,kt->spt', coeffs, self.bank.A0.T) # unshifted pulses (n, P, n_samples)
+        t = np.arange(self.bank.n_samples)
+        shifted = (t[None,None,:]-self.bank.shifts[idx][:,:,None])%self.bank.n_samples
+        np.take_along_axis(pulses, shifted, axis=2).sum(axis=1, out=buf['reconstructed'])
+
+        """ (iii) r2 score """
+        np.subtract(X, buf['reconstructed'], out=buf['residual'])
+        score = fit_quality.r2(X, buf['residual'], out=buf['score'], work=buf['centered'])
+
+        """ (iv) pulse intensities """
+        if mode in ['norm', 'both']:
+            np.sqrt(np.einsum('ijk,ijk->ij', coeffs, coeffs), out=buf['intensities'])
+        if mode in ['max', 'both']:
+            np.matmul(coeffs, self.pulse_op).max(axis=2, out=buf['intensities_max'])
+
+        if mode=='both':
+            intensities = (buf['intensities'], buf['intensities_max'])
+        elif mode=='max':
+            intensities = buf['intensities_max']
+        else:
+            intensities = buf['intensities']
+        if full_output:
+            details = {'coeffs': buf['coeffs'], 'residual': buf['residual'], 'delays': buf['delays']}
+            return buf['reconstructed'], score, intensities, details
+        return buf['reconstructed'], score, intensities
+
+    def quality(self, X, residual, metrics=fit_quality.METRICS, noise=None):
+        """ See WaveformRegressor.quality """
+        X = np.atleast_2d(X)
+        residual = np.atleast_2d(residual)
+        if residual.shape!=X.shape:
+            raise ValueError('Residual of shape {} for waveforms of shape {}'.format(residual.shape, X.shape))
+        buf = self._get_buffers(X)
+        return fit_quality.fit_quality(X, residual, metrics=metrics, noise=noise,
+                                       n_params=buf['coeffs'].shape[1]+self.n_pulse_-1, work=buf['centered'])
+
+    def _get_buffers(self, X):
+        """ Output arrays of analyze, allocated once per thread and per input shape """
+        try:
+            local = self._local
+        except AttributeError:
+            local = self._local = threading.local()
+        if getattr(local, 'key', None)!=X.shape:
+            n = X.shape[0]
+            local.buffers = {
+                'coeffs': np.empty((n, self.n_pulse_*self.bank.n_components)),
+                'reconstructed': np.empty(X.shape),
+                'residual': np.empty(X.shape),
+                'centered': np.empty(X.shape),
+                'score': np.empty(n),
+                'intensities': np.empty((n, self.n_pulse_)),
+                'intensities_max': np.empty((n, self.n_pulse_)),
+                'delays': np.empty((n, self.n_pulse_))
+            }
+            local.key = X.shape
+        return local.buffers
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_local', None)
+        return state
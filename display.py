@@ -0,0 +1,110 @@
+import numpy as np
+import time
+
+
+"""
+Display pipeline: min/max decimation of the curves to the pixel width of the visible range, redraw of
+the changed curves only, and frame rate adapted to the time actually spent drawing.
+"""
+
+
+def minmax_decimate(x, y, x_range=None, n_pixels=1000):
+    """ Clip (x, y) to x_range and decimate to about 2*n_pixels points, keeping the min and max of y in
+    each pixel so that peaks and spikes remain visible. x must be increasing.
+    Returns x and y (views on the inputs if no decimation is needed).
+    """
+    if x_range is not None:
+        lo = max(np.searchsorted(x, x_range[0], side='left')-1, 0)
+        hi = min(np.searchsorted(x, x_range[1], side='right')+1, x.size)
+        x, y = x[lo:hi], y[lo:hi]
+    n_pixels = max(int(n_pixels), 1)
+    if y.size<=2*n_pixels:
+        return x, y
+    edges = np.linspace(0, y.size, n_pixels+1).astype(int)[:-1]
+    y_min = np.minimum.reduceat(y, edges)
+    y_max = np.maximum.reduceat(y, edges)
+    x_dec = np.repeat(x[edges], 2)
+    y_dec = np.empty(2*n_pixels, dtype=np.result_type(y.dtype, np.float64))
+    y_dec[0::2] = y_min
+    y_dec[1::2] = y_max
+    return x_dec, y_dec
+
+
+class DecimatedCurve(object):
+    """
+    Wraps a pyqtgraph PlotDataItem: setData only stores the data, render pushes the decimated data to
+    the item if the data or the view changed since the last render.
+    """
+    def __init__(self, item, viewbox=None):
+        """ Args:
+        item: PlotDataItem
+        viewbox: ViewBox of the plot (default: the item's view box)
+        """
+        self.item = item
+        self.viewbox = viewbox
+        self.x = None
+        self.y = None
+        self._version = None # version of the data, see setData
+        self._rendered = None # (version, x range, width) of the last render
+        return
+
+    def setData(self, x, y=None, version=None):
+        """ Store new data. version: any value identifying the data (e.g. an update counter). If None,
+        the data are always considered new.
+        """
+        if y is None:
+            x, y = None, x
+        if x is None:
+            x = np.arange(np.size(y))
+        self.x = x
+        self.y = y
+        self._version = object() if version is None else version
+        return
+
+    def _view(self):
+        vb = self.viewbox if self.viewbox is not None else self.item.getViewBox()
+        if vb is None:
+            return None, 1000
+        width = max(int(vb.width()), 1)
+        if vb.autoRangeEnabled()[0]:
+            return None, width
+        x_range = vb.viewRange()[0]
+        return (x_range[0], x_range[1]), width
+
+    def render(self, force=False):
+        """ Returns True if the item was updated """
+        if self.y is None:
+            return False
+        x_range, width = self._view()
+        state = (self._version, x_range, width)
+        if not force and state==self._rendered:
+            return False
+        x, y = minmax_decimate(self.x, self.y, x_range=x_range, n_pixels=width)
+        self.item.setData(x, y)
+        self._rendered = state
+        return True
+
+
+class FrameTimer(object):
+    """
+    Frame period adapted to the drawing time: the drawing should take at most a fraction `budget` of
+    the frame period, otherwise the period is increased (down to the target fps when drawing is fast).
+    """
+    def __init__(self, fps=10, budget=0.5, max_period=2.):
+        self.fps = fps
+        self.budget = budget
+        self.max_period = max_period
+        self.period = 1/fps
+        self.frame_time = 0.
+        self._t0 = None
+        return
+
+    def start_frame(self):
+        self._t0 = time.perf_counter()
+        return
+
+    def end_frame(self):
+        """ Returns the new frame period (s) """
+        self.frame_time = time.perf_counter()-self._t0
+        self.period = min(max(1/self.fps, self.frame_time/self.budget), self.max_period)
+        return self.period
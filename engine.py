@@ -0,0 +1,311 @@
+import numpy as np
+import threading
+import time
+
+import config
+import latency
+import shots
+import utils
+
+
+"""
+Headless analysis engine: acquire -> background -> ROI -> fit -> running averages -> sinks.
+Pure python / numpy, no Qt or pydm dependency, so that the analysis can run on a compute node. The
+results are handed to the sinks (see class Sink). The GUI workers use the same fit functions, and the
+GUI dispatches their results (running averages and sinks) through an engine (see main.py).
+
+Results are dictionaries with the same keys as the data_dict of the GUI workers:
+    'score', 'intensity', 'fit', 'coeffs', 'data'
+plus 'timestamp' and 'pulse_id' when run from the engine, and 'delay' with a delay scan regressor.
+"""
+
+
+INTENSITY_MODES = ['norm', 'max'] # intensity modes of fit_shots
+
+
+def fit_shots(data, roi=None, regressor=None, polarity=1, mode='max'):
+    """ Fit a list of shots in a single matrix multiplication.
+    Args:
+        data: list of shots.Shot (or (2,n) arrays: x, background subtracted waveform), as sent through newDataSignal
+        roi: roi, or list of one roi per shot (same width, e.g. shots of several channels, see multichannel.py)
+        regressor: WaveformRegressor instance
+        polarity: polarity of the waveforms
+        mode: intensity mode, 'norm' or 'max' (see WaveformRegressor.get_pulse_intensity). 'both' is not
+            supported: a data_dict holds one intensity array per shot.
+    Returns:
+        list of data_dict, in the order of the shots. The fits are Shot instances, views on the array of the batch fits.
+    """
+    if mode not in INTENSITY_MODES:
+        raise ValueError('Intensity mode {} not supported, must be in {}'.format(mode, INTENSITY_MODES))
+    if regressor is None:
+        return [{'score': 0, 'intensity': 0, 'fit': None, 'data': d} for d in data]
+    per_shot = roi is not None and np.ndim(roi[0])>0 # one roi per shot
+    rois = roi if per_shot else [roi]*len(data)
+    bounds = [roi_bounds(d[1].size, r) for d, r in zip(data, rois)]
+    widths = set(hi-lo for lo, hi in bounds)
+    if len(widths)>1:
+        raise ValueError('The rois of the shots fitted together must have the same width')
+    dat_fit = shots.scratch((len(data), widths.pop())) # only used within this call
+    for ii, (d, (lo, hi)) in enumerate(zip(data, bounds)):
+        np.multiply(d[1][lo:hi], polarity, out=dat_fit[ii])
+    if per_shot:
+        xfit = [shots.get_x(d[1].size)[lo:hi] for d, (lo, hi) in zip(data, bounds)]
+    else:
+        xfit = shots.get_x(data[0][1].size)[bounds[0][0]:bounds[0][1]]
+    fits, scores, intensities, details = regressor.analyze(dat_fit, mode=mode, full_output=True)
+    coeffs, delays = None, None
+    if fits is not None:
+        fits = np.multiply(fits, polarity)
+        coeffs = details['coeffs'].copy()
+        if 'delays' in details: # delay scan regressor (see delay_bank.py)
+            delays = details['delays'].copy()
+    scores = scores.copy()
+    intensities = intensities.copy() # analyze returns views on per-thread buffers
+    return make_data_list(data, scores, intensities, fits=fits, xfit=xfit, coeffs=coeffs, delays=delays)
+
+
+def roi_bounds(n_samples, roi=None):
+    """ Sample range (lo, hi) of the roi of a waveform of n_samples """
+    if roi is None:
+        return 0, n_samples
+    lo, hi, _ = slice(roi[0], roi[1]).indices(n_samples)
+    return lo, hi
+
+
+def make_data_list(data, scores, intensities, fits=None, xfit=None, coeffs=None, delays=None):
+    """ One data_dict per shot from the arrays of a batch fit (see fit_shots). The arrays are not copied.
+    xfit is the x-axis of the fits, or a list of one x-axis per shot.
+    """
+    data_list = []
+    for ii, d in enumerate(data):
+        data_dict = {
+            'score': scores[ii:ii+1],
+            'intensity': intensities[ii],
+            'fit': None if fits is None else shots.Shot(fits[ii], x=xfit[ii] if isinstance(xfit, list) else xfit),
+            'coeffs': None if coeffs is None else coeffs[ii],
+            'data': d
+        }
+        if delays is not None:
+            data_dict['delay'] = delays[ii]
+        data_list.append(data_dict)
+    return data_list
+
+
+def fit_shot(data, roi=None, regressor=None, polarity=1, mode='max'):
+    """ Fit a single shot, see fit_shots """
+    return fit_shots([data], roi=roi, regressor=regressor, polarity=polarity, mode=mode)[0]
+
+
+class Sink(object):
+    """
+    Output of the engine. Subclasses override the methods they need. The methods are called from
+    the engine thread and should return quickly.
+    """
+    def on_regressor(self, regressor):
+        """ Called when a new regressor is set """
+        return
+
+    def on_results(self, results, ravgs):
+        """ Called after each processed batch of shots.
+        Args:
+            results: list of result dictionaries
+            ravgs: running averages of the score and of each pulse intensity (dict of RunningAverage)
+        """
+        return
+
+    def close(self):
+        return
+
+
+class PrintSink(Sink):
+    """ Print a summary of the analysis every period seconds """
+    def __init__(self, period=1., name=None, latency=True):
+        """ Args:
+        period: print period (s)
+        name: prefix of the printed lines (channel name)
+        latency: also print the latency summary (see latency.py)
+        """
+        self.period = period
+        self.name = name
+        self.latency = latency
+        self._t_last = time.time()
+        self._n = 0
+        return
+
+    def on_results(self, results, ravgs):
+        self._n+=len(results)
+        t = time.time()
+        if t-self._t_last<self.period:
+            return
+        rate = self._n/(t-self._t_last)
+        self._n = 0
+        self._t_last = t
+        prefix = '' if self.name is None else '{} | '.format(self.name)
+        if ravgs:
+            intensities = ', '.join(['{:.4g}'.format(np.asarray(r.ravg).item()) for r in ravgs['intensity']])
+            print('{}{:.1f} Hz | score: {:.4f} | intensities: {}'.format(
+                prefix, rate, np.asarray(ravgs['score'].ravg).item(), intensities))
+        else:
+            print('{}{:.1f} Hz | no regressor'.format(prefix, rate))
+        latency_txt = latency.monitor.format_summary() if self.latency else ''
+        if latency_txt:
+            print(latency_txt)
+        return
+
+
+class AnalysisEngine(object):
+    """
+    Streaming analysis of waveforms: background subtraction, ROI, fit and running averages. The
+    results are passed to the sinks.
+    """
+    def __init__(self, regressor=None, roi=None, bkg_fun=None, polarity=config.POLARITY,
+                 mode=config.INTENSITY_MODE, n=0, ts_len=1000, alpha=None, max_batch=64):
+        """ Args:
+        regressor: WaveformRegressor instance (can be set later with set_regressor)
+        roi: roi
+        bkg_fun: function to calculate the background (utils.Background, or function taking wf as single input)
+        polarity: polarity of the waveforms
+        mode: intensity mode, 'norm' or 'max'
+        n, ts_len, alpha: running averages parameters (see utils.RunningAverage)
+        max_batch: maximum number of queued shots fitted together in run
+        """
+        if mode not in INTENSITY_MODES:
+            raise ValueError('Intensity mode {} not supported, must be in {}'.format(mode, INTENSITY_MODES))
+        self.roi = roi
+        self.bkg_fun = bkg_fun
+        self.polarity = polarity
+        self.mode = mode
+        self.n = n
+        self.ts_len = ts_len
+        self.alpha = alpha
+        self.max_batch = max_batch
+        self.sinks = []
+        self.ravgs = {}
+        self.n_processed = 0
+        self.regressor = None
+        if regressor is not None:
+            self.set_regressor(regressor)
+        self._stop = threading.Event()
+        return
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        if self.regressor is not None:
+            sink.on_regressor(self.regressor)
+        return
+
+    def set_regressor(self, regressor, reset=True):
+        """ Swap the regressor and reset the running averages (not for an update of the same basis, 
+        reset=False, e.g. svd_waveform_processing.OnlineBasis)
+        """
+        if reset:
+            self.reset_ravgs(regressor.n_pulse_)
+        self.regressor = regressor
+        for sink in self.sinks:
+            sink.on_regressor(regressor)
+        return
+
+    def reset_ravgs(self, n_pulse=None):
+        """ New running averages of the score and of the n_pulse intensities (default: number of pulses
+        of the regressor), with the current parameters n, ts_len and alpha.
+        """
+        if n_pulse is None:
+            n_pulse = self.regressor.n_pulse_
+        self.ravgs = {
+            'score': utils.RunningAverage(self.n, self.ts_len, alpha=self.alpha),
+            'intensity': [utils.RunningAverage(self.n, self.ts_len, alpha=self.alpha) for ii in range(n_pulse)]
+        }
+        return
+
+    def process(self, waveforms, timestamps=None, pulse_ids=None):
+        """ Analyze a batch of raw waveforms (list or 2D array, same length) and dispatch the results.
+        Returns the list of results.
+        """
+        data = self.prepare(waveforms)
+        regressor = self.regressor # same regressor for the whole batch, even if swapped meanwhile
+        results = fit_shots(data, roi=self.roi, regressor=regressor, polarity=self.polarity, mode=self.mode)
+        return self.dispatch(results, regressor, timestamps=timestamps, pulse_ids=pulse_ids)
+
+    def prepare(self, waveforms):
+        """ Background subtraction of a batch of raw waveforms (same length). Returns the list of shots. """
+        waveforms = np.asarray(waveforms)
+        if self.bkg_fun is not None:
+            if isinstance(self.bkg_fun, utils.Background):
+                bkg = self.bkg_fun(waveforms) # vectorized over the batch
+            else:
+                bkg = np.asarray([self.bkg_fun(y) for y in waveforms])
+            waveforms = np.subtract(waveforms, bkg[:,None], dtype=np.result_type(waveforms.dtype, np.float64))
+        return [shots.Shot(y) for y in waveforms]
+
+    def dispatch(self, results, regressor, timestamps=None, pulse_ids=None):
+        """ Update the running averages with the results of the fit (by regressor) of a batch, and pass
+        them to the sinks. The failed fits (no fit), and the fits in flight during a swap to a regressor
+        with another number of pulses, are not averaged. Returns the list of results.
+        """
+        for ii, result in enumerate(results):
+            result['timestamp'] = None if timestamps is None else timestamps[ii]
+            result['pulse_id'] = None if pulse_ids is None else pulse_ids[ii]
+        n_pulse = len(self.ravgs.get('intensity', []))
+        fitted = [r for r in results if r['fit'] is not None and np.size(r['intensity'])==n_pulse]
+        if regressor is not None and fitted:
+            scores = np.asarray([r['score'][0] for r in fitted])
+            intensities = np.asarray([r['intensity'] for r in fitted])
+            self.ravgs['score'].update_ravg_ts_batch(scores)
+            for ii, ravg in enumerate(self.ravgs['intensity']):
+                ravg.update_ravg_ts_batch(intensities[:,ii])
+        self.n_processed+=len(results)
+        for sink in self.sinks:
+            sink.on_results(results, self.ravgs)
+        return results
+
+    def process_shots(self, shot_list):
+        """ Analyze shot_list from the acquisition (dictionaries with 'value', 'timestamp' and 'pulse_id').
+        Consecutive shot_list of the same length are fitted together.
+        """
+        ii = 0
+        while ii<len(shot_list):
+            jj = ii+1
+            while jj<len(shot_list) and jj-ii<self.max_batch and shot_list[jj]['value'].size==shot_list[ii]['value'].size:
+                jj+=1
+            batch = shot_list[ii:jj]
+            stamps = [latency.monitor.new_stamps(s['t_arrival']) if 't_arrival' in s else None for s in batch]
+            for st in stamps:
+                latency.monitor.stamp(st, 'fit_start')
+            self.process([s['value'] for s in batch], timestamps=[s['timestamp'] for s in batch],
+                         pulse_ids=[s['pulse_id'] for s in batch])
+            for st in stamps:
+                latency.monitor.stamp(st, 'fit_end', final=True)
+            ii = jj
+        return
+
+    def run(self, acquisition, max_shots=None, timeout=1.):
+        """ Process the shots of a MonitorAcquisition until stop is called (or max_shots are processed).
+        The acquisition notify function is replaced to wake up the engine.
+        """
+        new_shot = threading.Event()
+        acquisition.notify = new_shot.set
+        acquisition.start()
+        self._stop.clear()
+        try:
+            while not self._stop.is_set():
+                new_shot.wait(timeout)
+                new_shot.clear()
+                shot_list = acquisition.queue.get_all()
+                if max_shots is not None:
+                    shot_list = shot_list[:max_shots-self.n_processed]
+                self.process_shots(shot_list)
+                if max_shots is not None and self.n_processed>=max_shots:
+                    break
+        finally:
+            acquisition.stop()
+        return
+
+    def stop(self):
+        self._stop.set()
+        return
+
+    def close(self):
+        self.stop()
+        for sink in self.sinks:
+            sink.close()
+        return
@@ -0,0 +1,125 @@
+import numpy as np
+
+
+"""
+Vectorized fit quality metrics of a batch of waveforms X (n_shots, n_samples).
+
+All the metrics are derived from a few row sums of the centered waveforms and of the residual of the
+fit (X minus the fit, computed by the fit itself, see WaveformRegressor.analyze), without loop over the
+waveforms and without recomputing the fit:
+    r2       coefficient of determination 1-ss_res/ss_tot (same convention as sklearn r2_score)
+    pearson  Pearson correlation between the waveform and its fit
+    rms      normalized residual RMS, |X-fit|/|X|
+    chi2     reduced chi2, ss_res/(noise**2*(n_samples-n_params)). With noise=None, the residual
+             variance per degree of freedom.
+"""
+
+
+METRICS = ['r2', 'pearson', 'rms', 'chi2']
+HIGHER_IS_BETTER = {'r2': True, 'pearson': True, 'rms': False, 'chi2': False}
+
+
+def _rowdot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+
+def _center(X, work=None):
+    return np.subtract(X, X.mean(axis=1, keepdims=True), out=work)
+
+
+def _r2(ss_res, ss_tot, out=None):
+    """ 1-ss_res/ss_tot, 1 for a perfect fit of a constant waveform, 0 for other constant waveforms """
+    if out is None:
+        out = np.empty(ss_res.shape)
+    out.fill(0.)
+    valid = ss_tot!=0
+    out[valid] = 1 - ss_res[valid]/ss_tot[valid]
+    out[~valid & (ss_res==0)] = 1.
+    return out
+
+
+def r2(X, residual, out=None, work=None):
+    """ r2 score of each waveform from the residual of its fit.
+    Args:
+        X: waveforms (n, n_samples)
+        residual: X minus the fits
+        out: optional output array (n,)
+        work: optional work array of the shape of X
+    """
+    Xc = _center(X, work)
+    return _r2(_rowdot(residual, residual), _rowdot(Xc, Xc), out=out)
+
+
+def fit_quality(X, residual, metrics=METRICS, noise=None, n_params=0, work=None):
+    """ Fit quality metrics of each waveform.
+    Args:
+        X: waveforms (n, n_samples)
+        residual: X minus the fits
+        metrics: metrics to compute (see METRICS)
+        noise: noise RMS of the samples for chi2, scalar or one value per waveform (n,)
+        n_params: number of fitted parameters (chi2 degrees of freedom)
+        work: optional work array of the shape of X
+    Returns:
+        dictionary metric: array (n,)
+    """
+    unknown = set(metrics)-set(METRICS)
+    if unknown:
+        raise ValueError('Unknown fit quality metrics {}. Must be in {}.'.format(sorted(unknown), METRICS))
+    X = np.atleast_2d(X)
+    residual = np.atleast_2d(residual)
+    n_samples = X.shape[1]
+    ss_res = _rowdot(residual, residual)
+    quality = {}
+    if 'r2' in metrics or 'pearson' in metrics:
+        Xc = _center(X, work)
+        ss_tot = _rowdot(Xc, Xc)
+        if 'r2' in metrics:
+            quality['r2'] = _r2(ss_res, ss_tot)
+        if 'pearson' in metrics:
+            """ fit = X-residual: cov(X, fit) = ss_tot-cov(X, res), var(fit) = ss_tot-2cov(X, res)+var(res) """
+            c_xe = _rowdot(Xc, residual)
+            se = residual.sum(axis=1)
+            var_e = np.maximum(ss_res-se*se/n_samples, 0)
+            cov = ss_tot-c_xe
+            var_fit = np.maximum(ss_tot-2*c_xe+var_e, 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pearson = cov/np.sqrt(ss_tot*var_fit)
+            quality['pearson'] = np.where(np.isfinite(pearson), np.clip(pearson, -1, 1), 0.)
+    if 'rms' in metrics:
+        ss = _rowdot(X, X)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            quality['rms'] = np.where(ss!=0, np.sqrt(ss_res/ss), np.where(ss_res==0, 0., np.inf))
+    if 'chi2' in metrics:
+        dof = max(n_samples-n_params, 1)
+        variance = 1. if noise is None else np.square(noise)
+        quality['chi2'] = ss_res/(variance*dof)
+    return quality
+
+
+def gate(quality, thresholds):
+    """ Waveforms passing all the thresholds. A NaN metric (e.g. failed fit) fails its threshold.
+    Args:
+        quality: output of fit_quality
+        thresholds: dictionary metric: threshold, minimum for r2 and pearson, maximum for rms and chi2
+    Returns:
+        boolean array (n,)
+    """
+    good = None
+    for metric, threshold in thresholds.items():
+        if HIGHER_IS_BETTER[metric]:
+            passed = quality[metric]>=threshold
+        else:
+            passed = quality[metric]<=threshold
+        good = passed if good is None else good & passed
+    return good
+
+
+def parse_thresholds(items):
+    """ Thresholds from 'metric=value' strings (command line), e.g. ['r2=0.9', 'chi2=4'] """
+    thresholds = {}
+    for item in items or []:
+        metric, value = item.split('=')
+        if metric not in METRICS:
+            raise ValueError('Unknown fit quality metric {}. Must be in {}.'.format(metric, METRICS))
+        thresholds[metric] = float(value)
+    return thresholds
@@ -0,0 +1,135 @@
+import argparse
+import numpy as np
+import signal
+import time
+
+import config
+import utils
+import svd_waveform_processing as proc
+import refstore
+from acquisition import MonitorAcquisition, FakePV
+from engine import AnalysisEngine, PrintSink
+from basis_cache import BasisCache
+from delay_bank import construct_delayScanRegressor, parse_delay_scan
+
+
+"""
+Headless runner of the SVD analysis (no display needed).
+
+Examples:
+    python headless.py --pv DIAG:FEE1:202:241:Data --roi 0 100 --bkg 50
+    python headless.py --fake refs/GEM_example_waveforms.csv --rate 120 --max-shots 1000
+"""
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Headless SVD waveform analysis.')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--pv', default=config.DEFAULT_CHANNEL, help='waveform PV')
+    source.add_argument('--fake', default=None, help='replay the waveforms of this file as a fake PV')
+    parser.add_argument('--rate', type=float, default=config.RATE, help='rate of the fake PV (Hz)')
+    parser.add_argument('--refs', default=config.TEST_DATA_FILE, help='reference waveforms (.npy or .csv)')
+    parser.add_argument('--regressor', default=None, help='saved regressor (.npz), instead of building it from --refs')
+    parser.add_argument('--n-components', type=int, default=1)
+    parser.add_argument('--n-pulse', type=int, default=1)
+    parser.add_argument('--delay', type=int, nargs='*', default=None, help='delays between the pulses')
+    parser.add_argument('--projector', default=config.PROJECTOR_METHOD, choices=['pinv', 'QR', 'Ridge'])
+    parser.add_argument('--alpha', type=float, default=config.RIDGE_ALPHA, help='regularization of the Ridge projector')
+    parser.add_argument('--delay-scan', default=None, metavar='START:STOP[:STEP],...',
+                        help='fit the best delays of each shot in these ranges (one range per delay, see delay_bank.py)')
+    parser.add_argument('--scan-per', default=config.DELAY_SCAN_PER, choices=['shot', 'batch'])
+    parser.add_argument('--roi', type=int, nargs=2, default=[0, 100])
+    parser.add_argument('--bkg', type=int, default=0, help='number of samples for the background (0: none)')
+    parser.add_argument('--bkg-method', default=config.BKG_METHOD, choices=utils.BKG_METHODS)
+    parser.add_argument('--n', type=int, default=1, help='moving average length')
+    parser.add_argument('--ts-len', type=int, default=500, help='length of the running average time series')
+    parser.add_argument('--max-shots', type=int, default=None)
+    parser.add_argument('--print-period', type=float, default=1., help='summary print period (s)')
+    parser.add_argument('--serve-pvs', nargs='?', const=config.PV_PREFIX, default=None, metavar='PREFIX',
+                        help='serve the results as PVs (default prefix: {})'.format(config.PV_PREFIX))
+    parser.add_argument('--record', nargs='?', const=config.RECORD_DIR, default=None, metavar='DIR',
+                        help='record the results in HDF5 files (default directory: {})'.format(config.RECORD_DIR))
+    parser.add_argument('--record-waveforms', action='store_true', help='also record the waveforms')
+    return parser
+
+
+def make_bkg_fun(bkg_idx, method=config.BKG_METHOD):
+    if bkg_idx<=0:
+        return None
+    return utils.Background(bkg_idx=bkg_idx, method=method, trim=config.BKG_TRIM, alpha=config.BKG_PEDESTAL_ALPHA)
+
+
+def make_regressor(ref_wfs, roi=None, bkg_fun=None, **kwargs):
+    """ Same preparation of the reference waveforms as RegressorWidget.make_regressor """
+    if config.BASIS_CACHE:
+        return BasisCache().get_regressor(ref_wfs, roi=roi, bkg_fun=bkg_fun, **kwargs)
+    ref_wfs = refstore.WaveformView(ref_wfs, polarity=config.POLARITY, bkg_fun=bkg_fun, roi=roi)
+    if len(ref_wfs)>config.REF_CHUNK_SIZE:
+        svd_method = 'incremental'
+    else:
+        svd_method = config.SVD_METHOD
+        ref_wfs = np.asarray(ref_wfs)
+    return proc.construct_waveformRegressor(ref_wfs, svd_method=svd_method, **kwargs)
+
+
+def regressor_from_args(args, bkg_fun=None):
+    """ Saved regressor (--regressor), delay scan regressor (--delay-scan) or regressor built from --refs """
+    if args.regressor is not None:
+        return proc.WaveformRegressor.load(args.regressor)
+    ref_wfs = refstore.load_reference_set(args.refs)[0]
+    if args.delay_scan is not None:
+        ref_wfs = refstore.WaveformView(ref_wfs, polarity=config.POLARITY, bkg_fun=bkg_fun, roi=args.roi)
+        svd_method = 'incremental' if len(ref_wfs)>config.REF_CHUNK_SIZE else config.SVD_METHOD
+        if svd_method!='incremental':
+            ref_wfs = np.asarray(ref_wfs)
+        return construct_delayScanRegressor(ref_wfs, n_components=args.n_components, svd_method=svd_method,
+                                            delay_ranges=parse_delay_scan(args.delay_scan), per=args.scan_per)
+    return make_regressor(ref_wfs, roi=args.roi, bkg_fun=bkg_fun, n_components=args.n_components,
+                          n_pulse=args.n_pulse, delay=args.delay, method=args.projector, alpha=args.alpha)
+
+
+def build_engine(args, name=None):
+    """ Engine and sinks from the command line arguments. name: channel name (see multichannel.py) """
+    bkg_fun = make_bkg_fun(args.bkg, method=args.bkg_method)
+    regressor = regressor_from_args(args, bkg_fun)
+    engine = AnalysisEngine(regressor=regressor, roi=args.roi, bkg_fun=bkg_fun, n=args.n, ts_len=args.ts_len)
+    # with several channels, the latency (shared monitor) is printed once by the multichannel engine
+    engine.add_sink(PrintSink(period=args.print_period, name=name, latency=name is None))
+    if args.serve_pvs is not None:
+        from pv_server import PVServerSink
+        engine.add_sink(PVServerSink(prefix=args.serve_pvs))
+    if args.record is not None:
+        from recorder import ResultRecorder
+        engine.add_sink(ResultRecorder(directory=args.record, store_waveforms=args.record_waveforms))
+    return engine
+
+
+def make_pv(args):
+    if args.fake is not None:
+        return FakePV(refstore.load_reference_set(args.fake)[0])
+    from epics import PV
+    return PV(args.pv)
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    engine = build_engine(args)
+    pv = make_pv(args)
+    acquisition = MonitorAcquisition(pv, maxlen=config.QUEUE_SIZE)
+    signal.signal(signal.SIGINT, lambda signum, frame: engine.stop())
+    if isinstance(pv, FakePV):
+        pv.start(rate=args.rate)
+    t0 = time.time()
+    try:
+        engine.run(acquisition, max_shots=args.max_shots)
+    finally:
+        if isinstance(pv, FakePV):
+            pv.stop()
+        engine.close()
+    print('{} shots analyzed in {:.1f} s, {} dropped by the acquisition.'.format(
+        engine.n_processed, time.time()-t0, acquisition.queue.n_dropped))
+    return engine
+
+
+if __name__=='__main__':
+    main()
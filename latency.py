@@ -0,0 +1,122 @@
+import numpy as np
+import threading
+import time
+
+import config
+
+
+"""
+Per-stage latency of the shots, from their arrival to the display.
+
+Each shot carries a dictionary of timestamps (Shot.stamps, time.perf_counter()), stamped at the end of
+each stage of the path:
+    arrival     PV value received (monitor callback, or start of the PV get in timer mode)
+    acquired    waveform read and background subtracted (GetWfWorker / process_queue)
+    fit_start   fit worker started (signal hop and wait in the fit scheduler queue)
+    fit_end     fit done
+    dispatched  fit results received in the GUI thread (trigger_display)
+    displayed   curves and stripcharts updated (display_frame)
+The time between a stamp and the previous one is recorded as the duration of the stage (named after
+the stamp), plus the end-to-end latency ('total') at the last stage. In the headless engine
+(engine.AnalysisEngine.process_shots), the path ends at fit_end, which includes the sinks. The durations of the last
+`window` shots of each stage are kept in ring buffers, from which the percentiles are computed.
+"""
+
+
+STAGES = ['arrival', 'acquired', 'fit_start', 'fit_end', 'dispatched', 'displayed']
+LABELS = {
+    'acquired': 'acquisition',
+    'fit_start': 'fit queue',
+    'fit_end': 'fit',
+    'dispatched': 'dispatch',
+    'displayed': 'display',
+    'total': 'total'
+}
+
+
+class LatencyMonitor(object):
+    """
+    Rolling statistics of the stage durations.
+    """
+    def __init__(self, window=1000, enabled=True):
+        """ Args:
+        window: number of durations kept per stage
+        enabled: if False, stamp does nothing
+        """
+        self.window = window
+        self.enabled = enabled
+        self._durations = {}
+        self._lock = threading.Lock()
+        return
+
+    def new_stamps(self, t=None):
+        """ Stamps of a new shot, arrived at time t (default: now). None if the monitor is disabled. """
+        if not self.enabled:
+            return None
+        return {'arrival': time.perf_counter() if t is None else t}
+
+    def stamp(self, stamps, stage, final=False):
+        """ Stamp the end of a stage and record its duration (time since the previous stamp).
+        Args:
+            stamps: stamps of the shot (nothing is done if None)
+            stage: name of the stage
+            final: last stage of the shot, the end-to-end latency is recorded as well
+        """
+        if stamps is None:
+            return
+        t = time.perf_counter()
+        t_prev = next(reversed(stamps.values()))
+        stamps[stage] = t
+        self.record(stage, t-t_prev)
+        if final:
+            self.record('total', t-stamps['arrival'])
+        return
+
+    def record(self, name, duration):
+        with self._lock:
+            try:
+                ring = self._durations[name]
+            except KeyError:
+                ring = self._durations[name] = [np.zeros(self.window), 0, 0] # buffer, index, count
+            ring[0][ring[1]] = duration
+            ring[1] = (ring[1]+1)%self.window
+            ring[2]+=1
+        return
+
+    def durations(self, name):
+        """ Last durations of a stage (s), not ordered """
+        with self._lock:
+            if name not in self._durations:
+                return np.zeros(0)
+            buffer, idx, count = self._durations[name]
+            return buffer[:min(count, self.window)].copy()
+
+    def histogram(self, name, bins=50):
+        """ Histogram of the last durations of a stage (see np.histogram) """
+        return np.histogram(self.durations(name)*1e3, bins=bins)
+
+    def summary(self):
+        """ p50, p99 and max (ms) of each stage, in the order of the path, and number of recorded shots """
+        summary = {}
+        for name in STAGES[1:]+['total']:
+            d = self.durations(name)
+            if d.size==0:
+                continue
+            p50, p99 = np.percentile(d, [50, 99])*1e3
+            summary[name] = {'p50': p50, 'p99': p99, 'max': d.max()*1e3, 'n': self._durations[name][2]}
+        return summary
+
+    def format_summary(self):
+        items = ['{} {:.2f}/{:.2f}/{:.2f}'.format(LABELS[name], s['p50'], s['p99'], s['max'])
+                 for name, s in self.summary().items()]
+        if not items:
+            return ''
+        return 'latency p50/p99/max (ms): '+' | '.join(items)
+
+    def reset(self):
+        with self._lock:
+            self._durations = {}
+        return
+
+
+monitor = LatencyMonitor(window=config.LATENCY_WINDOW, enabled=config.LATENCY_MONITOR) # monitor of the application
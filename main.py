@@ -3,17 +3,26 @@ import sys
 from os import path
 import time
 
+import utils
+startup = utils.StartupTimer()
+
 from PyQt5.QtWidgets import QApplication, QWidget
 from PyQt5.QtCore import QObject, pyqtSlot, pyqtSignal, QTimer, QThread, QThreadPool, QRunnable
-from PyQt5.uic import loadUiType
 from PyQt5.QtCore import QDateTime
 import pyqtgraph as pg
 import pydm
 
 import config
+import latency
+from engine import AnalysisEngine
+from ui_cache import loadUiType
 from svd_widgets import Svd_stripchart
-from workers import FitWfWorker, WorkerSignal_ndarray, WorkerSignal_dict
+from scheduling import StageScheduler
+from display import FrameTimer
+from workers import FitWfWorker, BatchFitWorker, WorkerSignal_object, WorkerSignal_dict, WorkerSignal_list
+
 
+startup.mark('imports')
 
 Ui_MainWindow, QMainWindow = loadUiType('main.ui')
 
@@ -22,74 +31,207 @@ Ui_MainWindow, QMainWindow = loadUiType('main.ui')
 #         super(svd_interface, self).__init__()
 #         self.setupUi(self)
 
-class svd_interface(pydm.Display):
+class svd_interface(pydm.Display, Ui_MainWindow):
     displaySignal = pyqtSignal(dict)
     def __init__(self, parent=None, args=None, macros=None):
         self.threadpool = QThreadPool(maxThreadCount=12) # should be before super.__init__. Why?
         print('Threadpool with {} threads.'.format(self.threadpool.maxThreadCount()))
         
         super(svd_interface, self).__init__(parent=parent, args=args, macros=macros)
+        self.setupUi(self) # cached compiled UI, instead of pydm loading main.ui at each start
+        startup.mark('UI setup')
 
         # for l in self.__dir__():
         #     if 'waveform' in l:
         #     print(l)
 
         self._ana_count = 0
+        self.fitScheduler = StageScheduler(self.threadpool, name='fit', **config.SCHEDULING['fit'])
         
         # Signals for workers (multitreading)
-        self.newDataSignal = WorkerSignal_ndarray()
+        self.newDataSignal = WorkerSignal_object() # shots.Shot instances
         self.newFitSignal = WorkerSignal_dict()
+        self.newBatchFitSignal = WorkerSignal_list()
+
+        # Fits in worker processes instead of the threadpool (see procpool.py). Results as batches.
+        self.fitBackend = None
+        if config.ANALYSIS_BACKEND=='processes':
+            from procpool import ProcessFitBackend
+            self.fitBackend = ProcessFitBackend(callback=self.newBatchFitSignal.signal.emit)
 
         # connect stuff together
         self.waveformGraph.connect_attr('newDataSignal', self.newDataSignal)
         self.regressorWidget.connect_attr('graph', self.waveformGraph)
 
-        # Setup the analysis timer
+        # Setup the acquisition: analysis timer or PV monitor
         self.timer = QTimer(interval=int(1/config.RATE*1000)) # timer in ms
         self.timer.timeout.connect(self.waveformGraph.get_data)
-        self.timer.start()
+        if config.ACQUISITION_MODE=='monitor':
+            self.waveformGraph.start_monitor()
+        else:
+            self.timer.start()
         
         # Processing
+        self._batch = []
+        self.batchTimer = QTimer(singleShot=True, interval=config.BATCH_WINDOW)
+        self.batchTimer.timeout.connect(self.fit_batch)
         self.newDataSignal.signal.connect(self.fit_data)
+        self.newFitSignal.signal.connect(self.dispatch_results) # running averages before the display
+        self.newBatchFitSignal.signal.connect(self.dispatch_results_batch)
         self.newFitSignal.signal.connect(self.trigger_display)
+        self.newBatchFitSignal.signal.connect(self.trigger_display_batch)
+        self.newFitSignal.signal.connect(self.regressorWidget.online_update)
+        self.newBatchFitSignal.signal.connect(self.regressorWidget.online_update_batch)
+
+        # Result dispatch: running averages and sinks of an analysis engine (see engine.py). The
+        # acquisition, background and fits stay in the Qt workers above.
+        self.engine = AnalysisEngine(polarity=config.POLARITY, mode=config.INTENSITY_MODE)
 
         # Stripcharts
         self.stripchartsView.make_stripcharts(2, useRemote=False)
-        self.stripcharts = Svd_stripchart(stripchartsView=self.stripchartsView)
-        self.regressorWidget.newRegressorSignal.connect(self.stripcharts.make_ravgs)
-        self.newFitSignal.signal.connect(self.stripcharts.update_ravgs)
+        self.stripcharts = Svd_stripchart(self.engine, stripchartsView=self.stripchartsView)
+        self.regressorWidget.newRegressorSignal.connect(self.set_regressor)
+        self.regressorWidget.updatedRegressorSignal.connect(self.update_regressor)
         # self.timer.timeout.connect(self.stripchartsView.update_test)
 
         # Update display
         self.displaySignal.connect(self.waveformGraph.display_data_fit)
         self.displaySignal.connect(self.stripcharts.update_stripchartsView)
+        self._latest = None # last analyzed shot, displayed at the next frame
+        if config.DISPLAY_FPS is not None:
+            self.frameTimer = FrameTimer(fps=config.DISPLAY_FPS, budget=config.DISPLAY_BUDGET)
+            self.displayTimer = QTimer(singleShot=True, interval=int(self.frameTimer.period*1000))
+            self.displayTimer.timeout.connect(self.display_frame)
+            self.displayTimer.start()
 
+        # Result sinks of the engine (PV server, recorder, see engine.Sink)
+        if config.PV_SERVER:
+            from pv_server import PVServerSink
+            self.engine.add_sink(PVServerSink())
+        if config.RECORD:
+            from recorder import ResultRecorder
+            self.engine.add_sink(ResultRecorder())
+
+        # Shot counters
+        self.countersTimer = QTimer(interval=int(config.COUNTERS_PERIOD*1000))
+        self.countersTimer.timeout.connect(self.update_counters)
+        self.countersTimer.start()
+
+        startup.mark('connections')
+        print(startup.report())
         return
 
     def ui_filename(self):
         return 'main.ui'
 
     def ui_filepath(self):
-        return path.join(path.dirname(path.realpath(__file__)), self.ui_filename())
+        """ None: the UI is set up from the cached compiled main.ui (see ui_cache), not loaded by pydm """
+        return None
     
-    @pyqtSlot(np.ndarray)
+    @pyqtSlot(object)
     def fit_data(self, data):
+        if config.BATCH_SIZE>1:
+            self.add_to_batch(data)
+            return
+        if self.fitBackend is not None:
+            self.fitBackend.submit([data], roi=self.waveformGraph.get_roi(), 
+                                   regressor=self.regressorWidget.regressor)
+            return
         self.worker = FitWfWorker(
             data=data,
             roi=self.waveformGraph.get_roi(),
             regressor=self.regressorWidget.regressor,
             signal=self.newFitSignal)
-        self.threadpool.tryStart(self.worker)
+        self.fitScheduler.submit(self.worker)
+        return
+
+    def add_to_batch(self, data):
+        """ Collect shots until BATCH_SIZE shots are available or BATCH_WINDOW has elapsed 
+        since the first shot of the batch.
+        """
+        if self._batch and self._batch[0].shape!=data.shape:
+            self.fit_batch() # waveform length changed (new PV?), cannot be stacked with the previous shots
+        self._batch.append(data)
+        if len(self._batch)>=config.BATCH_SIZE:
+            self.fit_batch()
+        elif not self.batchTimer.isActive():
+            self.batchTimer.start()
+        return
+
+    @pyqtSlot()
+    def fit_batch(self):
+        self.batchTimer.stop()
+        if not self._batch:
+            return
+        if self.fitBackend is not None:
+            self.fitBackend.submit(self._batch, roi=self.waveformGraph.get_roi(), 
+                                   regressor=self.regressorWidget.regressor)
+            self._batch = []
+            return
+        self.worker = BatchFitWorker(
+            data=self._batch,
+            roi=self.waveformGraph.get_roi(),
+            regressor=self.regressorWidget.regressor,
+            signal=self.newBatchFitSignal)
+        self.fitScheduler.submit(self.worker, n=len(self._batch))
+        self._batch = []
+        return
+
+    @pyqtSlot(list)
+    def trigger_display_batch(self, data_list):
+        """ Same as trigger_display for a batch of shots (batched fitting mode, config.BATCH_SIZE>1, 
+        and process backend): the last shot of the batch is displayed if the display count is reached 
+        within the batch. The batch consumers (stripcharts, online basis, sinks) are connected to 
+        newBatchFitSignal directly, the results are not re-emitted shot by shot.
+        """
+        if not data_list:
+            return
+        for data_dict in data_list:
+            self._stamp(data_dict, 'dispatched')
+        if config.DISPLAY_FPS is not None:
+            self._latest = data_list[-1]
+            return
+        self._ana_count+=len(data_list)
+        if self._ana_count>config.DISPLAY_RATE_RATIO:
+            self._ana_count=0
+            self.displaySignal.emit(data_list[-1])
+            self._stamp(data_list[-1], 'displayed', final=True)
+        return
+
+    @pyqtSlot()
+    def display_frame(self):
+        """ Display the last analyzed shot (if new), and redraw the curves whose view changed. The next 
+        frame is scheduled according to the time spent drawing.
+        """
+        self.frameTimer.start_frame()
+        if self._latest is not None:
+            data_dict, self._latest = self._latest, None
+            self.displaySignal.emit(data_dict)
+            self._stamp(data_dict, 'displayed', final=True)
+        else:
+            self.waveformGraph.render()
+            self.stripchartsView.render()
+        period = self.frameTimer.end_frame()
+        self.displayTimer.start(int(period*1000))
         return
 
     @pyqtSlot(dict)
     def trigger_display(self, data_dict):
+        self._stamp(data_dict, 'dispatched')
+        if config.DISPLAY_FPS is not None:
+            self._latest = data_dict
+            return
         if self._ana_count<config.DISPLAY_RATE_RATIO:
             self._ana_count+=1
         else:
             self._ana_count=0
             self.displaySignal.emit(data_dict)
+            self._stamp(data_dict, 'displayed', final=True)
 
+    def _stamp(self, data_dict, stage, final=False):
+        """ Latency stamp of the shot of data_dict (see latency.py) """
+        latency.monitor.stamp(getattr(data_dict['data'], 'stamps', None), stage, final=final)
+        return
         
     
     # def make_stripchart(self, n=0, ts_len=100, alpha=None, n_pulse=1):
@@ -97,6 +239,56 @@ class svd_interface(pydm.Display):
     #         n=n, ts_len=ts_len, alpha=alpha, n_pulse=n_pulse, stripchartsView=self.stripchartsView)
     #     return
 
+    @pyqtSlot(int)
+    def set_regressor(self, n_pulse):
+        """ New regressor: passed to the engine (sinks), new running averages """
+        self.engine.set_regressor(self.regressorWidget.regressor)
+        self.stripcharts.make_ravgs(n_pulse)
+        return
+
+    @pyqtSlot()
+    def update_regressor(self):
+        """ Online update of the basis: passed to the engine (sinks), running averages kept """
+        self.engine.set_regressor(self.regressorWidget.regressor, reset=False)
+        return
+
+    @pyqtSlot(dict)
+    def dispatch_results(self, data_dict):
+        self.dispatch_results_batch([data_dict])
+        return
+
+    @pyqtSlot(list)
+    def dispatch_results_batch(self, data_list):
+        """ Running averages and sinks of the engine, for the results of the fit workers """
+        self.engine.dispatch(data_list, self.regressorWidget.regressor,
+                             timestamps=[getattr(d['data'], 'timestamp', None) for d in data_list],
+                             pulse_ids=[getattr(d['data'], 'pulse_id', None) for d in data_list])
+        return
+
+    def closeEvent(self, event):
+        self.engine.close()
+        if self.fitBackend is not None:
+            self.fitBackend.close()
+        super().closeEvent(event)
+        return
+
+    @pyqtSlot()
+    def update_counters(self):
+        """ Display (and log) how many shots were received, analyzed and dropped by each stage """
+        acq = self.waveformGraph.get_counters()
+        fit = (self.fitScheduler if self.fitBackend is None else self.fitBackend).get_counters()
+        txt = 'acquisition: {} received, {} dropped, {} queued | fit: {} received, {} analyzed, {} dropped, {} queued'.format(
+            acq['received'], acq['dropped'], acq['depth'],
+            fit['received'], fit['analyzed'], fit['dropped'], fit['depth'])
+        self.countersLabel.setText(txt)
+        latency_txt = latency.monitor.format_summary()
+        self.latencyLabel.setText(latency_txt)
+        if config.COUNTERS_LOG:
+            print(txt)
+        if config.LATENCY_LOG and latency_txt:
+            print(latency_txt)
+        return
+
     def print_time(self):
         time = QDateTime.currentDateTime()
         print(time.toString('yyyy-MM-dd hh:mm:ss dddd'))
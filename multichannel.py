@@ -0,0 +1,242 @@
+import argparse
+import hashlib
+import json
+import numpy as np
+import shlex
+import signal
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import latency
+from acquisition import MonitorAcquisition, FakePV
+from delay_bank import DelayScanRegressor
+from engine import fit_shots, roi_bounds
+import headless
+
+
+"""
+Multi-channel headless analysis: several diagnostic PVs analyzed by one process.
+
+Each channel has its own PV, regressor, ROI, background, running averages and sinks: it is the
+engine.AnalysisEngine that headless.py would build from the same arguments. One loop collects the
+shots of all the channels; the shots of the channels sharing a basis (same basis arrays, whether the
+regressors were loaded or built from the same reference set) are fitted together in one batch, each
+with the ROI of its channel, and the batches run on one thread pool shared by all the channels.
+
+Scope: this replaces several headless.py processes by one, not the GUI. main.py still analyzes and
+displays a single channel, with its own process and thread pool: the console load of N GUIs is only
+reduced for the channels moved to multichannel.py (e.g. one GUI for the channel being looked at).
+
+The channels are given in a JSON file (default: config.CHANNELS), name: headless.py arguments:
+    {
+        "GEM_241": "--pv DIAG:FEE1:202:241:Data --roi 0 100 --bkg 50",
+        "GEM_242": "--pv DIAG:FEE1:202:242:Data --roi 10 110 --bkg 50"
+    }
+
+Usage:
+    python multichannel.py channels.json --threads 4
+"""
+
+
+def basis_key(regressor):
+    """ Key of the basis of a regressor, equal for regressors giving the same fits """
+    if regressor is None or isinstance(regressor, DelayScanRegressor):
+        return id(regressor) # the delays of a delay scan per batch depend on the batch: not shared
+    h = hashlib.blake2b(digest_size=16)
+    for a in [regressor.A, regressor.projector, regressor.pulse_idx, regressor.pulse_ops]:
+        h.update(str(a.shape).encode())
+        h.update(np.ascontiguousarray(a).data)
+    h.update(str(regressor.n_pulse_).encode())
+    return h.hexdigest()
+
+
+class MultiChannelEngine(object):
+    """
+    Analysis of several channels (AnalysisEngine instances), with the fits batched across the channels
+    sharing a basis on a shared thread pool.
+    """
+    def __init__(self, channels, threads=config.MULTICHANNEL_THREADS, print_period=1.):
+        """ Args:
+        channels: dictionary name: AnalysisEngine (regressor, roi, background, running averages and sinks of the channel)
+        threads: number of threads of the fit pool
+        print_period: latency summary print period (s), None: no print
+        """
+        self.channels = OrderedDict(channels)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.print_period = print_period
+        self._keys = weakref.WeakKeyDictionary() # regressor: basis key, dropped with the regressor
+        self._t_print = time.time()
+        self._stop = threading.Event()
+        return
+
+    @property
+    def n_processed(self):
+        return sum(engine.n_processed for engine in self.channels.values())
+
+    def _basis_key(self, regressor):
+        if regressor is None:
+            return basis_key(regressor)
+        try:
+            return self._keys[regressor]
+        except KeyError:
+            key = self._keys[regressor] = basis_key(regressor)
+            return key
+
+    def groups(self):
+        """ Names of the channels, grouped by shared basis """
+        groups = OrderedDict()
+        for name, engine in self.channels.items():
+            groups.setdefault(self._basis_key(engine.regressor), []).append(name)
+        return list(groups.values())
+
+    def process_shots(self, shot_lists):
+        """ Analyze the shots of the channels.
+        Args:
+            shot_lists: dictionary name: list of shots from the acquisition of the channel (see
+                AnalysisEngine.process_shots)
+        """
+        batches = OrderedDict() # (basis, roi width, polarity, mode): [(name, index), ...], shots, rois
+        regressors, n_shots, stamps = {}, {}, []
+        for name, shot_list in shot_lists.items():
+            if not shot_list:
+                continue
+            engine = self.channels[name]
+            regressor = regressors[name] = engine.regressor # same regressor for the whole round
+            n_shots[name] = len(shot_list)
+            if len(set(s['value'].size for s in shot_list))==1:
+                data = engine.prepare([s['value'] for s in shot_list])
+            else:
+                data = [engine.prepare([s['value']])[0] for s in shot_list]
+            for ii, (s, d) in enumerate(zip(shot_list, data)):
+                lo, hi = roi_bounds(d[1].size, engine.roi)
+                key = (self._basis_key(regressor), hi-lo, engine.polarity, engine.mode)
+                batch = batches.setdefault(key, ([], [], [], regressor))
+                batch[0].append((name, ii))
+                batch[1].append(d)
+                batch[2].append((lo, hi))
+                if 't_arrival' in s:
+                    stamps.append(latency.monitor.new_stamps(s['t_arrival']))
+                    latency.monitor.stamp(stamps[-1], 'fit_start')
+
+        futures = [(index, self.executor.submit(fit_shots, data, roi=rois, regressor=regressor,
+                                                polarity=key[2], mode=key[3]))
+                   for key, (index, data, rois, regressor) in batches.items()]
+        results = {name: [None]*n for name, n in n_shots.items()}
+        for index, future in futures:
+            for (name, ii), result in zip(index, future.result()):
+                results[name][ii] = result
+
+        for name, result_list in results.items():
+            shot_list = shot_lists[name]
+            self.channels[name].dispatch(result_list, regressors[name], timestamps=[s['timestamp'] for s in shot_list],
+                                         pulse_ids=[s['pulse_id'] for s in shot_list])
+        for st in stamps:
+            latency.monitor.stamp(st, 'fit_end', final=True)
+        return
+
+    def run(self, acquisitions, max_shots=None, timeout=1.):
+        """ Process the shots of the acquisitions (dictionary name: MonitorAcquisition) until stop is
+        called (or max_shots are processed, all channels together).
+        """
+        new_shot = threading.Event()
+        for acquisition in acquisitions.values():
+            acquisition.notify = new_shot.set
+            acquisition.start()
+        self._stop.clear()
+        try:
+            while not self._stop.is_set():
+                new_shot.wait(timeout)
+                new_shot.clear()
+                self.process_shots({name: acquisition.queue.get_all() for name, acquisition in acquisitions.items()})
+                self.print_latency()
+                if max_shots is not None and self.n_processed>=max_shots:
+                    break
+        finally:
+            for acquisition in acquisitions.values():
+                acquisition.stop()
+        return
+
+    def print_latency(self):
+        if self.print_period is None or time.time()-self._t_print<self.print_period:
+            return
+        self._t_print = time.time()
+        latency_txt = latency.monitor.format_summary()
+        if latency_txt:
+            print(latency_txt)
+        return
+
+    def stop(self):
+        self._stop.set()
+        return
+
+    def close(self):
+        self.stop()
+        for engine in self.channels.values():
+            engine.close()
+        self.executor.shutdown()
+        return
+
+
+def load_channels(fname=None):
+    """ Channel specifications {name: list of headless.py arguments} from a JSON file (default: config.CHANNELS) """
+    if fname is None:
+        channels = config.CHANNELS
+    else:
+        with open(fname) as f:
+            channels = json.load(f, object_pairs_hook=OrderedDict)
+    return OrderedDict((name, shlex.split(argv) if isinstance(argv, str) else list(argv))
+                       for name, argv in channels.items())
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Multi-channel headless SVD waveform analysis.')
+    parser.add_argument('channels', nargs='?', default=None,
+                        help='JSON file of the channels, name: headless.py arguments (default: config.CHANNELS)')
+    parser.add_argument('--threads', type=int, default=config.MULTICHANNEL_THREADS, help='size of the shared fit pool')
+    parser.add_argument('--max-shots', type=int, default=None, help='total number of shots (all channels)')
+    parser.add_argument('--print-period', type=float, default=1., help='latency summary print period (s)')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    specs = load_channels(args.channels)
+    if not specs:
+        raise ValueError('No channel: give a JSON file of channels or set config.CHANNELS')
+    channel_parser = headless.make_parser()
+    engines, pvs, rates = OrderedDict(), OrderedDict(), {}
+    for name, channel_argv in specs.items():
+        channel_args = channel_parser.parse_args(channel_argv)
+        print('Channel {}:'.format(name))
+        engines[name] = headless.build_engine(channel_args, name=name)
+        pvs[name] = headless.make_pv(channel_args)
+        rates[name] = channel_args.rate
+    engine = MultiChannelEngine(engines, threads=args.threads, print_period=args.print_period)
+    print('{} channels, {} fit groups: {}'.format(len(engines), len(engine.groups()), engine.groups()))
+
+    acquisitions = OrderedDict((name, MonitorAcquisition(pv, maxlen=config.QUEUE_SIZE)) for name, pv in pvs.items())
+    signal.signal(signal.SIGINT, lambda signum, frame: engine.stop())
+    for name, pv in pvs.items():
+        if isinstance(pv, FakePV):
+            pv.start(rate=rates[name])
+    t0 = time.time()
+    try:
+        engine.run(acquisitions, max_shots=args.max_shots)
+    finally:
+        for pv in pvs.values():
+            if isinstance(pv, FakePV):
+                pv.stop()
+        engine.close()
+    elapsed = time.time()-t0
+    for name, channel in engine.channels.items():
+        print('{}: {} shots analyzed in {:.1f} s, {} dropped by the acquisition.'.format(
+            name, channel.n_processed, elapsed, acquisitions[name].queue.n_dropped))
+    return engine
+
+
+if __name__=='__main__':
+    main()
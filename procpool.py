@@ -0,0 +1,336 @@
+import multiprocessing
+import numpy as np
+import queue
+import sys
+import threading
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+
+import config
+import latency
+import shots
+from engine import INTENSITY_MODES, make_data_list
+
+
+"""
+Process-based fit backend: the fits run in worker processes instead of the threads of the QThreadPool,
+so that the Python code of the analysis does not serialize on the GIL.
+
+Each worker holds a copy of the regressor. The driver (ProcessFitBackend, in the GUI process) copies
+the ROI of the waveforms of a task in a slot of shared memory, the worker fits them in place and writes
+the fits in the second half of the slot, and sends back the small arrays (scores, intensities,
+coefficients, delays) through a queue. A collector thread turns the results into the data_dict of
+engine.fit_shots and passes them to the callback in the order of submission.
+
+Regressor hot-swap: a new regressor is sent to all the workers with a version number, and each task
+carries the version of the regressor it must be fitted with; a worker picks up the new regressor
+before its first task of the new version, so that no shot is fitted with a stale regressor.
+
+Backpressure: the number of tasks in flight is limited by the number of slots; when all the slots are
+in use, the new task is dropped and counted (same counters as scheduling.StageScheduler).
+
+Failures: each worker has its own task queue. The tasks of a worker that dies are failed (their shots
+are returned without fit) and the worker is restarted with the current regressor, so that the slots
+are freed and the later results are released.
+"""
+
+
+""" Worker processes """
+def _attach(name):
+    """ Attach to a segment of the driver without registering it with the resource tracker: the driver
+    owns (and unlinks) the segments, a registration by the worker would make the tracker report them as
+    leaked, or unregister them for the driver too (the tracker is shared with spawned processes).
+    """
+    if sys.version_info>=(3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None # the worker is single threaded
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _worker_main(wid, tasks, results, control):
+    regressor, version = None, -1
+    segments = {} # slot index: SharedMemory
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, slot, name, n, width, task_version, polarity, mode = task
+        try:
+            while version<task_version:
+                version, regressor = control.get()
+            if slot not in segments or segments[slot].name!=name:
+                if slot in segments:
+                    segments[slot].close()
+                segments[slot] = _attach(name)
+            data = np.ndarray((2, n, width), dtype=np.float64, buffer=segments[slot].buf)
+            X, out = data[0], data[1]
+            fits, scores, intensities, details = regressor.analyze(X, mode=mode, full_output=True)
+            record = {'score': scores.copy(), 'intensity': intensities.copy(), 'fit': fits is not None}
+            if fits is not None:
+                np.multiply(fits, polarity, out=out)
+                record['coeffs'] = details['coeffs'].copy()
+                if 'delays' in details: # delay scan regressor
+                    record['delays'] = details['delays'].copy()
+            results.put((wid, seq, 'done', record))
+        except Exception:
+            results.put((wid, seq, 'error', traceback.format_exc()))
+    for shm in segments.values():
+        shm.close()
+    return
+
+
+""" Driver """
+class ProcessFitBackend(object):
+    """
+    Fit of batches of shots in a pool of worker processes, results returned in the order of submission.
+    """
+    def __init__(self, callback, processes=config.ANALYSIS_PROCESSES, slots=None,
+                 start_method=config.ANALYSIS_START_METHOD):
+        """ Args:
+        callback: called with the list of data_dict of each task (see engine.fit_shots), in the order
+            of submission, from the collector thread (e.g. the emit of a WorkerSignal_list)
+        processes: number of worker processes (default: number of CPUs)
+        slots: maximum number of tasks in flight (default: 2 per process)
+        start_method: multiprocessing start method ('spawn' is safe with Qt threads running)
+        """
+        self.callback = callback
+        self.processes = processes or multiprocessing.cpu_count()
+        self.n_slots = slots or 2*self.processes
+        self._ctx = multiprocessing.get_context(start_method)
+
+        self._segments = [None]*self.n_slots
+        self._free = list(range(self.n_slots))
+        self._pending = {} # seq: (data, xfit, slot)
+        self._assigned = {} # worker id: set of the seq of the tasks sent to the worker
+        self._done = {} # seq: data_list, waiting for the previous tasks
+        self._seq = 0
+        self._next = 0
+        self._regressor = None
+        self._version = -1
+        self._closing = False
+        self._lock = threading.Lock()
+        self._release_lock = threading.Lock()
+        self.reset_counters()
+
+        self._results = self._ctx.Queue()
+        self._workers = {} # worker id: process
+        self._tasks = {} # worker id: task queue (one per worker: a dead worker cannot block the others)
+        self._controls = {} # worker id: control queue
+        self._n_started = 0
+        for ii in range(self.processes):
+            self._start_worker()
+
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+        print('Process fit backend with {} processes.'.format(self.processes))
+        return
+
+    def _start_worker(self):
+        """ Start a worker process, with the current regressor """
+        wid = self._n_started
+        self._n_started+=1
+        tasks = self._tasks[wid] = self._ctx.Queue()
+        control = self._controls[wid] = self._ctx.Queue()
+        if self._regressor is not None:
+            control.put((self._version, self._regressor))
+        self._assigned[wid] = set()
+        w = self._workers[wid] = self._ctx.Process(target=_worker_main, args=(wid, tasks, self._results, control),
+                                                   daemon=True)
+        w.start()
+        return
+
+    def reset_counters(self):
+        with self._lock:
+            self.n_received = 0
+            self.n_analyzed = 0
+            self.n_dropped = 0
+        return
+
+    def set_regressor(self, regressor):
+        """ Send a new regressor to the workers. The tasks submitted from now on are fitted with it. """
+        with self._lock:
+            self._version+=1
+            self._regressor = regressor
+            if regressor is not None:
+                for control in self._controls.values():
+                    control.put((self._version, regressor))
+        return
+
+    def _get_segment(self, slot, nbytes):
+        shm = self._segments[slot]
+        if shm is None or shm.size<nbytes:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = self._segments[slot] = shared_memory.SharedMemory(create=True, size=nbytes)
+        return shm
+
+    def submit(self, data, roi=None, regressor=None, polarity=config.POLARITY, mode=config.INTENSITY_MODE):
+        """ Schedule the fit of a list of shots (same length).
+        Args:
+            data, roi, regressor, polarity: see engine.fit_shots
+            mode: intensity mode, 'norm' or 'max'
+        Returns:
+            True if the task was sent, False if it was dropped (all slots in use).
+        """
+        if mode not in INTENSITY_MODES:
+            raise ValueError('Intensity mode {} not supported by the process backend'.format(mode))
+        if regressor is not self._regressor:
+            self.set_regressor(regressor)
+        n = len(data)
+        n_samples = data[0][1].size
+        if roi is not None:
+            lo, hi, _ = slice(roi[0], roi[1]).indices(n_samples)
+        else:
+            lo, hi = 0, n_samples
+        xfit = shots.get_x(n_samples)[lo:hi]
+        with self._lock:
+            self.n_received+=n
+            if regressor is None:
+                seq = self._seq
+                self._seq+=1
+                self._done[seq] = [{'score': 0, 'intensity': 0, 'fit': None, 'data': d} for d in data]
+                self.n_analyzed+=n
+            elif not self._free:
+                self.n_dropped+=n
+                return False
+            else:
+                seq = self._seq
+                self._seq+=1
+                slot = self._free.pop()
+                version = self._version
+                self._pending[seq] = (data, xfit, slot)
+                wid = min(self._assigned, key=lambda w: len(self._assigned[w])) # least busy worker
+                self._assigned[wid].add(seq)
+                tasks = self._tasks[wid]
+        if regressor is None:
+            self._release()
+            return True
+
+        shm = self._get_segment(slot, 2*n*xfit.size*8)
+        X = np.ndarray((n, xfit.size), dtype=np.float64, buffer=shm.buf)
+        for ii, d in enumerate(data):
+            np.multiply(d[1][lo:hi], polarity, out=X[ii])
+            latency.monitor.stamp(getattr(d, 'stamps', None), 'fit_start')
+        tasks.put((seq, slot, shm.name, n, xfit.size, version, polarity, mode))
+        return True
+
+    def _collect(self, poll_period=1.):
+        """ Collector thread: results of the workers to data_dict lists. Checks the workers every
+        poll_period (s) when no result arrives.
+        """
+        while True:
+            try:
+                item = self._results.get(timeout=poll_period)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            try:
+                if item:
+                    self._handle(*item)
+                self._check_workers()
+            except Exception:
+                print('Process fit backend error:\n{}'.format(traceback.format_exc()))
+        return
+
+    def _handle(self, wid, seq, kind, payload):
+        """ Result of a worker: 'done' (payload: record) or 'error' (payload: traceback) """
+        with self._lock:
+            self._assigned.get(wid, set()).discard(seq)
+        if kind=='error':
+            self._finish(seq, error=payload)
+        else:
+            self._finish(seq, record=payload)
+        return
+
+    def _check_workers(self):
+        """ Fail the tasks of a dead worker and restart it, so that their slots are freed and the results
+        after them are released.
+        """
+        for wid, w in list(self._workers.items()):
+            if w.is_alive() or self._closing:
+                continue
+            with self._lock:
+                del self._workers[wid], self._tasks[wid], self._controls[wid]
+                lost = self._assigned.pop(wid)
+                self._start_worker()
+            print('Process fit worker {} died (exit code {}), restarted.'.format(wid, w.exitcode))
+            for seq in sorted(lost):
+                self._finish(seq, error='worker {} died (exit code {})'.format(wid, w.exitcode))
+        return
+
+    def _finish(self, seq, record=None, error=None):
+        """ data_dict list of the finished task seq, free its slot and pass the results to the callback """
+        with self._lock:
+            try:
+                data, xfit, slot = self._pending.pop(seq)
+            except KeyError: # already failed
+                return
+        data_list = None
+        if error is None:
+            try:
+                fits = None
+                if record['fit']:
+                    out = np.ndarray((2, len(data), xfit.size), dtype=np.float64, buffer=self._segments[slot].buf)[1]
+                    fits = out.copy()
+                data_list = make_data_list(data, record['score'], record['intensity'], fits=fits, xfit=xfit,
+                                           coeffs=record.get('coeffs'), delays=record.get('delays'))
+            except Exception:
+                error = traceback.format_exc()
+        if error is not None:
+            print('Process fit failed:\n{}'.format(error))
+            data_list = [{'score': 0, 'intensity': 0, 'fit': None, 'data': d} for d in data]
+        for d in data:
+            latency.monitor.stamp(getattr(d, 'stamps', None), 'fit_end')
+        with self._lock:
+            self._free.append(slot)
+            self._done[seq] = data_list
+            self.n_analyzed+=len(data)
+        self._release()
+        return
+
+    def _release(self):
+        """ Pass the finished tasks to the callback, in order """
+        with self._release_lock:
+            while True:
+                with self._lock:
+                    data_list = self._done.pop(self._next, None)
+                    if data_list is None:
+                        break
+                    self._next+=1
+                self.callback(data_list)
+        return
+
+    def get_counters(self):
+        with self._lock:
+            in_flight = len(self._pending)
+            return {
+                'received': self.n_received,
+                'analyzed': self.n_analyzed,
+                'dropped': self.n_dropped,
+                'depth': max(in_flight-self.processes, 0),
+                'running': min(in_flight, self.processes)
+            }
+
+    def close(self, timeout=2.):
+        """ Stop the workers and the collector, and free the shared memory """
+        self._closing = True
+        for tasks in self._tasks.values():
+            tasks.put(None)
+        for w in self._workers.values():
+            w.join(timeout)
+            if w.is_alive():
+                w.terminate()
+        self._results.put(None)
+        self._collector.join(timeout)
+        for shm in self._segments:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self._segments = [None]*self.n_slots
+        return
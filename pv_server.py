@@ -0,0 +1,146 @@
+import asyncio
+import numpy as np
+import threading
+import time
+
+import config
+from engine import Sink
+
+
+"""
+Publish the fit results as EPICS PVs from an embedded Channel Access server (caproto).
+
+The analysis thread only appends the results to a pending list. The server runs its own asyncio loop
+in a background thread and publishes the pending results at most max_rate times per second:
+    {prefix}SCORE, {prefix}SCORE_AVG: last score and running average
+    {prefix}INTENSITY{i}, {prefix}INTENSITY{i}_AVG: last intensity and running average of pulse i
+    {prefix}SCORE_BUF, {prefix}INTENSITY{i}_BUF, {prefix}PULSEID_BUF: all the shots since the last
+        update, so that the full rate data are available at the reduced update rate
+    {prefix}NPULSE: number of pulses of the regressor
+    {prefix}RATE: analysis rate (Hz)
+"""
+
+
+class PVServerSink(Sink):
+    """
+    Engine sink serving the results as PVs. Requires caproto.
+    """
+    def __init__(self, prefix=config.PV_PREFIX, max_rate=config.PV_MAX_RATE, buffer_len=1000,
+                 max_pulse=config.PV_MAX_PULSE, interfaces=None):
+        """ Args:
+        prefix: prefix of the PV names
+        max_rate: maximum update rate of the PVs (Hz)
+        buffer_len: maximum length of the *_BUF PVs
+        max_pulse: number of INTENSITY{i} PVs
+        interfaces: network interfaces of the server (default: caproto default)
+        """
+        from caproto import ChannelDouble, ChannelInteger # optional dependency
+
+        self.prefix = prefix
+        self.max_rate = max_rate
+        self.buffer_len = buffer_len
+        self.max_pulse = max_pulse
+        self.interfaces = interfaces
+
+        pvs = {
+            'SCORE': ChannelDouble(value=0., precision=4),
+            'SCORE_AVG': ChannelDouble(value=0., precision=4),
+            'SCORE_BUF': ChannelDouble(value=[0.], max_length=buffer_len, precision=4),
+            'PULSEID_BUF': ChannelInteger(value=[0], max_length=buffer_len),
+            'NPULSE': ChannelInteger(value=0),
+            'RATE': ChannelDouble(value=0., precision=1, units='Hz')
+        }
+        for ii in range(max_pulse):
+            pvs['INTENSITY{}'.format(ii)] = ChannelDouble(value=0., precision=1)
+            pvs['INTENSITY{}_AVG'.format(ii)] = ChannelDouble(value=0., precision=1)
+            pvs['INTENSITY{}_BUF'.format(ii)] = ChannelDouble(value=[0.], max_length=buffer_len, precision=1)
+        self.pvs = pvs
+        self.pvdb = {prefix+name: pv for name, pv in pvs.items()}
+
+        self._lock = threading.Lock()
+        self._pending = []
+        self._ravgs = None
+        self._n_pulse = None
+        self._loop = None
+        self._stop = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        print('PV server started: {} PVs with prefix {}.'.format(len(self.pvdb), prefix))
+        return
+
+    def on_regressor(self, regressor):
+        with self._lock:
+            self._n_pulse = regressor.n_pulse_
+        return
+
+    def on_results(self, results, ravgs):
+        with self._lock:
+            self._pending.extend(results)
+            self._ravgs = ravgs
+        return
+
+    def close(self):
+        if self._loop is not None and self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join(timeout=2)
+        return
+
+    def _run(self):
+        from caproto.asyncio.server import Context
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._stop = asyncio.Event()
+        ctx = Context(self.pvdb, interfaces=self.interfaces)
+        server = self._loop.create_task(ctx.run(log_pv_names=False))
+        try:
+            self._loop.run_until_complete(self._publisher())
+        finally:
+            server.cancel()
+            try:
+                self._loop.run_until_complete(server)
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._loop.close()
+        return
+
+    async def _publisher(self):
+        period = 1/self.max_rate
+        t_last = time.time()
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=period)
+            except asyncio.TimeoutError:
+                pass
+            with self._lock:
+                results, self._pending = self._pending, []
+                ravgs = self._ravgs
+                n_pulse, self._n_pulse = self._n_pulse, None
+            t = time.time()
+            if n_pulse is not None:
+                await self.pvs['NPULSE'].write(n_pulse)
+            await self.pvs['RATE'].write(len(results)/(t-t_last))
+            t_last = t
+            results = [r for r in results if r['fit'] is not None]
+            if results: # the number of pulses may have changed within the results
+                results = [r for r in results if np.size(r['intensity'])==np.size(results[-1]['intensity'])]
+            if results:
+                await self._publish(results[-self.buffer_len:], ravgs)
+        return
+
+    async def _publish(self, results, ravgs):
+        timestamp = results[-1].get('timestamp') or time.time()
+        scores = np.asarray([np.ravel(r['score'])[0] for r in results], dtype=float)
+        intensities = np.asarray([r['intensity'] for r in results], dtype=float)
+        pulse_ids = np.asarray([r.get('pulse_id') or 0 for r in results], dtype=int)
+        await self.pvs['SCORE'].write(scores[-1], timestamp=timestamp)
+        await self.pvs['SCORE_BUF'].write(scores, timestamp=timestamp)
+        await self.pvs['PULSEID_BUF'].write(pulse_ids, timestamp=timestamp)
+        if ravgs:
+            await self.pvs['SCORE_AVG'].write(np.asarray(ravgs['score'].ravg).item(), timestamp=timestamp)
+        for ii in range(min(intensities.shape[1], self.max_pulse)):
+            await self.pvs['INTENSITY{}'.format(ii)].write(intensities[-1,ii], timestamp=timestamp)
+            await self.pvs['INTENSITY{}_BUF'.format(ii)].write(intensities[:,ii], timestamp=timestamp)
+            if ravgs and ii<len(ravgs['intensity']):
+                await self.pvs['INTENSITY{}_AVG'.format(ii)].write(
+                    np.asarray(ravgs['intensity'][ii].ravg).item(), timestamp=timestamp)
+        return
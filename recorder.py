@@ -0,0 +1,242 @@
+import numpy as np
+import os
+import queue
+import threading
+import time
+import traceback
+from datetime import datetime
+
+import config
+from engine import Sink
+
+
+"""
+Shot level recording of the fit results in HDF5 files (requires h5py).
+
+The analysis thread only extracts the columns of each batch of results and puts them in a queue, a
+background thread appends them to resizable datasets. If the writer cannot keep up and the queue is
+full, the batch is dropped (and counted) rather than blocking the analysis.
+
+Datasets (one row per shot): timestamp, pulse_id, score, intensity (n_shots, n_pulse),
+coeffs (n_shots, n_coeffs), delay (n_shots, n_pulse, delay scan regressor only), basis_version
+(number of online updates of the basis when the shot was dispatched, see OnlineBasis) and optionally
+waveform (n_shots, n_samples, compressed).
+A new file is started when a file holds max_shots shots, when the regressor changes (not for an
+online update of its basis), or when the
+shape of a column changes (e.g. results of fits still in flight with the previous regressor, arriving
+after the new one was set).
+"""
+
+
+def _get_meta(result, key):
+    """ Shot metadata: in the result (engine) or in the Shot (GUI workers) """
+    value = result.get(key)
+    if value is None:
+        value = getattr(result['data'], key, None)
+    return value
+
+
+def _shapes(columns):
+    """ Columns and their shapes (without the shots axis) and dtypes """
+    return tuple(sorted((key, data.shape[1:], data.dtype.str) for key, data in columns.items()))
+
+
+class ResultRecorder(Sink):
+    """
+    Engine sink recording the results in HDF5 files.
+    """
+    def __init__(self, directory=config.RECORD_DIR, prefix='svd', max_shots=config.RECORD_MAX_SHOTS,
+                 store_waveforms=config.RECORD_WAVEFORMS, compression='gzip', flush_period=1., queue_size=1000):
+        """ Args:
+        directory: directory of the files
+        prefix: prefix of the file names
+        max_shots: maximum number of shots per file (file rotation)
+        store_waveforms: also record the (background subtracted) waveforms
+        compression: compression of the waveform dataset
+        flush_period: maximum time (s) the data are buffered before being written
+        queue_size: maximum number of batches waiting to be written
+        """
+        import h5py # optional dependency
+        self._h5py = h5py
+        self.directory = directory
+        self.prefix = prefix
+        self.max_shots = max_shots
+        self.store_waveforms = store_waveforms
+        self.compression = compression
+        self.flush_period = flush_period
+        os.makedirs(directory, exist_ok=True)
+
+        self.n_recorded = 0
+        self.n_dropped = 0
+        self.files = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._file_shapes = None
+        self._n_file = 0
+        self._attrs = {}
+        self._basis_version = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return
+
+    def on_regressor(self, regressor):
+        self._basis_version = getattr(regressor, 'version_', 0)
+        if self._basis_version>0:
+            return # online update of the basis: same file, see the basis_version column
+        attrs = {'n_pulse': regressor.n_pulse_, 'n_coeffs': regressor.A.shape[0], 'n_samples': regressor.A.shape[1]}
+        params = getattr(regressor, 'params_', {})
+        for key in ['n_components', 'delay']:
+            if params.get(key) is not None:
+                attrs[key] = params[key]
+        self._put(('regressor', attrs))
+        return
+
+    def on_results(self, results, ravgs):
+        results = [r for r in results if r['fit'] is not None]
+        # the rows of a batch are stacked: one batch per run of consecutive shots of the same shapes
+        # (waveform length changed on the PV, fits in flight with another number of pulses)
+        ii = 0
+        while ii<len(results):
+            shapes = self._row_shapes(results[ii])
+            jj = ii+1
+            while jj<len(results) and self._row_shapes(results[jj])==shapes:
+                jj+=1
+            self._put(('results', self._columns(results[ii:jj])))
+            ii = jj
+        return
+
+    def _row_shapes(self, result):
+        shapes = tuple(np.shape(result.get(key)) for key in ['intensity', 'coeffs', 'delay'])
+        if self.store_waveforms:
+            shapes+=(np.shape(result['data'][1]),)
+        return shapes
+
+    def _columns(self, results):
+        """ Columns of a batch of results of the same shapes """
+        timestamps = [_get_meta(r, 'timestamp') for r in results]
+        pulse_ids = [_get_meta(r, 'pulse_id') for r in results]
+        columns = {
+            'timestamp': np.asarray([np.nan if t is None else t for t in timestamps], dtype=float),
+            'pulse_id': np.asarray([-1 if p is None else p for p in pulse_ids], dtype=np.int64),
+            'score': np.asarray([np.ravel(r['score'])[0] for r in results], dtype=float),
+            'intensity': np.asarray([r['intensity'] for r in results], dtype=float),
+            'basis_version': np.full(len(results), self._basis_version, dtype=np.int64)
+        }
+        for key in ['coeffs', 'delay']:
+            if key in results[0]:
+                columns[key] = np.asarray([r[key] for r in results], dtype=float)
+        if self.store_waveforms:
+            columns['waveform'] = np.asarray([r['data'][1] for r in results])
+        return columns
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if item[0]=='results':
+                self.n_dropped+=item[1]['score'].size
+        return
+
+    def close(self, timeout=10.):
+        try:
+            self._queue.put(('close', None), timeout=timeout)
+        except queue.Full:
+            print('Recorder queue full, the last results are not written.')
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print('Recorder writer thread did not stop within {} s.'.format(timeout))
+        print('{} shots recorded in {} file(s), {} dropped.'.format(self.n_recorded, len(self.files), self.n_dropped))
+        return
+
+    """ Writer thread """
+    def _run(self):
+        pending = []
+        t_flush = time.time()
+        while True:
+            try:
+                kind, item = self._queue.get(timeout=self.flush_period)
+            except queue.Empty:
+                kind, item = None, None
+            if kind=='results':
+                pending.append(item)
+            if pending and (kind in ['regressor', 'close'] or time.time()-t_flush>=self.flush_period):
+                self._write(pending)
+                pending = []
+                t_flush = time.time()
+            try:
+                if kind=='regressor':
+                    self._attrs = item
+                    self._close_file() # new regressor: new file
+                elif kind=='close':
+                    self._close_file()
+            except Exception:
+                print('Recorder error:\n{}'.format(traceback.format_exc()))
+            if kind=='close':
+                return
+
+    def _write(self, batches):
+        """ Write the batches, grouped by consecutive batches of the same column shapes. An error is
+        logged and only drops the shots of its group, the writer thread keeps running.
+        """
+        groups = []
+        for batch in batches:
+            shapes = _shapes(batch)
+            if groups and groups[-1][0]==shapes:
+                groups[-1][1].append(batch)
+            else:
+                groups.append((shapes, [batch]))
+        for shapes, group in groups:
+            try:
+                self._write_columns({key: np.concatenate([b[key] for b in group]) for key in group[0]}, shapes)
+            except Exception:
+                n = sum(b['score'].size for b in group)
+                self.n_dropped+=n
+                print('Recorder error, {} shots dropped:\n{}'.format(n, traceback.format_exc()))
+                self._close_file()
+        return
+
+    def _write_columns(self, columns, shapes):
+        if self._file is not None and self._file_shapes!=shapes:
+            self._close_file() # the shape of a column changed: new file
+        n = columns['score'].size
+        ii = 0
+        while ii<n:
+            if self._file is None:
+                self._open_file(columns)
+                self._file_shapes = shapes
+            n_write = min(n-ii, self.max_shots-self._n_file)
+            for key, data in columns.items():
+                dset = self._file[key]
+                dset.resize(self._n_file+n_write, axis=0)
+                dset[self._n_file:self._n_file+n_write] = data[ii:ii+n_write]
+            self._n_file+=n_write
+            self.n_recorded+=n_write
+            ii+=n_write
+            self._file.flush()
+            if self._n_file>=self.max_shots:
+                self._close_file()
+        return
+
+    def _open_file(self, columns):
+        fname = os.path.join(self.directory, '{}_{}.h5'.format(
+            self.prefix, datetime.now().strftime('%Y-%m-%dT%H_%M_%S_%f')))
+        self._file = self._h5py.File(fname, 'w')
+        for key, value in self._attrs.items():
+            self._file.attrs[key] = value
+        for key, data in columns.items():
+            kwargs = {'compression': self.compression} if key=='waveform' else {}
+            self._file.create_dataset(key, shape=(0,)+data.shape[1:], maxshape=(None,)+data.shape[1:],
+                                      dtype=data.dtype, chunks=(min(1024, self.max_shots),)+data.shape[1:], **kwargs)
+        self._n_file = 0
+        self.files.append(fname)
+        return
+
+    def _close_file(self):
+        if self._file is not None:
+            file, self._file = self._file, None
+            self._file_shapes = None
+            try:
+                file.close()
+            except Exception:
+                print('Recorder error while closing {}:\n{}'.format(file.filename, traceback.format_exc()))
+        return
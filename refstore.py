@@ -0,0 +1,149 @@
+import json
+import numpy as np
+import os
+from datetime import datetime
+
+
+"""
+Storage of reference waveform sets.
+
+The waveforms are written in a preallocated .npy file through a memory map, and flushed to disk every
+few shots together with a .json metadata file (PV, ROI, background, polarity, time, number of valid
+waveforms). A collection interrupted by a crash can thus be reloaded up to the last flush.
+The sets are read back as memory maps: nothing is loaded in memory until the waveforms are accessed,
+and WaveformView applies the polarity, background subtraction and ROI chunk by chunk (see
+svd_waveform_processing.svd_incremental).
+"""
+
+
+def metadata_filename(fname):
+    return os.path.splitext(fname)[0]+'.json'
+
+
+class ReferenceWriter(object):
+    """
+    Chunked writer of a reference waveform set.
+    """
+    def __init__(self, fname, n_samples, capacity=1000, dtype=np.float64, flush_every=50, **metadata):
+        """ Args:
+        fname: .npy file name
+        n_samples: length of the waveforms
+        capacity: initial number of waveforms (the file is grown if needed)
+        dtype: data type of the waveforms
+        flush_every: number of waveforms between flushes to disk
+        metadata: saved in the .json file (pv, roi, bkg_idx, polarity, ...)
+        """
+        self.fname = fname
+        self.flush_every = flush_every
+        self.metadata = dict(metadata)
+        self.metadata['start_time'] = datetime.now().isoformat()
+        self.n = 0
+        self._data = np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=(capacity, n_samples))
+        self.flush()
+        return
+
+    def __len__(self):
+        return self.n
+
+    def append(self, waveforms):
+        """ Append one waveform or a 2D array of waveforms """
+        waveforms = np.atleast_2d(waveforms)
+        n_new = waveforms.shape[0]
+        if self.n+n_new>self._data.shape[0]:
+            self._grow(max(2*self._data.shape[0], self.n+n_new))
+        self._data[self.n:self.n+n_new] = waveforms
+        n_old = self.n
+        self.n+=n_new
+        if self.n//self.flush_every>n_old//self.flush_every:
+            self.flush()
+        return
+
+    def _grow(self, capacity):
+        self._data.flush()
+        old = self._data
+        tmp = self.fname+'.tmp'
+        self._data = np.lib.format.open_memmap(tmp, mode='w+', dtype=old.dtype, shape=(capacity, old.shape[1]))
+        self._data[:self.n] = old[:self.n]
+        del old
+        self._data.flush()
+        os.replace(tmp, self.fname)
+        self._data = np.load(self.fname, mmap_mode='r+')
+        return
+
+    def flush(self):
+        self._data.flush()
+        self.metadata['n_waveforms'] = self.n
+        self.metadata['last_update'] = datetime.now().isoformat()
+        with open(metadata_filename(self.fname), 'w') as f:
+            json.dump(self.metadata, f, indent=2)
+        return
+
+    def close(self):
+        """ Flush and truncate the file to the number of waveforms written """
+        self.flush()
+        if self.n<self._data.shape[0]:
+            data = self._data
+            tmp = self.fname+'.tmp'
+            out = np.lib.format.open_memmap(tmp, mode='w+', dtype=data.dtype, shape=(self.n, data.shape[1]))
+            out[:] = data[:self.n]
+            out.flush()
+            del out, data
+            self._data = None
+            os.replace(tmp, self.fname)
+        else:
+            self._data = None
+        return
+
+
+def load_reference_set(fname):
+    """ Open a reference waveform set as a memory map (.npy), or load it (text file).
+    Returns:
+        waveforms: (n_waveforms, n_samples) array. For .npy, only the valid waveforms (see metadata).
+        metadata: dictionary (empty if there is no metadata file)
+    """
+    metadata = {}
+    if os.path.exists(metadata_filename(fname)):
+        with open(metadata_filename(fname)) as f:
+            metadata = json.load(f)
+    if fname.endswith('.npy'):
+        waveforms = np.load(fname, mmap_mode='r')
+        if 'n_waveforms' in metadata:
+            waveforms = waveforms[:metadata['n_waveforms']]
+    else:
+        waveforms = np.loadtxt(fname, delimiter=',')
+    return waveforms, metadata
+
+
+class WaveformView(object):
+    """
+    Lazy view of a set of raw waveforms with polarity, background subtraction and ROI. Supports
+    shape, len and slicing of the first axis: the processing is applied only to the requested
+    waveforms, so that a memory-mapped set can be processed chunk by chunk.
+    """
+    def __init__(self, waveforms, polarity=1, bkg_fun=None, roi=None):
+        self.waveforms = waveforms
+        self.polarity = polarity
+        self.bkg_fun = bkg_fun
+        self.roi = roi
+        n_samples = waveforms.shape[1] if roi is None else len(range(waveforms.shape[1])[roi[0]:roi[1]])
+        self.shape = (waveforms.shape[0], n_samples)
+        return
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        wfs = np.atleast_2d(np.asarray(self.waveforms[idx], dtype=float))*self.polarity
+        if self.bkg_fun is not None:
+            if hasattr(self.bkg_fun, 'estimate'): # utils.Background: vectorized, running pedestal untouched
+                bkg = self.bkg_fun.estimate(wfs)
+            else:
+                bkg = np.asarray([self.bkg_fun(wf) for wf in wfs])
+            wfs = (wfs.T-bkg).T
+        if self.roi is not None:
+            wfs = wfs[:,self.roi[0]:self.roi[1]]
+        return wfs
+
+    def __array__(self, dtype=None, copy=None):
+        wfs = self[:]
+        return wfs if dtype is None else wfs.astype(dtype)
@@ -0,0 +1,274 @@
+import argparse
+import multiprocessing
+import numpy as np
+import os
+import time
+
+import config
+import fit_quality
+import refstore
+import shots
+import utils
+from delay_bank import DelayScanRegressor
+from engine import INTENSITY_MODES, fit_shots, roi_bounds
+from headless import make_bkg_fun, regressor_from_args
+
+
+"""
+Offline replay: batch reanalysis of recorded waveforms with the background -> ROI -> fit -> intensity
+chain of the live analysis, in chunks across a process pool.
+
+Usage:
+    python replay.py run1.npy run2.npy --refs refs/GEM_example_waveforms.csv --roi 0 100 --bkg 10 -o run1_2.h5
+
+Inputs: reference sets (.npy, memory-mapped, or .csv, see refstore.load_reference_set) or files of the
+result recorder (.h5 with a 'waveform' dataset, see recorder.py; these waveforms are already
+background subtracted, --bkg is not applied to them). The basis is built once from --refs, each worker fits chunks of the input
+files, the results are written in one HDF5 file with the datasets of the recorder plus 'file_index'
+and 'shot_index' (position of the shot in its input file).
+
+The 'pedestal' background is estimated per chunk (see utils.Background.estimate), so that the results
+do not depend on how the chunks are distributed to the workers.
+
+Fit quality: additional metrics (--metrics pearson rms chi2, see fit_quality.py) are written as datasets
+of the same name, from the residual of the fit. The noise of chi2 is --noise, or the standard deviation
+of the background samples of each shot. With --gate (e.g. --gate r2=0.9 chi2=4), the boolean dataset
+'good' flags the shots passing all the thresholds. The metrics of a failed fit are NaN, and it is never good.
+"""
+
+
+def load_waveforms(fname):
+    """ Open a file of waveforms without loading it (except text files).
+    Returns:
+        dictionary with 'waveforms' (array-like, sliceable), 'pulse_id' and 'timestamp' (None if not in the file),
+        and 'background_subtracted' (True for the waveforms of the recorder, the input of the live fits)
+    """
+    if fname.endswith('.h5'):
+        import h5py # optional dependency
+        f = h5py.File(fname, 'r')
+        if 'waveform' not in f:
+            raise ValueError('{} contains no waveforms (recorded without waveforms?)'.format(fname))
+        return {'waveforms': f['waveform'], 'pulse_id': f.get('pulse_id'), 'timestamp': f.get('timestamp'),
+                'background_subtracted': True}
+    waveforms, metadata = refstore.load_reference_set(fname)
+    return {'waveforms': waveforms, 'pulse_id': None, 'timestamp': None, 'background_subtracted': False}
+
+
+""" Worker processes """
+_worker = {}
+
+def _init_worker(regressor, bkg, roi, polarity, mode, metrics=(), noise=None, thresholds=None):
+    _worker['regressor'] = regressor
+    _worker['bkg_fun'] = None if bkg is None else make_bkg_fun(*bkg)
+    _worker['roi'] = roi
+    _worker['polarity'] = polarity
+    _worker['mode'] = mode
+    _worker['metrics'] = list(metrics)
+    _worker['noise'] = noise
+    _worker['thresholds'] = thresholds or {}
+    _worker['files'] = {} # loaded text and .npy files
+    return
+
+
+def _read_chunk(fname, start, stop):
+    """ Waveforms start:stop of a file, with their pulse ids and timestamps (see load_waveforms).
+    The HDF5 files are opened for each chunk (and closed), the other files are loaded once per worker.
+    """
+    try:
+        data = _worker['files'][fname]
+    except KeyError:
+        data = load_waveforms(fname)
+    try:
+        chunk = {key: None if data[key] is None else data[key][start:stop] for key in ['waveforms', 'pulse_id', 'timestamp']}
+        chunk['background_subtracted'] = data['background_subtracted']
+    finally:
+        if data['background_subtracted']: # HDF5 file
+            data['waveforms'].file.close()
+        else:
+            _worker['files'][fname] = data
+    return chunk
+
+
+def _process_chunk(task):
+    """ Analyze the waveforms start:stop of a file: background, then engine.fit_shots as in the live analysis """
+    file_idx, fname, start, stop = task
+    chunk = _read_chunk(fname, start, stop)
+    wfs = np.asarray(chunk['waveforms'], dtype=float)
+    n = wfs.shape[0]
+    bkg_fun = _worker['bkg_fun']
+    noise = _worker['noise']
+    if bkg_fun is not None:
+        if noise is None:
+            noise = wfs[:,:bkg_fun.bkg_idx].std(axis=1)
+        if not chunk['background_subtracted']:
+            wfs = wfs-bkg_fun.estimate(wfs)[:,None]
+    regressor = _worker['regressor']
+    roi = _worker['roi']
+    polarity = _worker['polarity']
+    results = fit_shots([shots.Shot(y) for y in wfs], roi=roi, regressor=regressor, polarity=polarity,
+                        mode=_worker['mode'])
+    fitted = results[0]['fit'] is not None
+    result = {
+        'score': np.concatenate([r['score'] for r in results]),
+        'intensity': np.array([r['intensity'] for r in results]),
+        'coeffs': np.array([r['coeffs'] for r in results]) if fitted else np.zeros((n, regressor.A.shape[0])),
+        'pulse_id': np.full(n, -1, dtype=np.int64) if chunk['pulse_id'] is None else chunk['pulse_id'],
+        'timestamp': np.full(n, np.nan) if chunk['timestamp'] is None else chunk['timestamp'],
+        'file_index': np.full(n, file_idx, dtype=np.int32),
+        'shot_index': np.arange(start, stop, dtype=np.int64)
+    }
+    if isinstance(regressor, DelayScanRegressor):
+        result['delay'] = np.array([r['delay'] for r in results]) if fitted else np.full((n, regressor.n_pulse_), np.nan)
+    metrics = set(_worker['metrics'])|set(_worker['thresholds'])
+    if metrics:
+        if not fitted: # failed fit: NaN metrics, never good
+            quality = {metric: np.full(n, np.nan) for metric in metrics}
+        else:
+            lo, hi = roi_bounds(wfs.shape[1], roi)
+            X = polarity*wfs[:,lo:hi] # input of the fit, and its residual (fits are multiplied by the polarity)
+            residual = X-np.array([r['fit'].y for r in results])/polarity
+            quality = regressor.quality(X, residual, metrics=metrics-{'r2'}, noise=noise)
+            quality['r2'] = result['score']
+        for metric in _worker['metrics']:
+            result[metric] = quality[metric]
+        if _worker['thresholds']:
+            result['good'] = fit_quality.gate(quality, _worker['thresholds'])
+    return start, result
+
+
+""" Driver """
+def make_tasks(fnames, chunk_size):
+    """ Split the files in chunks. Returns the list of tasks (file_idx, fname, start, stop) and the
+    output offset of each task.
+    """
+    tasks, offsets = [], []
+    offset = 0
+    for file_idx, fname in enumerate(fnames):
+        waveforms = load_waveforms(fname)['waveforms']
+        n = len(waveforms)
+        if hasattr(waveforms, 'file'): # HDF5 dataset
+            waveforms.file.close()
+        for start in range(0, n, chunk_size):
+            stop = min(start+chunk_size, n)
+            tasks.append((file_idx, fname, start, stop))
+            offsets.append(offset)
+            offset+=stop-start
+    return tasks, offsets, offset
+
+
+def replay(fnames, output, regressor, bkg=None, roi=None, polarity=config.POLARITY, mode=config.INTENSITY_MODE,
+           chunk_size=2000, processes=None, print_period=1., metrics=(), noise=None, thresholds=None):
+    """ Reanalyze the waveforms of the files and write the results in output (HDF5).
+    Args:
+        fnames: input files (see load_waveforms)
+        output: output file name
+        regressor: WaveformRegressor instance
+        bkg: background parameters (bkg_idx, method) (see headless.make_bkg_fun), or None
+        roi, polarity, mode: as in the live analysis
+        chunk_size: number of waveforms per task
+        processes: number of worker processes (default: number of CPUs)
+        print_period: progress print period (s)
+        metrics: additional fit quality metrics, written as datasets ('pearson', 'rms', 'chi2', see fit_quality.py)
+        noise: noise RMS of the samples for chi2 (default: standard deviation of the background samples)
+        thresholds: fit quality gate {metric: threshold} (see fit_quality.gate), written as the 'good' dataset
+    Returns:
+        number of shots and throughput (shots/s)
+    """
+    import h5py # optional dependency
+    if mode not in INTENSITY_MODES:
+        raise ValueError('Intensity mode {} not supported in replay'.format(mode))
+    if bkg is not None and any(fname.endswith('.h5') for fname in fnames):
+        print('The waveforms of the recorder files are already background subtracted: --bkg only applies to '
+              'the references, the other files and the chi2 noise.')
+    metrics = [metric for metric in metrics if metric!='r2'] # r2 is the score dataset
+    tasks, offsets, n_total = make_tasks(fnames, chunk_size)
+    offsets = {(task[0], task[2]): offset for task, offset in zip(tasks, offsets)}
+    n_coeffs = regressor.A.shape[0]
+    t0 = time.time()
+    t_print = t0
+    n_done = 0
+    with h5py.File(output, 'w') as f:
+        f.attrs['files'] = [os.path.abspath(fname) for fname in fnames]
+        f.attrs['n_pulse'] = regressor.n_pulse_
+        f.attrs['n_coeffs'] = n_coeffs
+        f.attrs['n_samples'] = regressor.A.shape[1]
+        for key, value in getattr(regressor, 'params_', {}).items():
+            if value is not None:
+                f.attrs[key] = value
+        dsets = {
+            'score': f.create_dataset('score', (n_total,), dtype=float),
+            'intensity': f.create_dataset('intensity', (n_total, regressor.n_pulse_), dtype=float),
+            'coeffs': f.create_dataset('coeffs', (n_total, n_coeffs), dtype=float),
+            'pulse_id': f.create_dataset('pulse_id', (n_total,), dtype=np.int64),
+            'timestamp': f.create_dataset('timestamp', (n_total,), dtype=float),
+            'file_index': f.create_dataset('file_index', (n_total,), dtype=np.int32),
+            'shot_index': f.create_dataset('shot_index', (n_total,), dtype=np.int64)
+        }
+        if isinstance(regressor, DelayScanRegressor):
+            dsets['delay'] = f.create_dataset('delay', (n_total, regressor.n_pulse_), dtype=float)
+        for metric in metrics:
+            dsets[metric] = f.create_dataset(metric, (n_total,), dtype=float)
+        if thresholds:
+            dsets['good'] = f.create_dataset('good', (n_total,), dtype=bool)
+            for metric, threshold in thresholds.items():
+                f.attrs['gate_'+metric] = threshold
+        if 'chi2' in metrics and noise is not None:
+            f.attrs['noise'] = noise
+        with multiprocessing.Pool(processes, initializer=_init_worker,
+                                  initargs=(regressor, bkg, roi, polarity, mode, metrics, noise, thresholds)) as pool:
+            for start, result in pool.imap_unordered(_process_chunk, tasks):
+                offset = offsets[(result['file_index'][0], start)]
+                n = result['score'].size
+                for key, dset in dsets.items():
+                    dset[offset:offset+n] = result[key]
+                n_done+=n
+                if time.time()-t_print>print_period:
+                    t_print = time.time()
+                    print('{}/{} shots, {:.0f} shots/s'.format(n_done, n_total, n_done/(t_print-t0)))
+    elapsed = time.time()-t0
+    rate = n_done/elapsed if elapsed>0 else np.inf
+    print('{} shots reanalyzed in {:.1f} s: {:.0f} shots/s. Results written to {}.'.format(n_done, elapsed, rate, output))
+    return n_done, rate
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Offline reanalysis of recorded waveforms')
+    parser.add_argument('files', nargs='+', help='waveform files (.npy, .csv, or .h5 from the recorder)')
+    parser.add_argument('-o', '--output', default='replay.h5', help='output file (HDF5)')
+    parser.add_argument('--refs', default=config.TEST_DATA_FILE, help='reference waveforms (.npy or .csv)')
+    parser.add_argument('--regressor', default=None, help='saved regressor (.npz), instead of building it from --refs')
+    parser.add_argument('--n-components', type=int, default=1)
+    parser.add_argument('--n-pulse', type=int, default=1)
+    parser.add_argument('--delay', type=int, nargs='*', default=None, help='delays between the pulses')
+    parser.add_argument('--projector', default=config.PROJECTOR_METHOD, choices=['pinv', 'QR', 'Ridge'])
+    parser.add_argument('--alpha', type=float, default=config.RIDGE_ALPHA, help='regularization of the Ridge projector')
+    parser.add_argument('--delay-scan', default=None, metavar='START:STOP[:STEP],...',
+                        help='fit the best delays of each shot in these ranges (one range per delay, see delay_bank.py)')
+    parser.add_argument('--scan-per', default=config.DELAY_SCAN_PER, choices=['shot', 'batch'])
+    parser.add_argument('--roi', type=int, nargs=2, default=[0, 100])
+    parser.add_argument('--bkg', type=int, default=0, help='number of samples for the background (0: none)')
+    parser.add_argument('--bkg-method', default=config.BKG_METHOD, choices=utils.BKG_METHODS)
+    parser.add_argument('--mode', default=config.INTENSITY_MODE, choices=INTENSITY_MODES, help='intensity mode')
+    parser.add_argument('--metrics', nargs='*', default=[], choices=fit_quality.METRICS,
+                        help='additional fit quality metrics (see fit_quality.py)')
+    parser.add_argument('--noise', type=float, default=None,
+                        help='noise RMS of the samples for chi2 (default: standard deviation of the background samples)')
+    parser.add_argument('--gate', nargs='*', default=[], metavar='METRIC=VALUE',
+                        help='fit quality thresholds (minimum for r2 and pearson, maximum for rms and chi2)')
+    parser.add_argument('--chunk-size', type=int, default=2000, help='number of waveforms per task')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    bkg = (args.bkg, args.bkg_method) if args.bkg>0 else None
+    bkg_fun = None if bkg is None else make_bkg_fun(*bkg)
+    regressor = regressor_from_args(args, bkg_fun)
+    return replay(args.files, args.output, regressor, bkg=bkg, roi=args.roi, mode=args.mode,
+                  chunk_size=args.chunk_size, processes=args.processes, metrics=args.metrics, noise=args.noise,
+                  thresholds=fit_quality.parse_thresholds(args.gate))
+
+
+if __name__=='__main__':
+    main()
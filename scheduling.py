@@ -0,0 +1,145 @@
+import threading
+from collections import deque
+from PyQt5.QtCore import QRunnable
+
+
+"""
+Scheduling of the analysis tasks on the threadpool, with explicit drop policy and counters.
+QThreadPool.tryStart silently skips the task when no thread is available; the StageScheduler
+instead keeps a small queue of pending tasks per stage and counts what is received, analyzed and
+dropped, so that one can tell whether the stripcharts reflect all shots or only a subset.
+
+Policies:
+    'drop-newest': when the queue is full, the new task is dropped (maxlen=0 is equivalent to tryStart)
+    'drop-oldest': when the queue is full, the oldest pending task is dropped
+    'block': the caller waits until there is room in the queue (do not use from the GUI thread)
+"""
+
+POLICIES = ['drop-newest', 'drop-oldest', 'block']
+
+
+class _ScheduledRunnable(QRunnable):
+    """ Wraps a task to notify the scheduler when it is done. """
+    def __init__(self, runnable, scheduler, n):
+        super(_ScheduledRunnable, self).__init__()
+        self.runnable = runnable
+        self.scheduler = scheduler
+        self.n = n
+        return
+
+    def run(self):
+        try:
+            self.runnable.run()
+        finally:
+            self.scheduler._task_done(self.n)
+        return
+
+
+class StageScheduler(object):
+    """
+    Run the tasks of one analysis stage on a (shared) threadpool.
+    """
+    def __init__(self, threadpool, name='', policy='drop-newest', maxlen=0, max_running=None, timeout=None):
+        """ Args:
+        threadpool: QThreadPool instance
+        name: name of the stage (for the counters)
+        policy: 'drop-newest', 'drop-oldest' or 'block'
+        maxlen: maximum number of pending tasks
+        max_running: maximum number of tasks of this stage running at the same time. Default is the
+            number of threads of the pool.
+        timeout: for the 'block' policy, maximum waiting time (s) before dropping the task. None
+            waits forever.
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown scheduling policy {}. Must be one of {}.'.format(policy, POLICIES))
+        self.threadpool = threadpool
+        self.name = name
+        self.policy = policy
+        self.maxlen = maxlen
+        if max_running is None:
+            max_running = threadpool.maxThreadCount()
+        self.max_running = max_running
+        self.timeout = timeout
+
+        self._pending = deque()
+        self._running = 0
+        self._cond = threading.Condition()
+        self.reset_counters()
+        return
+
+    def reset_counters(self):
+        with self._cond:
+            self.n_received = 0
+            self.n_analyzed = 0
+            self.n_dropped = 0
+        return
+
+    def submit(self, runnable, n=1):
+        """ Schedule a task.
+        Args:
+            runnable: QRunnable instance
+            n: number of shots handled by the task (for the counters, e.g. batch size)
+        Returns:
+            True if the task was started or queued, False if it was dropped.
+        """
+        task = _ScheduledRunnable(runnable, self, n)
+        with self._cond:
+            self.n_received+=n
+            if self._running<self.max_running:
+                self._running+=1
+                start = True
+            else:
+                start = False
+                if len(self._pending)<self.maxlen:
+                    self._pending.append(task)
+                elif self.policy=='drop-oldest' and self.maxlen>0:
+                    self.n_dropped+=self._pending.popleft().n
+                    self._pending.append(task)
+                elif self.policy=='block':
+                    if self._cond.wait_for(self._has_room, timeout=self.timeout):
+                        if self._running<self.max_running:
+                            self._running+=1
+                            start = True
+                        else:
+                            self._pending.append(task)
+                    else:
+                        self.n_dropped+=n
+                        return False
+                else:
+                    self.n_dropped+=n
+                    return False
+        if start:
+            self.threadpool.start(task)
+        return True
+
+    def _has_room(self):
+        return (self._running<self.max_running) or (len(self._pending)<self.maxlen)
+
+    def _task_done(self, n):
+        """ Called from the worker thread when a task is finished: start the next pending task """
+        with self._cond:
+            self.n_analyzed+=n
+            if self._pending:
+                task = self._pending.popleft()
+            else:
+                task = None
+                self._running-=1
+            self._cond.notify()
+        if task is not None:
+            self.threadpool.start(task)
+        return
+
+    def get_counters(self):
+        with self._cond:
+            return {
+                'received': self.n_received,
+                'analyzed': self.n_analyzed,
+                'dropped': self.n_dropped,
+                'depth': len(self._pending),
+                'running': self._running
+            }
+
+    def format_counters(self):
+        c = self.get_counters()
+        return '{}: {} received, {} analyzed, {} dropped, {} queued'.format(
+            self.name, c['received'], c['analyzed'], c['dropped'], c['depth'])
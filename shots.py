@@ -0,0 +1,81 @@
+import numpy as np
+import threading
+
+
+"""
+Shot data structure for the PV -> fit -> plot path.
+
+A Shot holds a waveform y and its x-axis. The x-axes are shared, read-only np.arange cached per
+length (a ROI x-axis is a view of it). The background subtracted waveforms and the fits are arrays
+owned by their shots (a batch of fits shares one array), so that plots and sinks can keep them; only
+the fit input, used within a call, is written in a per-thread scratch array (see scratch).
+"""
+
+
+_x_cache = {}
+_x_lock = threading.Lock()
+_scratch = threading.local()
+
+
+def get_x(n):
+    """ Shared, read-only x-axis np.arange(n) """
+    try:
+        return _x_cache[n]
+    except KeyError:
+        with _x_lock:
+            x = np.arange(n)
+            x.flags.writeable = False
+            return _x_cache.setdefault(n, x)
+
+
+def scratch(shape, dtype=np.float64):
+    """ Work array of the calling thread (not initialized), valid until the next call from the same
+    thread. The memory is reused across calls and only grows to the largest request.
+    """
+    shape = tuple(np.atleast_1d(shape))
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape))*dtype.itemsize
+    buf = getattr(_scratch, 'buf', None)
+    if buf is None or buf.size<nbytes:
+        buf = _scratch.buf = np.empty(nbytes, dtype=np.uint8)
+    return buf[:nbytes].view(dtype).reshape(shape)
+
+
+class Shot(object):
+    """
+    Waveform and its x-axis, plus acquisition metadata. Indexing is compatible with the (2,n) arrays
+    previously used: shot[0] is x, shot[1] is y.
+    """
+    __slots__ = ('x', 'y', 'timestamp', 'pulse_id', 'stamps')
+
+    def __init__(self, y, x=None, timestamp=None, pulse_id=None, stamps=None):
+        self.y = y
+        self.x = get_x(y.size) if x is None else x
+        self.timestamp = timestamp
+        self.pulse_id = pulse_id
+        self.stamps = stamps # per-stage timestamps, see latency.py
+        return
+
+    def __getitem__(self, idx):
+        return (self.x, self.y)[idx]
+
+    def __len__(self):
+        return 2
+
+    @property
+    def shape(self):
+        return (2, self.y.size)
+
+    @property
+    def dtype(self):
+        return self.y.dtype
+
+    def copy(self):
+        return Shot(self.y.copy(), x=self.x, timestamp=self.timestamp, pulse_id=self.pulse_id, stamps=self.stamps)
+
+
+def make_shot(y, bkg_fun=None, timestamp=None, pulse_id=None, stamps=None):
+    """ Shot with the background subtracted waveform. Without background function, y is not copied. """
+    if bkg_fun is not None:
+        y = np.subtract(y, bkg_fun(y), dtype=np.result_type(y.dtype, np.float64))
+    return Shot(y, timestamp=timestamp, pulse_id=pulse_id, stamps=stamps)
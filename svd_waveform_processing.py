@@ -1,13 +1,12 @@
+import json
 import numpy as np
+import threading
+import time
 # from pathlib import Path
 
-from scipy.signal import savgol_filter
-from scipy.stats import pearsonr
+import fit_quality
 
-from sklearn.base import BaseEstimator, RegressorMixin
-from sklearn.decomposition import TruncatedSVD
-from sklearn.linear_model import Ridge
-from sklearn.metrics import r2_score
+# scipy and sklearn are imported where needed: importing them takes longer than the rest of the startup
 
 """
 General linear algebra comments on subspace projection:
@@ -20,11 +19,128 @@ The projector is defined as A.T (or pinv A).
 The relation Ax = (x.TA.T).T is also used to flip the matrix multiplication for the same reason.
 """
 
+PULSE_INTENSITY_MODES = ['norm', 'max', 'both'] # modes of get_pulse_intensity and analyze
 
-def get_basis_and_projector(waveforms, n_components=1, n_iter=20):
+
+class SvdBasis(object):
+    """ Result of the SVD of a set of reference waveforms (subset of the TruncatedSVD attributes).
+    
+    Attributes:
+        components_: right singular vectors (n_components, n_samples)
+        singular_values_: singular values
+        explained_variance_: variance of the waveforms projected on each component
+        explained_variance_ratio_: explained_variance_ normalized by the total variance of the waveforms
+        total_variance_: total variance of the waveforms
+        n_waveforms_, mean_: number and mean of the waveforms (moments used by OnlineBasis)
+        method: method used to compute the SVD
+        elapsed: computation time (s)
+    """
+    def __init__(self, components, singular_values, waveforms, method='', elapsed=0.):
+        self.components_ = components
+        self.singular_values_ = singular_values
+        self.method = method
+        self.elapsed = elapsed
+        if waveforms is not None:
+            self.explained_variance_ = np.var(waveforms.dot(components.T), axis=0)
+            self.total_variance_ = np.var(waveforms, axis=0).sum()
+            self.explained_variance_ratio_ = self.explained_variance_/self.total_variance_
+            self.n_waveforms_ = waveforms.shape[0]
+            self.mean_ = waveforms.mean(axis=0)
+        return
+    
+    def __repr__(self):
+        return 'SVD basis ({}): {} components in {:.3f} s, explained variance ratio: {}'.format(
+            self.method, self.components_.shape[0], self.elapsed, np.round(self.explained_variance_ratio_, 4))
+
+
+def _flip_signs(Vt):
+    """ Deterministic sign of the components: largest absolute value positive (as sklearn svd_flip) """
+    signs = np.sign(Vt[np.arange(Vt.shape[0]), np.argmax(np.abs(Vt), axis=1)])
+    signs[signs==0] = 1
+    return Vt*signs[:,None]
+
+
+def svd_exact(waveforms, n_components=1):
+    """ Exact truncated SVD through the eigen decomposition of the smallest Gram matrix. Fast for 
+    tall-skinny (or short-wide) matrices, which reference waveform sets usually are.
+    Returns singular values and right singular vectors Vt (n_components, n_samples).
+    """
+    from scipy.linalg import eigh
+    X = np.asarray(waveforms, dtype=float)
+    n_components = min(n_components, *X.shape)
+    if X.shape[1]<=X.shape[0]:
+        G = X.T.dot(X)
+        m = G.shape[0]
+        w, V = eigh(G, subset_by_index=[m-n_components, m-1])
+        w, V = w[::-1], V[:,::-1]
+        s = np.sqrt(np.clip(w, 0, None))
+        Vt = V.T
+    else:
+        G = X.dot(X.T)
+        m = G.shape[0]
+        w, U = eigh(G, subset_by_index=[m-n_components, m-1])
+        w, U = w[::-1], U[:,::-1]
+        s = np.sqrt(np.clip(w, 0, None))
+        Vt = U.T.dot(X)/np.where(s>0, s, 1)[:,None]
+    return s, Vt
+
+
+def svd_randomized(waveforms, n_components=1, n_iter=7, random_state=None):
+    """ Randomized truncated SVD (Halko et al.), only the requested components are computed. """
+    from sklearn.utils.extmath import randomized_svd
+    U, s, Vt = randomized_svd(np.asarray(waveforms, dtype=float), n_components, n_iter=n_iter, 
+                              random_state=random_state)
+    return s, Vt
+
+
+def svd_update(s, Vt, X, n_components=1, forget=1.):
+    """ Update the truncated SVD (s, Vt) of a set of waveforms with new waveforms X (incremental SVD, 
+    without centering).
+    Args:
+        s, Vt: current singular values and right singular vectors. None to start from scratch.
+        X: new waveforms (n_waveforms, n_samples)
+        n_components: number of components to keep
+        forget: factor in ]0,1] applied to the current singular values before the update (the weight
+            of the previous waveforms in the Gram matrix is forget**2)
+    """
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    if s is None:
+        M = X
+    else:
+        M = np.concatenate([(forget*s)[:,None]*Vt, X], axis=0)
+    _, s, Vt = np.linalg.svd(M, full_matrices=False)
+    return s[:n_components], Vt[:n_components]
+
+
+def svd_incremental(waveforms, n_components=1, chunk_size=500, n_oversamples=10):
+    """ Incremental truncated SVD: the waveforms are processed by chunks of chunk_size, so that the 
+    full set never needs to be in memory (works with memory-mapped arrays).
+    """
+    s, Vt = None, None
+    n_keep = n_components+n_oversamples
+    for ii in range(0, waveforms.shape[0], chunk_size):
+        s, Vt = svd_update(s, Vt, waveforms[ii:ii+chunk_size], n_components=n_keep)
+    return s[:n_components], Vt[:n_components]
+
+
+SVD_METHODS = {
+    'exact': svd_exact,
+    'randomized': svd_randomized,
+    'incremental': svd_incremental
+}
+
+
+def get_basis_and_projector(waveforms, n_components=1, n_iter=20, method='exact', **kwargs):
     """
     Returns the basis vector A, subspace projector and svd of the waveforms.
     
+    Args:
+        waveforms: reference waveforms (n_waveforms, n_samples)
+        n_components: number of SVD components. Only these components are computed.
+        n_iter: number of power iterations of the 'randomized' method (ignored by the other methods)
+        method: 'exact' (eigen decomposition of the Gram matrix), 'randomized' or 'incremental'
+        kwargs: passed to the svd function (random_state for 'randomized', chunk_size for 'incremental')
+    
     Remark: although in the single pulse case, A and the projector are simply the transpose of 
     each other, they are still assigned to two different variables, as their relationship is not as 
     straighforward for the multi-pulse case. The WaveformRegressor can thus handle both cases the 
@@ -32,8 +148,30 @@ def get_basis_and_projector(waveforms, n_components=1, n_iter=20):
     """
     
     """ (i) Perform SVD"""
-    svd = TruncatedSVD(n_components=25, n_iter=n_iter)
-    svd.fit(waveforms)
+    if method not in SVD_METHODS:
+        raise NameError('SVD method {} not implemented'.format(method))
+    t0 = time.perf_counter()
+    if method=='randomized':
+        kwargs['n_iter'] = n_iter
+    s, Vt = SVD_METHODS[method](waveforms, n_components=n_components, **kwargs)
+    Vt = _flip_signs(Vt)
+    if method=='incremental':
+        svd = SvdBasis(Vt, s, None, method=method, elapsed=time.perf_counter()-t0)
+        # explained variance by chunks, to not load the full set in memory
+        proj, tot, sq, sq_tot = 0, 0, 0, 0
+        n = waveforms.shape[0]
+        chunk_size = kwargs.get('chunk_size', 500)
+        for ii in range(0, n, chunk_size):
+            chunk = np.asarray(waveforms[ii:ii+chunk_size], dtype=float)
+            c = chunk.dot(Vt.T)
+            proj, sq = proj+c.sum(axis=0), sq+(c**2).sum(axis=0)
+            tot, sq_tot = tot+chunk.sum(axis=0), sq_tot+(chunk**2).sum(axis=0)
+        svd.explained_variance_ = sq/n-(proj/n)**2
+        svd.total_variance_ = (sq_tot/n-(tot/n)**2).sum()
+        svd.explained_variance_ratio_ = svd.explained_variance_/svd.total_variance_
+        svd.n_waveforms_, svd.mean_ = n, tot/n
+    else:
+        svd = SvdBasis(Vt, s, np.asarray(waveforms), method=method, elapsed=time.perf_counter()-t0)
     
     """ (ii) Construct projector """
 #     The projector is defined as the pseudo inverse of the basis vectors A:
@@ -53,8 +191,8 @@ def multiPulseProjector(singlePulseBasis, n_pulse=1, delay=None, sampling=1, met
         delay: delay between the pulses (if the number of delay is equal to n_pulse-1, then 
             the first pulse is assumed to have dl=0
         sampling: sampling of the waveform. Useful if the delay is given in time units instead of indices
-        method: 'pinv', 'QR', 'Ridge'
-        kwargs: only for Ridge regressor (see code)
+        method: 'pinv', 'QR', 'Ridge' or 'Tikhonov' (see regularized_projector)
+        kwargs: alpha (Ridge and Tikhonov) and penalty (Tikhonov)
     
     Returns:
         Basis matrix A and projector matrices
@@ -64,8 +202,6 @@ def multiPulseProjector(singlePulseBasis, n_pulse=1, delay=None, sampling=1, met
     The coefficients projector onto the subspace A are:
         coeffs=projector.dot(data)
         
-    Note: if method 'Ridge' is used, then a RidgeRegressor object is returned instead of a projector (matrix).
-    The function fitPulse will take care of handling this difference.
     """
     
     if delay is None:
@@ -99,38 +235,186 @@ def multiPulseProjector(singlePulseBasis, n_pulse=1, delay=None, sampling=1, met
         projector = np.transpose(np.linalg.inv(A.transpose().dot(Q))).dot(Q)
         return A, projector
     elif method=='Ridge':
-        if 'alpha' in kwargs:
-            alpha = kwargs.pop('alpha')
-        else:
-            alpha=0
-        projector = Ridge(alpha=alpha, fit_intercept=False) # is a RidgeRegressor instance, not a matrix
+        projector = regularized_projector(A, alpha=kwargs.get('alpha', 0))
+        return A, projector
+    elif method=='Tikhonov':
+        projector = regularized_projector(A, alpha=kwargs.get('alpha', 0), penalty=kwargs.get('penalty'))
         return A, projector
     else:
         raise NameError('Method not implemented')
 
 
-def construct_waveformRegressor(X_ref, n_components=1, n_pulse=1, delay=None, **kwargs):
+def regularized_projector(A, alpha=0, penalty=None):
+    """ Closed-form regularized (Tikhonov) projector (A.T A + R)^-1 A.T, with R = alpha*I + penalty.T penalty.
+    Same orientation as pinv(A): the coefficients of the data are projector.dot(data), and the fit of a
+    waveform (or of a batch) is a single matrix product.
+    With penalty=None, the coefficients are the same as sklearn Ridge(alpha, fit_intercept=False).fit(A, data).coef_.
+    
+    Args:
+        A: basis matrix (n_samples, n_coeffs)
+        alpha: Ridge regularization strength
+        penalty: Tikhonov matrix (n, n_coeffs), or 1D array of per coefficient weights (diagonal matrix)
+    """
+    A = np.asarray(A, dtype=float)
+    R = alpha*np.eye(A.shape[1])
+    if penalty is not None:
+        penalty = np.asarray(penalty, dtype=float)
+        R += np.diag(penalty**2) if penalty.ndim==1 else penalty.T.dot(penalty)
+    G = A.T.dot(A)+R
+    try:
+        L = np.linalg.cholesky(G)
+    except np.linalg.LinAlgError: # singular (no regularization and degenerate basis)
+        return np.linalg.pinv(G).dot(A.T)
+    return np.linalg.solve(L.T, np.linalg.solve(L, A.T))
+
+
+def construct_waveformRegressor(X_ref, n_components=1, n_pulse=1, delay=None, svd_method='exact', roi=None, **kwargs):
     """ Construct waveform regressor based on a set of reference waveforms.
     
     Args:
         X_ref: reference waveform
         n_components: nubmer of SVD components to use for the fit
         n_pulse: number of pulse to fit in the waveform
+        svd_method: see function get_basis_and_projector
+        roi: roi of the reference waveforms (only stored in the regressor)
         **kwargs: see function multiPulseProjector. If n_pulse>1, a kwarg 'delay' is mandatory.
     """
-    A, projector, svd = get_basis_and_projector(X_ref, n_components=n_components)
+    A, projector, svd = get_basis_and_projector(X_ref, n_components=n_components, method=svd_method)
     A, projector = multiPulseProjector(A, n_pulse=n_pulse, delay=delay, **kwargs)
-    return WaveformRegressor(A=A, projector=projector, n_pulse=n_pulse)
+    regr = WaveformRegressor(A=A, projector=projector, n_pulse=n_pulse, roi=roi)
+    regr.svd_ = svd
+    regr.params_ = dict(n_components=n_components, n_pulse=n_pulse, delay=delay, **kwargs)
+    return regr
+
+
+class OnlineBasis(object):
+    """ Online adaptation of the SVD basis of a regressor from live waveforms.
+    
+    Well fitted waveforms are accumulated by add and, by batches, folded in the SVD of the reference 
+    set (incremental SVD, see svd_update) with an exponential forgetting factor per waveform. update 
+    returns a new regressor: swapping it in (simple attribute assignment) is atomic, the running fits 
+    keep the regressor they started with. Its attribute version_ is the number of updates of the basis.
+    The explained variance of the updated bases is computed from the weighted moments (same forgetting 
+    factor) of the reference set and of the accumulated waveforms. Without the moments of the reference 
+    set (regressor saved by an older version), it is the explained variance of the last batch only.
+    Only for single pulse regressors: multipulse waveforms cannot be used to update the single pulse basis.
+    """
+    def __init__(self, regressor, forget=0.99, min_score=0.95, batch_size=20, n_oversamples=5):
+        """
+        Args:
+            regressor: WaveformRegressor made by construct_waveformRegressor
+            forget: forgetting factor per waveform (memory of about 1/(1-forget) waveforms)
+            min_score: only the waveforms with a fit score above min_score are used
+            batch_size: number of waveforms accumulated before each update
+            n_oversamples: extra components kept in the online SVD for accuracy
+        """
+        if regressor.n_pulse_!=1:
+            raise ValueError('Online basis update is only possible for single pulse regressors.')
+        self.params = dict(regressor.params_)
+        self.n_components = self.params.pop('n_components')
+        self.forget = forget
+        self.min_score = min_score
+        self.batch_size = batch_size
+        self.n_keep = self.n_components+n_oversamples
+        self.roi = regressor.roi
+        self.support_tol = regressor.support_tol
+        self.s = regressor.svd_.singular_values_
+        self.Vt = regressor.svd_.components_
+        self.n_updates = 0
+        # weighted moments of the waveforms: weight, sum and sum of the squared norms
+        svd = regressor.svd_
+        if getattr(svd, 'mean_', None) is not None:
+            n = svd.n_waveforms_
+            self._moments = (n, n*svd.mean_, n*(svd.total_variance_+svd.mean_.dot(svd.mean_)))
+        else:
+            self._moments = None
+        
+        self._pending = []
+        self._n_pending = 0
+        self._busy = False
+        self._lock = threading.Lock()
+        return
+    
+    def add(self, X, score=None):
+        """ Add waveform(s) X (same ROI and polarity as the regressor).
+        Returns True if enough waveforms are accumulated and no update is running: update should be called.
+        """
+        X = np.array(X, dtype=float, ndmin=2) # copy: accumulated until the next update
+        if X.shape[1]!=self.Vt.shape[1]:
+            return False
+        if score is not None:
+            X = X[np.ravel(score)>=self.min_score]
+        with self._lock:
+            if X.shape[0]>0:
+                self._pending.append(X)
+                self._n_pending+=X.shape[0]
+            if self._n_pending>=self.batch_size and not self._busy:
+                self._busy = True
+                return True
+        return False
+    
+    def update(self):
+        """ Fold the accumulated waveforms in the basis and return the updated regressor """
+        with self._lock:
+            X = np.concatenate(self._pending, axis=0)
+            self._pending = []
+            self._n_pending = 0
+        try:
+            # weight forget per waveform in the Gram matrix: sqrt(forget) per waveform on the singular values
+            s, Vt = svd_update(self.s, self.Vt, X, n_components=self.n_keep, forget=np.sqrt(self.forget)**X.shape[0])
+            self.s, self.Vt = s, Vt
+            self.n_updates+=1
+            Vt, s = _flip_signs(Vt[:self.n_components]), s[:self.n_components]
+            if self._moments is None:
+                svd = SvdBasis(Vt, s, X, method='online, variance of the last batch')
+            else:
+                svd = self._weighted_basis(Vt, s, X)
+            A, projector = multiPulseProjector(svd.components_.T, **self.params)
+            regr = WaveformRegressor(A=A, projector=projector, n_pulse=1, roi=self.roi, support_tol=self.support_tol)
+            regr.svd_ = svd
+            regr.params_ = dict(n_components=self.n_components, **self.params)
+            regr.version_ = self.n_updates
+        finally:
+            with self._lock:
+                self._busy = False
+        return regr
+    
+    def _weighted_basis(self, Vt, s, X):
+        """ SvdBasis of the updated components, with the explained variance of the weighted waveforms.
+        The squared singular values are the weighted sums of the squared projections (uncentered SVD).
+        """
+        f = self.forget**X.shape[0]
+        w, total, sq = self._moments
+        w, total, sq = f*w+X.shape[0], f*total+X.sum(axis=0), f*sq+(X**2).sum()
+        self._moments = (w, total, sq)
+        svd = SvdBasis(Vt, s, None, method='online')
+        svd.n_waveforms_, svd.mean_ = w, total/w
+        svd.explained_variance_ = s**2/w-Vt.dot(svd.mean_)**2
+        svd.total_variance_ = sq/w-svd.mean_.dot(svd.mean_)
+        svd.explained_variance_ratio_ = svd.explained_variance_/svd.total_variance_
+        return svd
+
 
 
+def _json_default(obj):
+    """ numpy scalars and arrays in the saved metadata """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return obj.item()
 
-class WaveformRegressor(BaseEstimator, RegressorMixin):
-    """ Regressor compatible with sk-learn package (or not really...) """
-    def __init__(self, A=None, projector=None, n_pulse=1, roi=None):
+
+class WaveformRegressor(object):
+    """ Regressor following the sk-learn conventions (fit, predict, score), without depending on it """
+    def __init__(self, A=None, projector=None, n_pulse=1, roi=None, support_tol=1e-2):
         """
         Args:
             A: Basis vectors of the subspace in matrix form (column vectors)
                 projector: projector on the subspace A
+            n_pulse: number of pulses in the basis
+            roi: roi of the waveforms
+            support_tol: samples where all the basis vectors of a pulse are smaller than support_tol 
+                times their maximum are considered outside of the pulse for the 'max' intensity. 
+                None takes the full waveform length for each pulse.
         
         Remarks:
             Because the basis A can be built artificially from non-orthogonal vectors, its projector is not necessarily 
@@ -139,7 +423,7 @@ class WaveformRegressor(BaseEstimator, RegressorMixin):
             Also, in order to facilitate the fit of multiple waveforms at once, both matrices are transposed. The projection 
             and reconstruction are calculated thus as coeffs=X.dot(T) and coeffs.dot(A) respectively.
             
-            The regressor is not fully compatible with sklearn unfortunately. This is because the basis and the projector 
+            The regressor is not compatible with sklearn estimators utilities. This is because the basis and the projector 
             are external parameters that the package does not know how to handle properly.
         
         Construct basis A and projector using the function 'get_basis_projector' or 'construct_2PulseProjector'
@@ -149,6 +433,116 @@ class WaveformRegressor(BaseEstimator, RegressorMixin):
         self.n_pulse_ = n_pulse
         if roi is None:
             self.roi=[0, 1e6]
+        else:
+            self.roi = list(roi)
+        self.support_tol = support_tol
+        self._make_pulse_operators()
+    
+    
+    def __getstate__(self):
+        """ The per-thread buffers are not pickled (e.g. when sent to a process pool) """
+        state = self.__dict__.copy()
+        state.pop('_local', None)
+        return state
+    
+    
+    def save(self, fname, **metadata):
+        """ Save the regressor (basis, projector, pulse operators, SVD) in a compressed .npz file, so 
+        that it can be loaded without recomputing the SVD.
+        
+        Inputs:
+            - fname: file name (.npz)
+            - metadata: json serializable information saved with the regressor (ROI, background 
+            settings, hash of the reference set, ...)
+        """
+        arrays = {
+            'A': self.A.T,
+            'projector': self.projector.T,
+            'pulse_idx': self.pulse_idx,
+            'pulse_ops': self.pulse_ops
+        }
+        svd = getattr(self, 'svd_', None)
+        if svd is not None:
+            arrays['svd_components'] = svd.components_
+            arrays['svd_singular_values'] = svd.singular_values_
+            arrays['svd_explained_variance'] = svd.explained_variance_
+            arrays['svd_explained_variance_ratio'] = svd.explained_variance_ratio_
+            metadata['svd_method'] = svd.method
+            metadata['svd_elapsed'] = svd.elapsed
+            if getattr(svd, 'mean_', None) is not None:
+                arrays['svd_mean'] = svd.mean_
+                metadata.update(svd_n_waveforms=svd.n_waveforms_, svd_total_variance=svd.total_variance_)
+        metadata.update(n_pulse=self.n_pulse_, roi=self.roi, support_tol=self.support_tol, 
+                        params=getattr(self, 'params_', {}))
+        np.savez_compressed(fname, metadata=json.dumps(metadata, default=_json_default), **arrays)
+        return
+    
+    
+    @classmethod
+    def load(cls, fname):
+        """ Load a regressor saved by save. The metadata are in the attribute metadata_. """
+        with np.load(fname) as f:
+            arrays = {key: f[key] for key in f.files}
+        metadata = json.loads(str(arrays.pop('metadata')))
+        regr = cls.__new__(cls)
+        regr.A = arrays['A'].T
+        regr.projector = arrays['projector'].T
+        regr.n_pulse_ = metadata['n_pulse']
+        regr.roi = metadata['roi']
+        regr.support_tol = metadata['support_tol']
+        regr.pulse_idx = arrays['pulse_idx']
+        regr.pulse_ops = arrays['pulse_ops']
+        regr.params_ = metadata['params']
+        if 'svd_components' in arrays:
+            regr.svd_ = SvdBasis(arrays['svd_components'], arrays['svd_singular_values'], None, 
+                                 method=metadata['svd_method'], elapsed=metadata['svd_elapsed'])
+            regr.svd_.explained_variance_ = arrays['svd_explained_variance']
+            regr.svd_.explained_variance_ratio_ = arrays['svd_explained_variance_ratio']
+            if 'svd_mean' in arrays: # not in the files saved before the moments were added
+                regr.svd_.mean_ = arrays['svd_mean']
+                regr.svd_.n_waveforms_ = metadata['svd_n_waveforms']
+                regr.svd_.total_variance_ = metadata['svd_total_variance']
+        regr.metadata_ = metadata
+        return regr
+    
+    
+    def _make_pulse_operators(self):
+        """ Precompute the per-pulse reconstruction operators, restricted to the support of each pulse.
+        pulse_ops[ii] is the basis of pulse ii, evaluated on the samples pulse_idx[ii]. The supports are 
+        padded to the same length (by repeating a sample of the support), so that the reconstruction of 
+        all pulses is a single batched product (see pulse_max_intensity).
+        """
+        nCoeff = int(self.A.shape[0]/self.n_pulse_)
+        supports = []
+        for ii in range(self.n_pulse_):
+            A_pulse = np.abs(self.A[ii*nCoeff:(ii+1)*nCoeff,:]).max(axis=0)
+            if self.support_tol is None or A_pulse.max()==0:
+                idx = np.arange(self.A.shape[1])
+            else:
+                idx = np.nonzero(A_pulse>=self.support_tol*A_pulse.max())[0]
+            supports.append(idx)
+        width = max([idx.size for idx in supports])
+        self.pulse_idx = np.asarray([np.pad(idx, (0, width-idx.size), mode='edge') for idx in supports])
+        self.pulse_ops = np.asarray([self.A[ii*nCoeff:(ii+1)*nCoeff, idx] for ii, idx in enumerate(self.pulse_idx)])
+        return
+    
+    
+    def pulse_max_intensity(self, coeffs=None, out=None, work=None):
+        """ Max of the reconstruction of each pulse, computed on the support of the pulses only.
+        Args:
+            coeffs: fitted coefficients (default: self.coeffs_)
+            out: optional output array (n_waveforms, n_pulse)
+            work: optional work array (n_pulse, n_waveforms, support width)
+        """
+        if coeffs is None:
+            coeffs = self.coeffs_
+        n = coeffs.shape[0]
+        coeffs = coeffs.reshape(n, self.n_pulse_, -1).transpose(1,0,2) # (n_pulse, n, nCoeff)
+        reconstructed = np.matmul(coeffs, self.pulse_ops, out=work) # (n_pulse, n, width)
+        if out is None:
+            return reconstructed.max(axis=2).T
+        reconstructed.max(axis=2, out=out.T)
+        return out
     
     
     def fit(self, X, y=None):
@@ -159,12 +553,8 @@ class WaveformRegressor(BaseEstimator, RegressorMixin):
             self.coeffs_ = np.zeros(self.A.shape[1])
             return self
         
-        if isinstance(self.projector, Ridge):
-            ridge = self.projector.fit(self.A, X)
-            coeffs = ridge.coef_
-        else:
-#             coeffs = self.projector.dot(X.T) # old way
-            coeffs = X.dot(self.projector)
+#         coeffs = self.projector.dot(X.T) # old way
+        coeffs = X.dot(self.projector)
         
         if len(X.shape)==1:
             self.coeffs_ = coeffs[None,:]
@@ -193,17 +583,37 @@ class WaveformRegressor(BaseEstimator, RegressorMixin):
         """ Returns the r2 score of the projected waveforms (one score value per waveform)
         Must have called fit(X) or fit_reconstruct(X) before.
         """
-        return r2_score(X.T, self.reconstruct().T, multioutput='raw_values')
-            # .T: hack so that the score of multiple waveforms is computed correctly
+        X = np.atleast_2d(X)
+        return fit_quality.r2(X, X-self.reconstruct())
     
     
     def pearsonr_coeff(self, X):
         """ Pearson correlation between the fit and the waveform X
         Must have called fit(X) or fit_reconstruct(X) before.
         """
-        if len(X.shape)==1:
-            X = X[None,:]
-        return np.asarray([pearsonr(xx, rr)[0] for xx, rr in zip(X, self.reconstruct())])
+        X = np.atleast_2d(X)
+        return fit_quality.fit_quality(X, X-self.reconstruct(), metrics=['pearson'])['pearson']
+    
+    
+    def quality(self, X, residual, metrics=fit_quality.METRICS, noise=None):
+        """ Fit quality metrics of the waveforms X (see fit_quality.py), from the residual of their fit 
+        (the fit is not recomputed).
+        
+        Inputs:
+            - waveform(s) X, as given to analyze
+            - residual: residual of the fit of X, from analyze(X, full_output=True)
+            - metrics: list of metrics ('r2', 'pearson', 'rms', 'chi2')
+            - noise: noise RMS of the samples, for chi2
+        Outputs:
+            - dictionary metric: array (one value per waveform)
+        """
+        X = np.atleast_2d(X)
+        residual = np.atleast_2d(residual)
+        if residual.shape!=X.shape:
+            raise ValueError('Residual of shape {} for waveforms of shape {}'.format(residual.shape, X.shape))
+        buf = self._get_buffers(X)
+        return fit_quality.fit_quality(X, residual, metrics=metrics, noise=noise, 
+                                       n_params=self.A.shape[0], work=buf['centered'])
     
     
     def fit_reconstruct(self, X, return_score=False):
@@ -217,31 +627,112 @@ class WaveformRegressor(BaseEstimator, RegressorMixin):
         """
         Inputs:
             - waveform X
-            - mode: 'norm' or 'max'. Return the norm of fitted coefficients or the max of each pulse
-                For multipulse basis it is recommended to use the 'max' method, as the basis may not be orthogonal.
+            - mode: 'norm', 'max' or 'both'. Return the norm of fitted coefficients or the max of each pulse
+                (or both). For multipulse basis it is recommended to use the 'max' method, as the basis may not be orthogonal.
         Ouputs:
             - intensities: individual pulse intensities
         """
+        if mode not in PULSE_INTENSITY_MODES:
+            raise ValueError('Intensity mode {} not supported, must be in {}'.format(mode, PULSE_INTENSITY_MODES))
         self.fit(X)
         nCoeff = int(self.coeffs_.shape[1]/self.n_pulse_)
-        intensities = np.zeros((self.coeffs_.shape[0],self.n_pulse_))
-        if mode=='both':
-            intensities_max = np.zeros((self.coeffs_.shape[0],self.n_pulse_))
-        for ii in range(self.n_pulse_):
-            coeffs = self.coeffs_[:,ii*nCoeff:(ii+1)*nCoeff]
-            if mode=='norm':
-                intensities[:,ii] = np.linalg.norm(coeffs, axis=1)
-            elif mode=='max':
-                reconstructed_single = coeffs.dot(self.A[ii*nCoeff:(ii+1)*nCoeff,:])
-                intensities[:,ii] = np.max(reconstructed_single, axis=1)
-            elif mode=='both':
-                intensities[:,ii] = np.linalg.norm(coeffs, axis=1)
-                reconstructed_single = coeffs.dot(self.A[ii*nCoeff:(ii+1)*nCoeff,:])
-                intensities_max[:,ii] = np.max(reconstructed_single, axis=1)
+        if mode in ['norm', 'both']:
+            coeffs = self.coeffs_.reshape(self.coeffs_.shape[0], self.n_pulse_, nCoeff)
+            intensities = np.linalg.norm(coeffs, axis=2)
+        if mode in ['max', 'both']:
+            intensities_max = self.pulse_max_intensity()
         
         if mode=='both':
             return intensities, intensities_max
+        elif mode=='max':
+            return intensities_max
         return intensities
+    
+    
+    def analyze(self, X, mode='max', full_output=False):
+        """ Single pass analysis of the waveform(s) X: the data are projected once and the reconstruction, 
+        the r2 score and the pulse intensities are all derived from the same coefficients.
+        Equivalent to fit_reconstruct(X, return_score=True) followed by get_pulse_intensity(X, mode), 
+        but without the second fit and the sklearn overhead.
+        
+        Inputs:
+            - waveform(s) X
+            - mode: 'norm', 'max' or 'both' (see get_pulse_intensity)
+            - full_output: also return the details of the fit
+        Outputs:
+            - reconstructed: fitted waveforms
+            - score: r2 score of each waveform
+            - intensities: individual pulse intensities (tuple (norm, max) if mode=='both')
+            - details (if full_output): dictionary with the fitted coefficients 'coeffs' and the 
+                residual X-reconstructed 'residual' (empty if the fit failed)
+        
+        Remark: the outputs are views on buffers preallocated for the calling thread. They are 
+        overwritten by the next call from the same thread, copy them if they must be kept.
+        """
+        if mode not in PULSE_INTENSITY_MODES:
+            raise ValueError('Intensity mode {} not supported, must be in {}'.format(mode, PULSE_INTENSITY_MODES))
+        if X.ndim==1:
+            X = X[None,:]
+        if X.shape[-1] != self.A.shape[1]:
+            print('Data and projector shapes dont match.')
+            self.coeffs_ = np.zeros((X.shape[0], self.A.shape[0]))
+            zeros = np.zeros((X.shape[0], self.n_pulse_))
+            out = None, np.zeros(X.shape[0]), (zeros, zeros) if mode=='both' else zeros
+            return out+({},) if full_output else out
+        
+        buf = self._get_buffers(X)
+        
+        """ (i) projection and reconstruction """
+        np.dot(X, self.projector, out=buf['coeffs'])
+        self.coeffs_ = buf['coeffs']
+        np.dot(buf['coeffs'], self.A, out=buf['reconstructed'])
+        
+        """ (ii) r2 score (same convention as sklearn r2_score), the residual is kept for quality """
+        np.subtract(X, buf['reconstructed'], out=buf['residual'])
+        score = fit_quality.r2(X, buf['residual'], out=buf['score'], work=buf['centered'])
+        
+        """ (iii) pulse intensities """
+        nCoeff = int(self.coeffs_.shape[1]/self.n_pulse_)
+        if mode in ['norm', 'both']:
+            coeffs = buf['coeffs'].reshape(X.shape[0], self.n_pulse_, nCoeff)
+            np.sqrt(np.einsum('ijk,ijk->ij', coeffs, coeffs), out=buf['intensities'])
+        if mode in ['max', 'both']:
+            self.pulse_max_intensity(buf['coeffs'], out=buf['intensities_max'], work=buf['pulses'])
+        
+        if mode=='both':
+            intensities = (buf['intensities'], buf['intensities_max'])
+        elif mode=='max':
+            intensities = buf['intensities_max']
+        else:
+            intensities = buf['intensities']
+        if full_output:
+            return buf['reconstructed'], score, intensities, {'coeffs': buf['coeffs'], 'residual': buf['residual']}
+        return buf['reconstructed'], score, intensities
+    
+    
+    def _get_buffers(self, X):
+        """ Working arrays for analyze, allocated once per thread and per input shape. """
+        try:
+            local = self._local
+        except AttributeError:
+            local = self._local = threading.local()
+        dtype = np.result_type(X.dtype, self.projector.dtype, self.A.dtype, np.float64)
+        key = (X.shape, dtype)
+        if getattr(local, 'key', None)!=key:
+            n, n_samples = X.shape
+            n_coeffs = self.A.shape[0]
+            local.buffers = {
+                'coeffs': np.empty((n, n_coeffs), dtype=dtype),
+                'reconstructed': np.empty((n, n_samples), dtype=dtype),
+                'residual': np.empty((n, n_samples), dtype=dtype),
+                'centered': np.empty((n, n_samples), dtype=dtype),
+                'pulses': np.empty((self.n_pulse_, n, self.pulse_idx.shape[1]), dtype=dtype),
+                'score': np.empty(n),
+                'intensities': np.empty((n, self.n_pulse_)),
+                'intensities_max': np.empty((n, self.n_pulse_), dtype=dtype)
+            }
+            local.key = key
+        return local.buffers
 
     
     
@@ -273,9 +764,6 @@ def construct_2PulseProjector(singlePulseBasis, delay=None, sampling=.125, metho
             P=A.dot(projector).dot(data)
         The coefficients projector onto the subspace A are:
             coeffs=projector.dot(data)
-        
-        Note: if method 'Ridge' is used, then a RidgeRegressor object is returned instead of a projector (matrix).
-        The function fitPulse will take care of handling this difference.
     """
     
     if delay is None:
@@ -297,11 +785,7 @@ def construct_2PulseProjector(singlePulseBasis, delay=None, sampling=.125, metho
         projector = np.transpose(np.linalg.inv(A.transpose().dot(Q))).dot(Q)
         return A, projector
     elif method=='Ridge':
-        if 'alpha' in kwargs:
-            alpha = kwargs.pop('alpha')
-        else:
-            alpha=0
-        projector = Ridge(alpha=alpha, fit_intercept=False) # is a RidgeRegressor instance, not a matrix
+        projector = regularized_projector(A, alpha=kwargs.get('alpha', 0))
         return A, projector
     else:
         raise NameError('Method not implemented')
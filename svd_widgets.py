@@ -1,25 +1,25 @@
 import numpy as np
 import sys
 from epics import PV
-import matplotlib.pyplot as plt
 from datetime import datetime
 
 from PyQt5.QtCore import QObject, pyqtSlot, pyqtSignal, QTimer, QThread, QThreadPool, QRunnable
 from PyQt5.QtWidgets import QFileDialog
-from PyQt5.uic import loadUiType
+from ui_cache import loadUiType
 import pyqtgraph as pg
-import pydm
 
 import config
 import utils
-from workers import GetWfWorker
+from workers import GetWfWorker, Worker, WorkerSignal_object
+from shots import get_x
+from display import DecimatedCurve
+from acquisition import MonitorAcquisition, drain_shots
+from scheduling import StageScheduler
 
 import svd_waveform_processing as proc
-
-# test data
-fdata = config.TEST_DATA_FILE
-test_data = np.loadtxt(fdata, delimiter=',')
-
+import refstore
+import basis_cache
+import delay_bank
 
 # UIs
 Ui_waveformGraph, QWaveformGraph = loadUiType('waveformGraph.ui')
@@ -28,6 +28,7 @@ Ui_stripchart, QStripchart = loadUiType('stripchart.ui')
 
 class WaveformGraphWidget(QWaveformGraph, Ui_waveformGraph):
     newBkgSignal = pyqtSignal()
+    newShotSignal = pyqtSignal()
     def __init__(self, parent=None):
         """ Notes:
         Needs a newDataSignal to be defined from the parent using self.connect_attr
@@ -40,17 +41,22 @@ class WaveformGraphWidget(QWaveformGraph, Ui_waveformGraph):
         except AttributeError:
             self.threadpool = QThreadPool(maxThreadCount=4)
             print('Threadpool with {} threads started.'.format(self.threadpool.maxThreadCount()))
+        self.scheduler = StageScheduler(self.threadpool, name='acquisition', **config.SCHEDULING['acquisition'])
         
         # epics PV setup
         self.pv = PV(config.DEFAULT_CHANNEL)
         self.channelEdit.setText(config.DEFAULT_CHANNEL)
         self.channelEdit.returnPressed.connect(self.change_pv)
+        self.acquisition = None # monitor acquisition, see start_monitor
+        self.newShotSignal.connect(self.process_queue)
 
         # graph (using remote lead to problems with QObjects (cant be pickled))
         self.wfPlot = pg.PlotWidget()
         self.pgLayout.addWidget(self.wfPlot)
         self.wfCurve = utils.initialize_line_plot(self.wfPlot, color=config.COLORS[0])
         self.wfFit = utils.initialize_line_plot(self.wfPlot, color=config.COLORS[1])
+        self.curves = [DecimatedCurve(self.wfCurve, self.wfPlot.getViewBox()),
+                       DecimatedCurve(self.wfFit, self.wfPlot.getViewBox())]
         # self.view = pg.widgets.RemoteGraphicsView.RemoteGraphicsView()
         # self.wfPlot = self.view.pg.PlotItem()
         # self.pgLayout.addWidget(self.view)
@@ -70,9 +76,48 @@ class WaveformGraphWidget(QWaveformGraph, Ui_waveformGraph):
     
     @pyqtSlot()
     def change_pv(self):
+        monitor = self.acquisition is not None
+        self.stop_monitor()
         self.pv = PV(self.channelEdit.text())
+        if monitor:
+            self.start_monitor()
+        return
+    
+    def start_monitor(self):
+        """ Monitor-driven acquisition: each PV update is queued (CA thread) and processed by 
+        process_queue. Replaces the get_data timer.
+        """
+        self.acquisition = MonitorAcquisition(self.pv, maxlen=config.QUEUE_SIZE, notify=self.newShotSignal.emit)
+        self.acquisition.start()
+        print('Monitor acquisition started on {}.'.format(self.pv.pvname))
+        return
+    
+    def stop_monitor(self):
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            self.acquisition = None
+        return
+    
+    @pyqtSlot()
+    def process_queue(self):
+        if self.acquisition is None:
+            return
+        for d in drain_shots(self.acquisition.queue, bkg_fun=self.bkg_fun):
+            self.newDataSignal.signal.emit(d)
         return
     
+    def get_counters(self):
+        """ Shot counters of the acquisition stage """
+        if self.acquisition is not None:
+            queue = self.acquisition.queue
+            return {
+                'received': queue.n_received,
+                'analyzed': queue.n_received-queue.n_dropped-len(queue),
+                'dropped': queue.n_dropped,
+                'depth': len(queue)
+            }
+        return self.scheduler.get_counters()
+    
     @pyqtSlot()
     def get_roi(self):
         self.roi = np.round(self.lr.getRegion()).astype(int)
@@ -81,7 +126,7 @@ class WaveformGraphWidget(QWaveformGraph, Ui_waveformGraph):
     @pyqtSlot()
     def get_data(self):
         self.worker = GetWfWorker(self.pv, bkg_fun=self.bkg_fun, signal=self.newDataSignal)
-        self.threadpool.tryStart(self.worker) # skip (no queuing) if no thread available (if rate is too high)
+        self.scheduler.submit(self.worker) # skip or queue if no thread available (if rate is too high), see config.SCHEDULING
         # self.worker.signals.signal.connect(self.display_data)
         return
     
@@ -90,21 +135,29 @@ class WaveformGraphWidget(QWaveformGraph, Ui_waveformGraph):
         data = data_dict['data']
         fit = data_dict['fit']
         # print(data.shape)
-        self.wfCurve.setData(data[0],data[1])
+        self.curves[0].setData(data[0],data[1])
         # self.wfPlot.plot(data[0],data[1], clear=True)
         if fit is not None:
-            self.wfFit.setData(fit[0], fit[1])
+            self.curves[1].setData(fit[0], fit[1])
+        self.render()
+        return
+    
+    def render(self):
+        """ Draw the curves (decimated to the visible range) that changed since the last draw """
+        for curve in self.curves:
+            curve.render()
         return
 
     @pyqtSlot()
     def new_bkg(self):
         bkg_idx = int(self.bkgEdit.text())
         if (bkg_idx<=0) or (bkg_idx is None):
-            self.bkg_fun = lambda wf: 0
+            self.bkg_fun = None
             print('Background subtraction removed.')
         else:
-            self.bkg_fun = lambda wf: utils.background(wf, bkg_idx=bkg_idx)
-            print('Background subtraction updated.')
+            self.bkg_fun = utils.Background(bkg_idx=bkg_idx, method=config.BKG_METHOD, 
+                                            trim=config.BKG_TRIM, alpha=config.BKG_PEDESTAL_ALPHA)
+            print('Background subtraction updated ({}).'.format(config.BKG_METHOD))
         self.newBkgSignal.emit()
         return
 
@@ -112,19 +165,30 @@ class WaveformGraphWidget(QWaveformGraph, Ui_waveformGraph):
 
 class RegressorWidget(QRegressor, Ui_regressor):
     newRegressorSignal = pyqtSignal(int)
+    updatedRegressorSignal = pyqtSignal() # online basis update: same number of pulses, running averages kept
     def __init__(self, parent=None):
         super(RegressorWidget, self).__init__(parent=parent)
         self.setupUi(self)
         
         self.graph = None # to be connected in main
         self.regressor = None
-        self.ref_wfs = test_data*config.POLARITY
+        self.online = None # online basis update, see config.ONLINE_BASIS
+        self.ref_wfs = None # raw reference waveforms (polarity applied in make_regressor). Test data if None.
+        self.ref_metadata = {}
+        self.ref_hash = None # (ref_wfs, hash) of the last hashed reference set
+        self.basisCache = basis_cache.BasisCache() if config.BASIS_CACHE else None
         
         # plot
         self.basisPlot = self.basisCanvas.addPlot()
         self.basisPlot.addLegend(offset=(60,5))
         
         # connections
+        self.newRegressorBuilt = WorkerSignal_object()
+        self.newRegressorBuilt.signal.connect(self.set_regressor)
+        self.newCachedRegressor = WorkerSignal_object()
+        self.newCachedRegressor.signal.connect(self.set_cached_regressor)
+        self.newOnlineRegressor = WorkerSignal_object()
+        self.newOnlineRegressor.signal.connect(self.swap_regressor)
         self.setRegressor.clicked.connect(self.make_regressor)
         self.newrefs.clicked.connect(self.save_data)
         self.basisfile.clicked.connect(self.load_basis_file)
@@ -144,33 +208,130 @@ class RegressorWidget(QRegressor, Ui_regressor):
             delay = list(map(int, delay.split(',')))
         except (TypeError, ValueError):
             delay = None
-        ref_wfs = self.ref_wfs.copy()
-    
-        if self.graph.bkg_fun is not None:
-            bkg = np.asarray([self.graph.bkg_fun(wf) for wf in ref_wfs])
-            ref_wfs = (self.ref_wfs.T-bkg).T
         if roi is None:
             print('Roi not defined, entire waveform taken.')
+        if self.ref_wfs is None:
+            self.ref_wfs, self.ref_metadata = refstore.load_reference_set(config.TEST_DATA_FILE)
+            print('Test reference waveforms loaded.')
+        kwargs = {'n_components': self.n_c, 'n_pulse': self.n_p, 'delay': delay, 
+                  'method': config.PROJECTOR_METHOD, 'alpha': config.RIDGE_ALPHA}
+        delay_ranges = delay_bank.parse_delay_scan(self.delay_txt.text())
+        if delay_ranges is not None:
+            # delay scan (e.g. '20:80' or '20:80:2, 40:100'): the best delays are fitted for each shot
+            ref_wfs, svd_method = self._reference_view(roi)
+            self.worker = Worker(
+                target=delay_bank.construct_delayScanRegressor,
+                args=(ref_wfs,),
+                kwargs={'n_components': self.n_c, 'delay_ranges': delay_ranges, 'per': config.DELAY_SCAN_PER, 
+                        'svd_method': svd_method},
+                signal=self.newRegressorBuilt
+                )
+        elif self.basisCache is not None:
+            # the regressor is reused if it was already built with the same references and parameters
+            ref_hash = self.ref_hash if self.ref_hash is not None and self.ref_hash[0] is self.ref_wfs else None
+            self.worker = Worker(
+                target=self._cached_regressor,
+                args=(self.ref_wfs, ref_hash, roi, self.graph.bkg_fun),
+                kwargs=kwargs,
+                signal=self.newCachedRegressor
+                )
         else:
-            ref_wfs = ref_wfs[:,roi[0]:roi[1]]
-        regr = proc.construct_waveformRegressor(
-                                            ref_wfs, 
-                                            n_components=self.n_c, 
-                                            n_pulse=self.n_p, 
-                                            delay=delay
-                                            )
+            ref_wfs, svd_method = self._reference_view(roi)
+            # the SVD runs in the threadpool, the GUI and the analysis are not stalled
+            self.worker = Worker(
+                target=proc.construct_waveformRegressor,
+                args=(ref_wfs,),
+                kwargs=dict(kwargs, svd_method=svd_method, roi=roi),
+                signal=self.newRegressorBuilt
+                )
+        self.graph.threadpool.start(self.worker)
+        print('Building regressor...')
+        return
+    
+    def _reference_view(self, roi):
+        """ Reference waveforms prepared as the live waveforms, and SVD method suited to their number """
+        ref_wfs = refstore.WaveformView(self.ref_wfs, polarity=config.POLARITY, bkg_fun=self.graph.bkg_fun, roi=roi)
+        if len(ref_wfs)>config.REF_CHUNK_SIZE:
+            return ref_wfs, 'incremental' # large (memory-mapped) set: processed by chunks
+        return np.asarray(ref_wfs), config.SVD_METHOD
+    
+    def _cached_regressor(self, ref_wfs, ref_hash, roi, bkg_fun, **kwargs):
+        """ Regressor from the cache (runs in the threadpool). The reference set is hashed if ref_hash 
+        is None. Returns the regressor and (ref_wfs, hash), kept in ref_hash by set_cached_regressor 
+        (GUI thread) so that the hash is computed once.
+        """
+        if ref_hash is None:
+            ref_hash = (ref_wfs, basis_cache.hash_waveforms(ref_wfs))
+        return self.basisCache.get_regressor(ref_wfs, ref_hash=ref_hash[1], roi=roi, bkg_fun=bkg_fun, **kwargs), ref_hash
+    
+    @pyqtSlot(object)
+    def set_cached_regressor(self, result):
+        regr, self.ref_hash = result
+        self.set_regressor(regr)
+        return
+    
+    @pyqtSlot(object)
+    def set_regressor(self, regr):
         self.regressor = regr
         self.show_basis()
         self.newRegressorSignal.emit(regr.n_pulse_)
         print('Regressor updated. Shape of basis: {}.'.format(regr.A.shape))
+        if config.ONLINE_BASIS:
+            if regr.n_pulse_==1:
+                self.online = proc.OnlineBasis(regr, forget=config.ONLINE_FORGET, 
+                                               min_score=config.ONLINE_MIN_SCORE, batch_size=config.ONLINE_BATCH)
+                print('Online basis update enabled.')
+            else:
+                self.online = None
+                print('Online basis update only available for single pulse regressors.')
+        return
+    
+    @pyqtSlot(object)
+    def swap_regressor(self, update):
+        """ Swap in the online updated regressor (passed to the engine by updatedRegressorSignal). The 
+        running averages are not reset. Updates of a previous regressor (still running when a new 
+        regressor was set) are ignored.
+        """
+        online, regr = update
+        if online is not self.online:
+            print('Online update of a previous regressor ignored.')
+            return
+        self.regressor = regr
+        self.updatedRegressorSignal.emit()
+        return
+    
+    @staticmethod
+    def _online_update(online):
+        """ Runs in the threadpool. Returns the updated regressor with its source. """
+        return online, online.update()
+    
+    @pyqtSlot(dict)
+    def online_update(self, data_dict):
+        if self.online is None or data_dict['fit'] is None:
+            return
+        roi = self.graph.get_roi()
+        wf = data_dict['data'][1][roi[0]:roi[1]]*config.POLARITY
+        if self.online.add(wf, score=data_dict['score']):
+            self.onlineWorker = Worker(target=self._online_update, args=(self.online,), signal=self.newOnlineRegressor)
+            self.graph.threadpool.start(self.onlineWorker)
+        return
+    
+    @pyqtSlot(list)
+    def online_update_batch(self, data_list):
+        for data_dict in data_list:
+            self.online_update(data_dict)
         return
     
     def show_basis(self):
         A = self.regressor.A
         self.basisPlot.clear()
         basisData = []
-        cmap = plt.cm.viridis(np.linspace(0.25,0.95,A.shape[0]))*255 # mpl is 0-1, pg is 0-255
-        cmap = cmap.astype(int)
+        try:
+            cmap = pg.colormap.get('viridis').map(np.linspace(0.25,0.95,A.shape[0]), mode='byte').astype(int)
+        except AttributeError: # older pyqtgraph, use matplotlib (imported here to not slow down the startup)
+            from matplotlib import cm
+            cmap = cm.viridis(np.linspace(0.25,0.95,A.shape[0]))*255 # mpl is 0-1, pg is 0-255
+            cmap = cmap.astype(int)
         for ii, a in enumerate(A):
             basisData.append(self.basisPlot.plot(a/2**ii, pen=pg.mkPen(color=cmap[ii], width=1),
                                                  name='base {}'.format(ii)))
@@ -180,21 +341,25 @@ class RegressorWidget(QRegressor, Ui_regressor):
     def save_data(self):
         print('Start saving new set of reference waveforms...')
         self._save_count = 0
-        self._to_be_saved = []
+        self._writer = None
         self.graph.newDataSignal.signal.connect(self._save_data)
         return
     
-    @pyqtSlot(np.ndarray)
+    @pyqtSlot(object)
     def _save_data(self, data):
-        self._to_be_saved.append(data[1])
+        if self._writer is None:
+            fname = './refs/refs_{}.npy'.format(datetime.now().isoformat().replace(':','_')[:-7])
+            self._writer = refstore.ReferenceWriter(
+                fname, data.shape[1], capacity=config.SAVE_NUMBER, dtype=data.dtype, flush_every=config.REF_FLUSH_EVERY,
+                pv=self.graph.pv.pvname, roi=[int(r) for r in self.graph.get_roi()], 
+                bkg_idx=int(self.graph.bkgEdit.text()), polarity=config.POLARITY)
+        self._writer.append(data[1])
         self._save_count+=1
         if self._save_count>=config.SAVE_NUMBER:
             self.graph.newDataSignal.signal.disconnect(self._save_data)
-            to_be_saved = np.asarray(self._to_be_saved)
-            fname = './refs/refs_{}.npy'.format(datetime.now().isoformat().replace(':','_')[:-7])
-            np.save(fname, to_be_saved)
-            self._to_be_saved = None
-            print('{} reference waveforms saved to {}.'.format(self._save_count,fname))
+            self._writer.close()
+            print('{} reference waveforms saved to {}.'.format(self._save_count,self._writer.fname))
+            self._writer = None
         return
 
     @pyqtSlot()
@@ -206,8 +371,13 @@ class RegressorWidget(QRegressor, Ui_regressor):
 		
         if dlg.exec_():
             filename = dlg.selectedFiles()
-            self.ref_wfs = np.load(filename[0])*config.POLARITY
-            print('Reference waveforms loaded.')
+            if filename[0].endswith('.npz'): # saved regressor
+                self.basisfileEdit.setText(filename[0])
+                self.set_regressor(proc.WaveformRegressor.load(filename[0]))
+                return
+            self.ref_wfs, self.ref_metadata = refstore.load_reference_set(filename[0])
+            self.basisfileEdit.setText(filename[0])
+            print('{} reference waveforms loaded. {}'.format(len(self.ref_wfs), self.ref_metadata))
         return
 
 
@@ -254,9 +424,8 @@ class StripchartsView(Ui_stripchart, QStripchart):
         self.stripchartsData = []
         for ii,n in enumerate(N):
             for jj in range(n):
-                self.stripchartsData.append(
-                    utils.initialize_line_plot(self.stripcharts[ii], config.COLORS[jj])
-                    )
+                item = utils.initialize_line_plot(self.stripcharts[ii], config.COLORS[jj])
+                self.stripchartsData.append(DecimatedCurve(item, self.stripcharts[ii].getViewBox()))
         return
 
     def clear_stripcharts(self):
@@ -266,9 +435,22 @@ class StripchartsView(Ui_stripchart, QStripchart):
         return
 
     
-    def update(self, stripchartsData):
-        for data, dataObj in zip(stripchartsData, self.stripchartsData):
-            dataObj.setData(data)
+    def update(self, stripchartsData, versions=None):
+        """ Args:
+            stripchartsData: list of the time series of each curve
+            versions: list of the version of each time series (curves with unchanged version are not redrawn)
+        """
+        if versions is None:
+            versions = [None]*len(stripchartsData)
+        for data, version, curve in zip(stripchartsData, versions, self.stripchartsData):
+            if version is None or version!=curve._version:
+                curve.setData(get_x(len(data)), data, version=version)
+        self.render()
+        return
+    
+    def render(self):
+        for curve in getattr(self, 'stripchartsData', []):
+            curve.render()
         return
 
     def update_test(self):
@@ -283,17 +465,21 @@ class StripchartsView(Ui_stripchart, QStripchart):
         self.stripchartsData[2].setData(data)
         # self.stripchartsData[3].setData(data1)
         # data = [data]
+        self.render()
         return
 
 
 class Svd_stripchart(QObject):
-    """ Class to handle running average of svd fit results.
+    """ Class to display the running averages of svd fit results.
     Needs a two stripcharts view.
     In the first stripchart holds the score stripchart and the second 
     stripchart the pulses intensities.
+    The running averages are those of the analysis engine the fit results are dispatched to 
+    (engine.AnalysisEngine.dispatch).
     """
-    def __init__(self, n=0, ts_len=1000, alpha=None, n_pulse=1, stripchartsView=None):
+    def __init__(self, engine, n=0, ts_len=1000, alpha=None, n_pulse=1, stripchartsView=None):
         super(Svd_stripchart, self).__init__()
+        self.engine = engine
         self.n = n
         self.ts_len = ts_len
         self.alpha = alpha
@@ -319,38 +505,36 @@ class Svd_stripchart(QObject):
     
     @pyqtSlot(int)
     def make_ravgs(self, n_pulse):
-        """ Instantiate running averages
+        """ Instantiate running averages (in the engine)
         """
         self.n_pulse = n_pulse
-        self.ravg_score = utils.RunningAverage(self.n, self.ts_len, alpha=self.alpha)
-        self.ravg_int = []
-        for ii in range(n_pulse):
-            self.ravg_int.append(utils.RunningAverage(self.n, self.ts_len, alpha=self.alpha))
+        self.engine.n, self.engine.ts_len, self.engine.alpha = self.n, self.ts_len, self.alpha
+        self.engine.reset_ravgs(n_pulse)
         self.stripchartsView.make_stripchartsData((1,len(self.ravg_int)))
         self._ravg_ready = True
         print('Stripchart 1: fit score\nStripchart 2: {} pulses intensities'.format(self.n_pulse))
         return
     
-    @pyqtSlot(dict)
-    def update_ravgs(self, data_dict):
-        if not self._ravg_ready:
-            return
-        # print(data_dict['intensity'])
-        self.ravg_score.update_ravg_ts(data_dict['score'])
-        for ii,ravg in enumerate(self.ravg_int):
-            ravg.update_ravg_ts(data_dict['intensity'][ii])
-        return
+    @property
+    def ravg_score(self):
+        return self.engine.ravgs['score']
+    
+    @property
+    def ravg_int(self):
+        return self.engine.ravgs['intensity']
     
     @pyqtSlot(dict)
     def update_stripchartsView(self, data_dict):
         if not self._ravg_ready:
             return
         data = self.get_stripchartsData()
-        self.stripchartsView.update(data)
+        versions = [self.ravg_score.version]+[ravg.version for ravg in self.ravg_int]
+        self.stripchartsView.update(data, versions=versions)
         return
     
     def get_stripchartsData(self):
-        data = [self.ravg_score.ravg_ts]
+        """ Time series of the running averages, views on their buffers (redrawn at each update) """
+        data = [self.ravg_score.ravg_ts_view]
         for ii,ravg in enumerate(self.ravg_int):
-            data.append(ravg.ravg_ts)
+            data.append(ravg.ravg_ts_view)
         return data
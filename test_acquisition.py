@@ -0,0 +1,74 @@
+import numpy as np
+
+import utils
+from acquisition import MonitorAcquisition, FakePV, PULSEID_MASK, drain_shots, get_pulse_id
+
+
+"""
+Tests of the monitor acquisition: FakePV -> MonitorAcquisition (ShotQueue) -> shots, drained by
+drain_shots as in WaveformGraphWidget.process_queue.
+
+Usage:
+    python -m pytest -q test_acquisition.py
+"""
+
+
+def make_pv(n=20, n_samples=50):
+    """ Fake PV whose i-th waveform is a pedestal of 10 plus a step of height i after sample 10 """
+    waveforms = np.full((n, n_samples), 10.)
+    waveforms[:,10:] += np.arange(n)[:,None]
+    return FakePV(waveforms)
+
+
+def test_order_and_metadata():
+    pv = make_pv()
+    acquisition = MonitorAcquisition(pv, maxlen=100)
+    acquisition.start()
+    for ii in range(10):
+        pv.publish()
+    shot_list = drain_shots(acquisition.queue, bkg_fun=utils.Background(bkg_idx=10, method='mean'))
+    assert len(shot_list) == 10
+    for ii, shot in enumerate(shot_list):
+        assert np.allclose(shot.y[:10], 0) # background subtracted
+        assert np.allclose(shot.y[10:], ii) # one shot per publish, in order
+    pulse_ids = [shot.pulse_id for shot in shot_list]
+    assert pulse_ids == list(range(1, 11)) # from the nanoseconds of the timestamp
+    timestamps = [shot.timestamp for shot in shot_list]
+    assert timestamps == sorted(timestamps)
+    assert acquisition.queue.n_received == 10
+    assert acquisition.queue.n_dropped == 0
+    assert len(acquisition.queue) == 0
+
+
+def test_drop_oldest_when_full():
+    pv = make_pv()
+    acquisition = MonitorAcquisition(pv, maxlen=5)
+    acquisition.start()
+    for ii in range(12):
+        pv.publish()
+    assert acquisition.queue.n_received == 12
+    assert acquisition.queue.n_dropped == 7
+    shot_list = drain_shots(acquisition.queue)
+    assert [shot.pulse_id for shot in shot_list] == list(range(8, 13)) # the last 5 shots, oldest first
+    assert [shot.y[-1]-10 for shot in shot_list] == list(range(7, 12))
+
+
+def test_notify_and_stop():
+    pv = make_pv()
+    calls = []
+    acquisition = MonitorAcquisition(pv, maxlen=100, notify=lambda: calls.append(len(acquisition.queue)))
+    acquisition.start()
+    for ii in range(3):
+        pv.publish()
+    assert calls == [1, 2, 3] # notified after each shot is queued
+    acquisition.stop()
+    pv.publish()
+    assert len(calls) == 3
+    assert acquisition.queue.n_received == 3
+
+
+def test_pulse_id():
+    assert get_pulse_id(None) is None
+    assert get_pulse_id(123) == 123
+    assert get_pulse_id((5 << 17) | 42) == 42
+    assert get_pulse_id(PULSEID_MASK+1) == 0
@@ -0,0 +1,39 @@
+import importlib
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+from PyQt5 import QtWidgets
+
+
+"""
+Drop-in replacement of PyQt5.uic.loadUiType with a cache of the compiled UI.
+The .ui file is compiled to python once (in __uicache__, next to the .ui file) and the compiled
+module is imported at the next startups, unless the .ui file is newer.
+"""
+
+CACHE_DIR = '__uicache__'
+
+
+def _base_class(fname):
+    """ Qt class of the top widget of the .ui file """
+    root = ET.parse(fname).getroot()
+    return getattr(QtWidgets, root.find('widget').get('class'))
+
+
+def loadUiType(fname):
+    """ Returns the form class and the base class of the .ui file (same as PyQt5.uic.loadUiType) """
+    fname = os.path.abspath(fname)
+    directory = os.path.join(os.path.dirname(fname), CACHE_DIR)
+    modname = os.path.splitext(os.path.basename(fname))[0]+'_ui'
+    compiled = os.path.join(directory, modname+'.py')
+    if not os.path.exists(compiled) or os.path.getmtime(compiled)<os.path.getmtime(fname):
+        from PyQt5 import uic
+        os.makedirs(directory, exist_ok=True)
+        with open(compiled, 'w') as f:
+            uic.compileUi(fname, f, from_imports=False)
+    if directory not in sys.path:
+        sys.path.append(directory)
+    module = importlib.import_module(modname)
+    form_class = [getattr(module, name) for name in dir(module) if name.startswith('Ui_')][0]
+    return form_class, _base_class(fname)
@@ -1,7 +1,7 @@
 import numpy as np
 from collections import deque
-from PyQt5.QtCore import QObject, pyqtSignal, QRunnable
-import pyqtgraph as pg
+import threading
+import time
 
 
 """
@@ -31,9 +31,133 @@ def background(signal, bkg_idx=100):
     return np.median(signal[0:bkg_idx])
 
 
+def _ewa_operator(alpha, size):
+    """ Lower triangular operator of the exponential average over size points: W[k,j] = alpha*(1-alpha)^(k-j) """
+    k = np.arange(size)
+    powers = np.subtract.outer(k, k)
+    return np.where(powers>=0, alpha*(1-alpha)**np.clip(powers, 0, None), 0.)
+
+
+def exponential_average(x, alpha, y0=0., block=64):
+    """
+    Vectorized exponential average y_k = alpha*x_k + (1-alpha)*y_(k-1), starting from y0.
+    Computed by blocks with a small triangular operator (numerically stable, no scipy needed).
+    """
+    x = np.ravel(np.asarray(x, dtype=float))
+    y = np.empty_like(x)
+    W = _ewa_operator(alpha, min(block, x.size))
+    decay = (1-alpha)**np.arange(1, W.shape[0]+1)
+    for ii in range(0, x.size, block):
+        xb = x[ii:ii+block]
+        n = xb.size
+        y[ii:ii+n] = W[:n,:n].dot(xb) + decay[:n]*y0
+        y0 = y[ii+n-1]
+    return y
+
+
+BKG_METHODS = ['median', 'mean', 'trimmed', 'pedestal']
+
+
+def background_batch(signals, bkg_idx=100, method='median', trim=0.1):
+    """
+    Return the background value of each waveform of a 2D array (vectorized)
+    Args:
+        signals: waveforms (n_waveforms, n_samples)
+        bkg_idx: the background is estimated on the first bkg_idx samples
+        method: 'median', 'mean' or 'trimmed' (mean without the trim fraction of lowest and highest samples)
+        trim: trimmed fraction on each side for the 'trimmed' method
+    """
+    window = np.atleast_2d(signals)[:,0:bkg_idx]
+    if method=='median':
+        return np.median(window, axis=1)
+    elif method=='mean':
+        return window.mean(axis=1)
+    elif method=='trimmed':
+        k = int(trim*window.shape[1])
+        if k==0:
+            return window.mean(axis=1)
+        return np.sort(window, axis=1)[:,k:window.shape[1]-k].mean(axis=1)
+    else:
+        raise NameError('Background method {} not implemented'.format(method))
+
+
+class Background(object):
+    """
+    Background estimator, to be used as bkg_fun. Works on single waveforms (returns a value) or on 2D
+    arrays of waveforms (returns one value per waveform).
+    
+    The 'pedestal' method estimates the background across shots: the mean of the background window is
+    averaged exponentially over the shots (weight alpha for the new shot), which is cheaper and less
+    noisy than a shot by shot median.
+    """
+    def __init__(self, bkg_idx=100, method='median', trim=0.1, alpha=0.01):
+        if method not in BKG_METHODS:
+            raise NameError('Background method {} not implemented'.format(method))
+        self.bkg_idx = bkg_idx
+        self.method = method
+        self.trim = trim
+        self.alpha = alpha
+        self.pedestal = None
+        self._lock = threading.Lock()
+        return
+
+    def __call__(self, signals):
+        bkg = self.update(np.atleast_2d(signals))
+        if np.ndim(signals)==1:
+            return bkg[0]
+        return bkg
+
+    def update(self, signals):
+        """ Background of each waveform, updating the running pedestal if needed """
+        if self.method!='pedestal':
+            return background_batch(signals, bkg_idx=self.bkg_idx, method=self.method, trim=self.trim)
+        means = signals[:,0:self.bkg_idx].mean(axis=1)
+        with self._lock:
+            pedestal = means[0] if self.pedestal is None else self.pedestal
+            bkg = exponential_average(means, self.alpha, y0=pedestal)
+            self.pedestal = bkg[-1]
+        return bkg
+
+    def estimate(self, signals):
+        """ Background of each waveform of a set (e.g. reference set), without changing the running pedestal.
+        For the 'pedestal' method, the pedestal of the set is the mean of the background window over all waveforms.
+        """
+        signals = np.atleast_2d(signals)
+        if self.method!='pedestal':
+            return background_batch(signals, bkg_idx=self.bkg_idx, method=self.method, trim=self.trim)
+        return np.full(signals.shape[0], signals[:,0:self.bkg_idx].mean())
+
+
+class StartupTimer(object):
+    """
+    Timing report of the startup steps
+    """
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.marks = []
+        return
+
+    def mark(self, label):
+        self.marks.append((label, time.perf_counter()))
+        return
+
+    def report(self):
+        t_prev = self.t0
+        lines = []
+        for label, t in self.marks:
+            lines.append('  {:<30s}{:8.3f} s'.format(label, t-t_prev))
+            t_prev = t
+        lines.append('  {:<30s}{:8.3f} s'.format('total', t_prev-self.t0))
+        return 'Startup time:\n'+'\n'.join(lines)
+
+
 class RunningAverage(object):
     """
     Class to handle a running average of data and a time series of the running average
+    
+    The time series is stored in a preallocated circular buffer. The buffer is written twice (at
+    index i and i+ts_len), so that the ordered time series is always a contiguous slice of the buffer
+    (updates are O(1), reading it needs no copy, see ravg_ts_view).
     """
     def __init__(self, n, ts_len, alpha=None):
         """
@@ -46,8 +170,33 @@ class RunningAverage(object):
         self.ts_len = ts_len
         self.alpha = alpha
         self.ravg = 0
-        self.ravg_ts = np.array([])
+        self._buffer = np.zeros(2*ts_len)
+        self._idx = 0 # next write position in [0, ts_len)
+        self._count = 0 # number of valid points in the time series
+        self.version = 0 # incremented at each update (to know if the time series changed)
         return
+    
+    @property
+    def ravg_ts(self):
+        """ Ordered time series of the running average (oldest first), a copy not modified by the next updates """
+        return self.ravg_ts_view.copy()
+    
+    @property
+    def ravg_ts_view(self):
+        """ Same as ravg_ts without copy: read-only view of the buffer, only valid until the next update 
+        (for plotting, redrawn at each update, see version).
+        """
+        start = self._idx + self.ts_len - self._count
+        view = self._buffer[start:start+self._count]
+        view.flags.writeable = False
+        return view
+    
+    @property
+    def _alpha(self):
+        """ Weight of the new data point (the linear average is an exponential average with 1/(n+1)) """
+        if self.alpha is None:
+            return 1/(self.n+1)
+        return self.alpha
 
     def update_ravg(self, newDataPoint):
         """
@@ -65,9 +214,34 @@ class RunningAverage(object):
         needx: in case dummy x coordinates are needed for plotting
         """
         self.update_ravg(newDataPoint)
-        self.ravg_ts = np.append(self.ravg_ts, self.ravg)
-        if self.ravg_ts.shape[0]>self.ts_len:
-            self.ravg_ts = self.ravg_ts[-self.ts_len:]
+        if self.ts_len>0:
+            value = np.asarray(self.ravg).item()
+            self._buffer[self._idx] = value
+            self._buffer[self._idx+self.ts_len] = value
+            self._idx = (self._idx+1)%self.ts_len
+            self._count = min(self._count+1, self.ts_len)
+        self.version+=1
+        if needx:
+            self.ravg_tsx = np.arange(self._count)
+        return
+    
+    def update_ravg_ts_batch(self, newDataPoints, needx=False):
+        """
+        Same as update_ravg_ts for an array of consecutive data points, vectorized.
+        """
+        x = np.ravel(np.asarray(newDataPoints, dtype=float))
+        if x.size==0:
+            return
+        ravgs = exponential_average(x, self._alpha, y0=np.asarray(self.ravg, dtype=float).item())
+        self.ravg = ravgs[-1]
+        if self.ts_len>0:
+            ravgs = ravgs[-self.ts_len:]
+            idx = (self._idx + np.arange(ravgs.size))%self.ts_len
+            self._buffer[idx] = ravgs
+            self._buffer[idx+self.ts_len] = ravgs
+            self._idx = (self._idx+ravgs.size)%self.ts_len
+            self._count = min(self._count+ravgs.size, self.ts_len)
+        self.version+=1
         if needx:
-            self.ravg_tsx = np.arange(self.ravg_ts.size)
-        return
\ No newline at end of file
+            self.ravg_tsx = np.arange(self._count)
+        return
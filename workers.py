@@ -2,6 +2,10 @@ import  numpy as np
 from PyQt5.QtCore import QObject, pyqtSlot, pyqtSignal, QTimer, QThread, QThreadPool, QRunnable
 
 import config
+from engine import fit_shot, fit_shots
+from acquisition import get_pulse_id
+from shots import make_shot
+from latency import monitor
 
 
 class WorkerSignal(QObject):
@@ -23,6 +27,12 @@ class WorkerSignal_ndarray(QObject):
 class WorkerSignal_dict(QObject):
     signal = pyqtSignal(dict)
 
+class WorkerSignal_list(QObject):
+    signal = pyqtSignal(list)
+
+class WorkerSignal_object(QObject):
+    signal = pyqtSignal(object)
+
 
 class Worker(QRunnable):
     """ Generic Task for ThreadPool to execute required Kwargs =
@@ -36,16 +46,17 @@ class Worker(QRunnable):
         self.target = target 
         self.args = args
         self.kwargs = kwargs
+        self.signals = signal
 
-        self.signals = WorkerSignal()
-        types = ['str','int','ndarray']
-        for t in type:
-            if type_out==t:
-                self.signals = eval('Workersignal_{}()'.format(t))
-
+    @pyqtSlot()
     def run(self):
-        out = self.target(*self.args, **self.kwargs)
-        self.signals.signal.emit(out)
+        try:
+            out = self.target(*self.args, **self.kwargs)
+        except Exception as e:
+            print('{} failed: {}'.format(getattr(self.target, '__name__', self.target), e))
+            return
+        if self.signals is not None:
+            self.signals.signal.emit(out)
 
 
 class GetWfWorker(QRunnable):
@@ -77,12 +88,11 @@ class GetWfWorker(QRunnable):
         '''
         Initialise the runner function with passed args, kwargs.
         '''
+        stamps = monitor.new_stamps()
         data = self.pv.get_with_metadata()
-        y = data['value']
-        x = np.arange(y.size) # just to get some x-values
-        if self.bkg_fun is not None:
-            y = y-self.bkg_fun(y)
-        d = np.c_[x,y].T
+        d = make_shot(data['value'], bkg_fun=self.bkg_fun, timestamp=data.get('timestamp'),
+                      pulse_id=get_pulse_id(data.get('nanoseconds')), stamps=stamps)
+        monitor.stamp(stamps, 'acquired')
         # d = data['value']
         if self.signals is not None:
             self.signals.signal.emit(d)
@@ -112,28 +122,44 @@ class FitWfWorker(QRunnable):
     
     @pyqtSlot()
     def run(self):
-        dat_fit = self.data[1]*self._polarity
-        if self.roi is not None:
-            dat_fit = dat_fit[self.roi[0]:self.roi[1]]
-            xfit = np.arange(self.roi[0],self.roi[1])
-        else:
-            xfit = np.arange(dat_fit.size)
-        if self.regressor is not None:
-            fit, score = self.regressor.fit_reconstruct(dat_fit, return_score=True)
-            fit = np.squeeze(fit)*self._polarity
-            fit = np.c_[xfit,fit].T
-            intensity = self.regressor.get_pulse_intensity(dat_fit, mode=config.INTENSITY_MODE)
-            intensity = intensity[0]
-        else:
-            fit = None
-            intensity = 0
-            score = 0
-
-        data_dict = {
-            'score': score,
-            'intensity': intensity,
-            'fit': fit,
-            'data': self.data
-        }
+        stamps = getattr(self.data, 'stamps', None)
+        monitor.stamp(stamps, 'fit_start')
+        data_dict = fit_shot(self.data, roi=self.roi, regressor=self.regressor, 
+                             polarity=self._polarity, mode=config.INTENSITY_MODE)
+        monitor.stamp(stamps, 'fit_end')
+        if self.signals is not None:
+            self.signals.signal.emit(data_dict)
+
+
+class BatchFitWorker(QRunnable):
+    '''
+    Worker thread to fit a batch of waveforms at once.
+    The waveforms are stacked and fitted in a single matrix multiplication. The results are 
+    emitted as a list of data_dict (same format as FitWfWorker), in the order of the shots.
+    '''
+    def __init__(self, data=None, roi=None, regressor=None, signal=None):
+        """ Args:
+        data: list of data to fit (same format as for FitWfWorker)
+        roi: roi
+        regressor: regressor instance
+        signal: WorkerSignal_list instance to be emitted when fit is done
+        """
+        super(BatchFitWorker, self).__init__()
+
+        self.data = data
+        self.roi = roi
+        self.regressor = regressor
+        self.signals = signal
+        self._polarity = config.POLARITY
+        return
+    
+    @pyqtSlot()
+    def run(self):
+        for d in self.data:
+            monitor.stamp(getattr(d, 'stamps', None), 'fit_start')
+        data_list = fit_shots(self.data, roi=self.roi, regressor=self.regressor, 
+                              polarity=self._polarity, mode=config.INTENSITY_MODE)
+        for d in self.data:
+            monitor.stamp(getattr(d, 'stamps', None), 'fit_end')
         if self.signals is not None:
-            self.signals.signal.emit(data_dict)
\ No newline at end of file
+            self.signals.signal.emit(data_list)